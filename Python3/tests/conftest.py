@@ -0,0 +1,5 @@
+"""The modules are run from Python3, where wspr_gui.py is started"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
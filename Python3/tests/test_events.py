@@ -0,0 +1,112 @@
+"""Events the beacon sends in binary mode, see wspr_cat.py and wspr_trace.py"""
+import os
+import struct
+import time
+
+import pytest
+
+import wspr_proto
+import wspr_sim
+import wspr_trace
+from wspr_cat import beacon, fixedPort
+from wspr_proto import (catFramer, make_frame, decode_event, is_event, EVENT_FORMAT,
+                        FRAME_EVENT, FRAME_STATUS, EVENT_CONFIG, beaconEvent)
+
+@pytest.fixture
+def simulator():
+    server = wspr_sim.simulatorServer()
+    server.start()
+    yield server
+    server.stop()
+
+def connect(sim):
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.speed_file = None
+    assert wsprdev.connect()
+    assert isinstance(wsprdev.query("QH"), wspr_proto.hwReply)
+    return wsprdev
+
+def event_frame(event = EVENT_CONFIG, state = 2):
+    return make_frame(FRAME_EVENT, EVENT_FORMAT.pack(event, 1760000000, state, 8, 20))
+
+def test_decode_event():
+    frame = event_frame()
+    assert is_event(frame)
+    assert decode_event(frame) == beaconEvent('config', 1760000000, 'OA', 8, 20)
+    assert not is_event(make_frame(FRAME_STATUS, b'\0' * 4))
+    assert decode_event(event_frame(event = 99)) is None
+    assert decode_event(event_frame(state = 7)) is None
+    assert decode_event(make_frame(FRAME_EVENT, struct.pack('<B', EVENT_CONFIG))) is None
+
+def test_event_between_replies():
+    frame = event_frame()
+    framer = catFramer()
+    framer.binary = True
+    framer.feed(b'OK\r\n' + frame[:5])
+    assert framer.next_frame() == b'OK'
+    assert framer.next_frame() is None
+    framer.feed(frame[5:] + b'SM0FXK,JO89,23,0\r\n')
+    assert framer.next_frame() == frame
+    assert framer.next_frame() == b'SM0FXK,JO89,23,0'
+
+def test_binary_status_and_events(simulator):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    wsprdev = connect(sim)
+    events = []
+    wsprdev.subscribe(events.append)
+    try:
+        assert wsprdev.enable_binary()
+        assert wsprdev.status_commands() == [("FS", [])]
+        assert wsprdev.query("QC", ['SM0FXK', 'JO89', 23, 0]) == wspr_proto.ackReply('OK')
+        status = wsprdev.query("FS")
+        assert isinstance(status, wspr_proto.fullStatus)
+        assert (status.call, status.locator, status.power) == ('SM0FXK', 'JO89', 23)
+        assert wsprdev.query("QC") == wspr_proto.configReply('SM0FXK', 'JO89', 23, 0)
+        assert [event.event for event in events] == ['config']
+    finally:
+        wsprdev.close()
+
+def test_events_while_idle(simulator):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    wsprdev = connect(sim)
+    events = []
+    wsprdev.subscribe(events.append)
+    wsprdev.start_worker()
+    try:
+        assert wsprdev.run_async(wsprdev.enable_binary).result()
+        wsprdev.query("QC", ['SM0FXK', 'JO89', 23, 0])
+        wsprdev.query("WS", ['TX', 4, 20])
+        deadline = time.monotonic() + 3.0
+        while 'state' not in [event.event for event in events] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        state = [event for event in events if event.event == 'state']
+        assert state and (state[-1].state, state[-1].interval, state[-1].band) == ('WT', 4, 20)
+        assert wsprdev.state.status == wspr_proto.statusReply('WT', 4, 20)
+    finally:
+        wsprdev.close()
+
+def test_replay_binary_trace(simulator, tmp_path):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    path = os.path.join(str(tmp_path), 'binary.trace')
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.speed_file = None
+    wsprdev.trace = wspr_trace.traceWriter(path)
+    assert wsprdev.connect()
+    try:
+        wsprdev.query("QH")
+        assert wsprdev.enable_binary()
+        for n in range(3):
+            wsprdev.query("QC", ['SM0FXK', 'JO89', 23, n])
+            time.sleep(0.05)
+            wsprdev.query_batch([("QC", []), ("WS", ['ST'])])
+    finally:
+        wsprdev.close()
+        wsprdev.trace.close()
+    for realtime in (False, True):
+        replayed, replies = wspr_trace.replay_commands(path, realtime)
+        assert replayed.binary
+        configs = [reply for reply in replies if isinstance(reply, wspr_proto.configReply)]
+        assert configs == [wspr_proto.configReply('SM0FXK', 'JO89', 23, n) for n in range(3)]
+        assert replayed.replay.mismatches == []
+        # The event frames split over two reads are put together again
+        assert replayed.metrics.snapshot()['counters'].get('events_total:config') == 3
@@ -0,0 +1,84 @@
+"""The fleet daemon with simulated beacons, see wspr_fleet.py"""
+import asyncio
+import time
+
+import pytest
+
+import wspr_sim
+from wspr_fleet import fleetMember
+
+@pytest.fixture
+def simulator():
+    server = wspr_sim.simulatorServer()
+    server.start()
+    yield server
+    server.stop()
+
+def configured_beacon(server, actions):
+    sim = server.add(wspr_sim.simulatedBeacon())
+    # As QC would
+    sim.eeprom.put_str('call', b'SM0FXK')
+    sim.eeprom.put_str('locator', b'JO89')
+    sim.eeprom.put_int('power', 23)
+    sim.eeprom.put_int('xtal_offset', 0)
+    sim.eeprom.put_str('magic', wspr_sim.MAGIC)
+    wspr = sim.wspr
+    def record(command, now):
+        if command[:2] in ('TX', 'CA'):
+            actions.append((sim.device, command))
+        wspr(command, now)
+    sim.wspr = record
+    return sim
+
+def member(spec):
+    fleet_member = fleetMember(spec)
+    fleet_member.wsprdev.wsprdev.speed_file = None
+    return fleet_member
+
+async def wait_for(condition, timeout = 10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.05)
+
+def test_start_stop_and_reconnect(simulator):
+    actions = []
+    started = configured_beacon(simulator, actions)
+    stopped = configured_beacon(simulator, actions)
+    # Already transmitting, the daemon should stop it
+    stopped.wspr_state = wspr_sim.waiting_for_timeslot
+
+    async def run():
+        fleet = [member(started.device + ',4,20'), member(stopped.device + ',stop')]
+        tasks = [asyncio.ensure_future(m.run()) for m in fleet]
+        try:
+            await wait_for(lambda: fleet[0].state == 'WT' and fleet[1].state == 'DI')
+            assert fleet[0].wsprdev.wsprdev.binary and fleet[1].wsprdev.wsprdev.binary
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+        assert sorted(actions) == sorted([(started.device, 'TX,4,20'), (stopped.device, 'CA')])
+        assert (started.wspr_state, started.timeslot, started.bands) == \
+            (wspr_sim.waiting_for_timeslot, 4, 20)
+        assert stopped.wspr_state == wspr_sim.inactive
+
+        # The beacon is reset, FS is not known until BM1 again. It goes on
+        # transmitting from the EEPROM and is not told to start again.
+        beacon = fleet[0].wsprdev
+        started.reset(time.monotonic())
+        started.booting_until = 0
+        status = None
+        for n in range(10):
+            status = await beacon.poll(fleet[0].action)
+            if status is not None and beacon.wsprdev.negotiated:
+                break
+            await asyncio.sleep(0.2)
+            beacon.wsprdev.retry_at = 0
+        assert (status.state, status.interval, status.band) == ('WT', 4, 20)
+        assert beacon.wsprdev.binary
+        assert len(actions) == 2
+        for m in fleet:
+            m.wsprdev.close()
+
+    asyncio.run(run())
@@ -0,0 +1,26 @@
+"""The transmission journal, see wspr_journal.py"""
+import calendar
+import os
+
+import wspr_journal
+
+HOUR = calendar.timegm((2024, 10, 10, 13, 0, 0))
+
+def minutes(t):
+    return (t - HOUR) // 60
+
+def test_missed_slots(tmp_path):
+    journal = wspr_journal.transmissionJournal(os.path.join(str(tmp_path), 'journal.sqlite'))
+    try:
+        start = HOUR - 3600 + 40 * 60
+        journal.status('dev', 'WT', 8, 20, t = start)
+        # On air in the slots at minute 48, 56, 0 and 8, not in the one at 40
+        for m in (48, 56, 60, 68):
+            journal.status('dev', 'OA', 8, 20, t = HOUR - 3600 + m * 60 + 1)
+            journal.status('dev', 'WT', 8, 20, t = HOUR - 3600 + m * 60 + 115)
+        journal.flush()
+        missed = journal.missed_slots(start, HOUR + 16 * 60)
+        assert [(minutes(slot), band, interval) for slot, device, band, interval in missed] \
+            == [(-20, 20, 8)]
+    finally:
+        journal.close()
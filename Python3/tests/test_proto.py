@@ -0,0 +1,162 @@
+"""Framing and decoding of the beacon replies, see wspr_proto.py"""
+import wspr_proto
+from wspr_cat import beacon, fixedPort
+from wspr_proto import (catFramer, make_frame, decode_reply, parse_full_status, ERROR_FRAME,
+                        CORRUPT_FRAME, TIME_REQUEST, STATUS_FORMAT, FRAME_STATUS, FRAME_START,
+                        statusReply, configReply, timeReply, fullStatus)
+
+def frames(framer):
+    result = []
+    while True:
+        frame = framer.next_frame()
+        if frame is None:
+            return result
+        result.append(frame)
+
+def binary_framer():
+    framer = catFramer()
+    framer.binary = True
+    return framer
+
+def status_payload(state = 1, configured = 1):
+    return STATUS_FORMAT.pack(1760000000, state, 8, 20, 0, configured, 2,
+                              b'SM0FXK\0\0', b'JO89\0', 23, -12)
+
+#=============================================================================#
+# Framing
+#=============================================================================#
+def test_lines():
+    framer = catFramer()
+    framer.feed(b'WT,8,20\r\nOK\r\n')
+    assert frames(framer) == [b'WT,8,20', b'OK']
+
+def test_partial_line():
+    framer = catFramer()
+    framer.feed(b'WT,8')
+    assert framer.next_frame() is None
+    framer.feed(b',20\r\n')
+    assert frames(framer) == [b'WT,8,20']
+
+def test_unknown_command():
+    framer = catFramer()
+    framer.feed(b'?;OK\r\n')
+    assert frames(framer) == [ERROR_FRAME, b'OK']
+
+def test_garbage_and_time_requests():
+    framer = catFramer()
+    framer.feed(b'\x00\xff' + bytes([TIME_REQUEST]) + b'DI\r\nW' + bytes([TIME_REQUEST]) + b'T,8,20\r\n')
+    assert frames(framer) == [b'DI', b'WT,8,20']
+    assert framer.time_requests == 2
+
+def test_blank_line():
+    framer = catFramer()
+    framer.feed(b'\x00\xff\r\n1760000000\r\n')
+    assert frames(framer) == [b'', b'1760000000']
+
+def test_frame_start_without_binary():
+    framer = catFramer()
+    framer.feed(bytes([FRAME_START]) + b'garbage\r\nDI\r\n')
+    assert frames(framer) == [b'garbage', b'DI']
+
+def test_binary_frame():
+    frame = make_frame(FRAME_STATUS, status_payload())
+    framer = binary_framer()
+    framer.feed(b'OK\r\n' + frame + b'DI\r\n')
+    assert frames(framer) == [b'OK', frame, b'DI']
+
+def test_binary_frame_in_pieces():
+    frame = make_frame(FRAME_STATUS, status_payload())
+    framer = binary_framer()
+    for n in range(len(frame) - 1):
+        framer.feed(frame[n:n + 1])
+        assert framer.next_frame() is None
+    framer.feed(frame[-1:])
+    assert framer.next_frame() == frame
+
+def test_corrupt_frame():
+    frame = bytearray(make_frame(FRAME_STATUS, status_payload()))
+    frame[10] ^= 0x01
+    framer = binary_framer()
+    framer.feed(bytes(frame) + b'\r\nOK\r\n')
+    found = frames(framer)
+    assert found[0] == CORRUPT_FRAME
+    assert found[-1] == b'OK'
+
+def test_resync_after_corrupt_frame():
+    # A length byte lost on the line: the frame seems to reach into the next one
+    frame = make_frame(FRAME_STATUS, status_payload())
+    damaged = frame[:2] + frame[3:]
+    framer = binary_framer()
+    framer.feed(damaged[:-4] + frame)
+    found = frames(framer)
+    assert found[0] == CORRUPT_FRAME
+    assert found[-1] == frame
+
+def test_impossible_header():
+    framer = binary_framer()
+    framer.feed(bytes([FRAME_START, 9, 255]) + b'\r\nOK\r\n')
+    found = frames(framer)
+    assert found[0] == CORRUPT_FRAME
+    assert found[-1] == b'OK'
+
+def test_clear_keeps_frame():
+    frame = make_frame(FRAME_STATUS, status_payload())
+    framer = binary_framer()
+    framer.feed(frame[:4])
+    assert framer.next_frame() is None
+    framer.clear(keep_frame = True)
+    framer.feed(frame[4:] + b'OK\r\n')
+    assert frames(framer) == [frame, b'OK']
+
+def test_clear_drops_text():
+    framer = binary_framer()
+    framer.feed(b'WT,8')
+    framer.clear(keep_frame = True)
+    framer.feed(b'OK\r\n')
+    assert frames(framer) == [b'OK']
+
+#=============================================================================#
+# Decoding
+#=============================================================================#
+def test_decode_status():
+    assert decode_reply('WS', ['ST'], b'WT,8,20') == statusReply('WT', 8, 20)
+    assert decode_reply('WS', ['ST'], b'DI') == statusReply('DI', None, None)
+    assert decode_reply('QC', [], b'SM0FXK,JO89,23,-12') == configReply('SM0FXK', 'JO89', 23, -12)
+    assert decode_reply('QT', [], b'1760000000') == timeReply(1760000000)
+
+def test_decode_errors():
+    assert decode_reply('WS', ['ST'], None).reason == wspr_proto.TIMEOUT
+    assert decode_reply('WS', ['ST'], ERROR_FRAME).reason == wspr_proto.UNKNOWN_COMMAND
+    assert decode_reply('WS', ['ST'], b'XX,1').reason == wspr_proto.BAD_REPLY
+    assert decode_reply('QC', [], b'NC').reason == wspr_proto.NOT_CONFIGURED
+    assert decode_reply('QT', [], b'noon').reason == wspr_proto.BAD_REPLY
+
+def test_decode_blank_line():
+    assert decode_reply('QT', [], b'').reason == wspr_proto.BAD_REPLY
+    # The batch carries on with the replies after it
+    wsprdev = beacon(fixedPort('/dev/null'))
+    replies = wsprdev.decode([("QT", []), ("WS", ['ST'])], [b'', b'WT,8,20'])
+    assert replies[0].reason == wspr_proto.BAD_REPLY
+    assert replies[1] == statusReply('WT', 8, 20)
+
+def test_decode_full_status():
+    frame = make_frame(FRAME_STATUS, status_payload())
+    assert decode_reply('FS', [], frame) == fullStatus(1760000000, 'WT', 8, 20, 0, True, '2',
+                                                       'SM0FXK', 'JO89', 23, -12)
+    assert decode_reply('FS', [], CORRUPT_FRAME).reason == wspr_proto.CORRUPT
+    assert decode_reply('QC', [], frame).reason == wspr_proto.BAD_REPLY
+
+def test_full_status_not_configured():
+    status = parse_full_status(status_payload(state = 0, configured = 0))
+    assert (status.state, status.interval, status.band, status.call) == ('DI', None, None, None)
+    assert parse_full_status(status_payload()[:-1]) is None
+    assert parse_full_status(status_payload(state = 7)) is None
+
+def test_binary_follows_the_beacon():
+    wsprdev = beacon(fixedPort('/dev/null'))
+    assert not wsprdev.framer.binary
+    wsprdev.binary = True
+    assert wsprdev.framer.binary
+    # FS ?; means the beacon has been reset, without BM1
+    wsprdev.decode([("FS", [])], [ERROR_FRAME])
+    assert not wsprdev.binary and not wsprdev.framer.binary
@@ -0,0 +1,44 @@
+"""The CAT server with a simulated beacon, see wspr_server.py"""
+import time
+
+import pytest
+
+import wspr_server
+import wspr_sim
+from wspr_cat import beacon, fixedPort
+
+@pytest.fixture
+def mux():
+    server = wspr_sim.simulatorServer()
+    sim = server.add(wspr_sim.simulatedBeacon())
+    server.start()
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.speed_file = None
+    multiplexer = wspr_server.beaconMultiplexer(wsprdev)
+    yield multiplexer
+    multiplexer.stop()
+    server.stop()
+
+def test_bad_parameters(mux):
+    mux.wsprdev.start_worker()
+    assert mux.handle(b'QCSM0FXK,JO89,23,0') == b'OK\r\n'
+    for command in (b'WSTX,abc,20', b'WSTX,4', b'QCSM0FXK,JO89,x,0', b'QTnoon'):
+        assert mux.handle(command) == b'ER\r\n'
+    assert mux.handle(b'WSTX,4,20') == b'OK\r\n'
+    assert mux.handle(b'WSST') == b'WT,4,20\r\n'
+
+def test_poll_goes_on_after_an_error(mux):
+    poll = mux.poll
+    polls = []
+    def failing_poll():
+        polls.append(time.monotonic())
+        if len(polls) == 1:
+            raise ValueError("unexpected reply")
+        return poll()
+    mux.poll = failing_poll
+    mux.start()
+    deadline = time.monotonic() + 5.0
+    while len(polls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(polls) >= 2
+    assert mux.poller.is_alive()
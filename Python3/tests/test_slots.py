@@ -0,0 +1,32 @@
+"""Slot arithmetic, see wspr_poll.py"""
+import calendar
+
+from wspr_poll import slot_start, slot_end, next_transition, TX_END
+
+HOUR = calendar.timegm((2024, 10, 10, 13, 0, 0))
+
+def minutes(t):
+    return (t - HOUR) // 60
+
+def test_slot_start():
+    assert minutes(slot_start(HOUR, 2)) == 0
+    assert minutes(slot_start(HOUR + 3 * 60 + 59, 2)) == 2
+    assert minutes(slot_start(HOUR + 17 * 60, 8)) == 16
+
+def test_slots_start_every_hour():
+    # 60 is not a multiple of 8, the slot at minute 56 is 4 minutes long
+    assert minutes(slot_start(HOUR + 57 * 60, 8)) == 56
+    assert minutes(slot_end(HOUR + 57 * 60, 8)) == 60
+    assert minutes(slot_start(HOUR + 60 * 60 + 1, 8)) == 60
+    assert minutes(slot_end(HOUR + 60 * 60 + 1, 8)) == 68
+
+def test_slot_end():
+    assert minutes(slot_end(HOUR, 2)) == 2
+    assert minutes(slot_end(HOUR + 59 * 60, 2)) == 60
+    assert minutes(slot_end(HOUR + 30 * 60, 20)) == 40
+
+def test_next_transition():
+    assert minutes(next_transition('WT', 8, HOUR + 57 * 60)) == 60
+    assert next_transition('OA', 8, HOUR + 8 * 60 + 30) == HOUR + 8 * 60 + TX_END
+    assert next_transition('DI', 8, HOUR) is None
+    assert next_transition('WT', 0, HOUR) is None
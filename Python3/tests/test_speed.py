@@ -0,0 +1,72 @@
+"""Line speed negotiation with a simulated beacon, see wspr_cat.py"""
+import os
+import time
+
+import pytest
+
+import wspr_proto
+import wspr_sim
+from wspr_cat import beacon, fixedPort, SPEED, LINE_SPEEDS
+
+@pytest.fixture
+def simulator():
+    server = wspr_sim.simulatorServer()
+    server.start()
+    yield server
+    server.stop()
+
+def connect(sim, speed_file = None):
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.speed_file = speed_file
+    assert wsprdev.connect()
+    assert isinstance(wsprdev.query("QH"), wspr_proto.hwReply)
+    return wsprdev
+
+def test_negotiate_speed(simulator, tmp_path):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    speed_file = os.path.join(str(tmp_path), 'speed.json')
+    wsprdev = connect(sim, speed_file)
+    try:
+        assert wsprdev.negotiate_speed() == LINE_SPEEDS[0]
+        assert sim.speed == LINE_SPEEDS[0]
+        assert wsprdev.query("QB") == wspr_proto.speedReply(LINE_SPEEDS[0])
+        assert isinstance(wsprdev.query("WS", ['ST']), wspr_proto.statusReply)
+    finally:
+        wsprdev.close()
+    # The next connection starts at the speed that worked
+    wsprdev = connect(sim, speed_file)
+    try:
+        assert wsprdev.speed == LINE_SPEEDS[0]
+    finally:
+        wsprdev.close()
+
+def test_old_firmware(simulator):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    sim.serial_speed = sim.error
+    wsprdev = connect(sim)
+    try:
+        t = time.monotonic()
+        assert wsprdev.negotiate_speed() == SPEED
+        # Without QB there is nothing to wait for
+        assert time.monotonic() - t < 1.0
+        assert isinstance(wsprdev.query("QH"), wspr_proto.hwReply)
+    finally:
+        wsprdev.close()
+
+def test_speed_not_confirmed(simulator):
+    sim = simulator.add(wspr_sim.simulatedBeacon())
+    change = sim.serial_speed
+    def wrong_speed(param, now):
+        # The beacon changes to another speed than asked for
+        change(param, now)
+        if param:
+            sim.speed = 38400
+    sim.serial_speed = wrong_speed
+    wsprdev = connect(sim)
+    try:
+        assert wsprdev.negotiate_speed() == SPEED
+        # The firmware has gone back to SPEED by itself
+        assert sim.speed == SPEED
+        assert isinstance(wsprdev.query("QH"), wspr_proto.hwReply)
+    finally:
+        wsprdev.close()
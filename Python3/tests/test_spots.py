@@ -0,0 +1,31 @@
+"""The spot archive analyser, see wspr_spots.py"""
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import wspr_spots
+
+SPOTS = ('1,1767225600,DL1AAA,JO50,-20,14.097100,SM0FXK,JO89,23,0,1000,200,20,1,0\n'
+         '2,1767225600,SM0FXK,JO89,-20,14.097100,DL1BBB,JO50,23,0,1000,200,20,1,0\n'
+         '3,1767229200,"G4AAA","IO91",-20,7.040100,"SM0FXK","JO89",23,0,1500,200,40,1,0\n'
+         '4,1767229200,G4AAA,IO91,-18,1.838100,SM0FXK,JO89,23,0,1500,200,160,1,0\n')
+
+@pytest.fixture
+def archive(tmp_path):
+    path = os.path.join(str(tmp_path), 'wsprspots-2026-01.csv')
+    with open(path, 'w') as f:
+        f.write(SPOTS)
+    return path
+
+def test_spots_of_the_call(archive, tmp_path):
+    spots = wspr_spots.load([archive], 'sm0fxk', root = str(tmp_path))
+    # The spot SM0FXK reported is left out, the quoted call is found
+    assert sorted(spots['band']) == [20, 40, 160]
+
+def test_aggregate_some_bands(archive, tmp_path):
+    spots = wspr_spots.load([archive], 'SM0FXK', root = str(tmp_path))
+    stats = wspr_spots.aggregate(spots, bands = [40, 20])
+    assert stats['bands'] == [40, 20]
+    assert stats['spots'].sum() == 2
+    assert stats['spots'][0, 1] == 1 and stats['spots'][1, 0] == 1
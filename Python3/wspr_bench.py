@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the CAT link between the host and the WSPR beacon.
+
+The benchmarks run against the simulated beacon in wspr_sim, paced to the
+baud rate under test, so the numbers are reproducible without hardware.
+The link is moved to the baud rate under test with QB, as negotiate_speed
+in wspr_cat does it.
+For every command type the round trip latency (p50/p99), commands per
+second and bytes on the wire are measured, including the string building
+in compose_cat_command and the decoding in cat_to_dict. The status polls
+of the GUI are measured as well, with the batches fetch() sends: the
+first poll, the later ones, and the FS poll once binary frames are on.
+
+The startup of the GUI is measured as well: the imports and the setup
+done before the main window is shown, each in a fresh interpreter with a
+home directory of its own, so the journal and port database are new.
+wspr_bench.py --startup fails when it takes longer than STARTUP_LIMIT,
+so a heavy import or a blocking call at startup is caught.
+
+The results are written as JSON, so runs of different releases can be
+compared.
+
+Usage:
+  wspr_bench.py [-n COUNT] [-b BAUD,BAUD,...] [-o results.json]
+  wspr_bench.py --startup
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from wspr_cat import SPEED, beacon, fixedPort, compose_cat_command, cat_to_dict
+import wspr_sim
+
+BAUDRATES = [SPEED, 57600, 115200]
+COUNT = 200
+STARTUP_RUNS = 5
+STARTUP_LIMIT = 0.25        # Seconds from the first import until the window can be built
+
+# What wspr_gui.py does before the main window is built, without Tk
+startup_script = '''
+import time
+start = time.perf_counter()
+from wspr_cat import beacon
+from wspr_config import WsprConfig, serialPort, when_done
+from wspr_clock import clockSync
+import wspr_poll, wspr_metrics, wspr_proto
+from wspr_journal import transmissionJournal
+import wspr_trace
+import queue
+imported = time.perf_counter()
+wsprdev = beacon(serialPort())
+wsprdev.journal = transmissionJournal()
+wsprdev.trace = wspr_trace.from_env()
+events = queue.Queue()
+wsprdev.subscribe(events.put)
+wsprdev.start_worker()
+clock = clockSync(wsprdev)
+wspr_metrics.export_from_env()
+ready = time.perf_counter()
+print(imported - start, ready - imported)
+'''
+
+# Commands that do not change the beacon state
+commands = {'QT': ("QT", []),
+            'WSST': ("WS", ['ST']),
+            'QH': ("QH", []),
+            'QC': ("QC", [])}
+
+# The batches fetch() in the GUI polls with. The first poll also reads
+# the hardware, in binary mode FS replaces them.
+poll_batches = {'first_poll': [("WS", ['ST']), ("QH", [])],
+                'poll': [("WS", ['ST'])]}
+binary_batches = {'poll_binary': [("FS", [])]}
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+def summary(samples, wire_in, wire_out):
+    total = sum(samples)
+    return {'count': len(samples),
+            'p50_ms': percentile(samples, 50) * 1000.0,
+            'p99_ms': percentile(samples, 99) * 1000.0,
+            'mean_ms': total / len(samples) * 1000.0,
+            'per_second': len(samples) / total if total > 0 else None,
+            'bytes_to_beacon': wire_in / float(len(samples)),
+            'bytes_from_beacon': wire_out / float(len(samples))}
+
+def measure(sim, count, function, *args):
+    samples = []
+    bytes_in = sim.bytes_in
+    bytes_out = sim.bytes_out
+    for i in range(count):
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+    return summary(samples, sim.bytes_in - bytes_in, sim.bytes_out - bytes_out)
+
+def bench_codec(count):
+    """Host side cost of building commands and parsing replies, no I/O"""
+    results = {}
+    reply = str.encode('WT,4,20\r\n')
+    start = time.perf_counter()
+    for i in range(count):
+        str.encode(compose_cat_command('WS', ['TX', 4, 20]))
+    results['compose_us'] = (time.perf_counter() - start) / count * 1e6
+    start = time.perf_counter()
+    for i in range(count):
+        cat_to_dict(reply.decode('utf-8'))
+    results['decode_us'] = (time.perf_counter() - start) / count * 1e6
+    return results
+
+def bench_link(baudrate, count):
+    server = wspr_sim.simulatorServer()
+    sim = server.add(wspr_sim.simulatedBeacon())
+    server.start()
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.speed_file = None       # The pty is gone after the run
+    if not wsprdev.connect():
+        server.stop()
+        raise RuntimeError("cannot open simulated beacon " + sim.device)
+    # The link starts at SPEED, as the firmware does after a reset
+    wsprdev.query("QH")
+    if baudrate != SPEED and wsprdev.negotiate_speed((baudrate,)) != baudrate:
+        wsprdev.close()
+        server.stop()
+        raise RuntimeError("beacon did not change to %d baud" % baudrate)
+    wsprdev.send_cat_cmd("QC", ['SM0FXK', 'JO89', 23, 0])
+    results = {'baudrate': baudrate, 'commands': {}}
+    for name, (cmd, parameters) in commands.items():
+        results['commands'][name] = measure(sim, count, wsprdev.send_cat_cmd, cmd, parameters)
+    results['polls'] = {}
+    for name, batch in poll_batches.items():
+        results['polls'][name] = measure(sim, count, wsprdev.query_batch, batch)
+    if not wsprdev.enable_binary():
+        wsprdev.close()
+        server.stop()
+        raise RuntimeError("beacon did not switch to binary frames")
+    for name, batch in binary_batches.items():
+        results['polls'][name] = measure(sim, count, wsprdev.query_batch, batch)
+    wsprdev.close()
+    server.stop()
+    return results
+
+def bench_startup(runs = STARTUP_RUNS):
+    """Seconds spent on imports and on setup before the GUI window, median of runs"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, HOME = home, USERPROFILE = home)
+    imports = []
+    setups = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', startup_script], cwd = here,
+                                         stdin = subprocess.DEVNULL, env = env)
+        t_import, t_setup = [float(x) for x in output.split()[-2:]]
+        imports.append(t_import)
+        setups.append(t_setup)
+    shutil.rmtree(home, ignore_errors = True)
+    return {'runs': runs,
+            'import_ms': percentile(imports, 50) * 1000.0,
+            'setup_ms': percentile(setups, 50) * 1000.0,
+            'total_ms': percentile([a + b for a, b in zip(imports, setups)], 50) * 1000.0,
+            'limit_ms': STARTUP_LIMIT * 1000.0}
+
+def run(baudrates = BAUDRATES, count = COUNT):
+    results = {'benchmark': 'wspr_cat',
+               'version': 2,
+               'time': int(time.time()),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'count': count,
+               'codec': bench_codec(count * 100),
+               'startup': bench_startup(),
+               'links': []}
+    for baudrate in baudrates:
+        results['links'].append(bench_link(baudrate, count))
+    return results
+
+def report_startup(startup):
+    print("startup: imports %.1f ms, setup %.1f ms, total %.1f ms (limit %.0f ms)" %
+          (startup['import_ms'], startup['setup_ms'], startup['total_ms'], startup['limit_ms']))
+
+def report(results):
+    report_startup(results['startup'])
+    print("compose %.2f us, decode %.2f us" % (results['codec']['compose_us'],
+                                                results['codec']['decode_us']))
+    for link in results['links']:
+        print("%d baud" % link['baudrate'])
+        rows = list(link['commands'].items()) + list(link['polls'].items())
+        for name, r in rows:
+            print("  %-11s p50 %7.2f ms  p99 %7.2f ms  %7.1f/s  %5.1f B out  %5.1f B in" %
+                  (name, r['p50_ms'], r['p99_ms'], r['per_second'],
+                   r['bytes_to_beacon'], r['bytes_from_beacon']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "CAT link benchmarks")
+    parser.add_argument('-n', '--count', type = int, default = COUNT,
+                        help = "round trips per command")
+    parser.add_argument('-b', '--baud', default = ','.join(str(b) for b in BAUDRATES),
+                        help = "comma separated baud rates")
+    parser.add_argument('-o', '--output', help = "write the results as JSON to this file")
+    parser.add_argument('--startup', action = 'store_true',
+                        help = "only measure the GUI startup, fail above the limit")
+    args = parser.parse_args()
+    if args.startup:
+        startup = bench_startup()
+        report_startup(startup)
+        sys.exit(1 if startup['total_ms'] > startup['limit_ms'] else 0)
+    results = run([int(b) for b in args.baud.split(',')], args.count)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
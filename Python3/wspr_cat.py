@@ -22,10 +22,16 @@ This file is part of the graphical user interface for WSPR beacon.
 """
 import serial
 import time
+import wspr_proto
+import wspr_metrics
 import datetime
+import json
 import os
+import select
 import sys
-from wspr_config import serialPort
+import threading
+import queue
+from concurrent.futures import Future
 
 if os.name == 'posix':
     import termios
@@ -33,56 +39,715 @@ if os.name == 'posix':
 
 conf = {'ddsdev': '/dev/ttyACM0'}
 SPEED=9600   #19200
+BANDS = [160,80,40,30,20,17,15,12,10]   # Meters
+INTERVALS = [2, 4, 6, 8]                # Minutes
+HW_NAMES = {'1': "SA6VEE board with AD9850",     # Reply to QH
+            '2': "Arduino UNO with Si5351 and DS3231 real time clock"}
+
+# Transmission timing of the firmware
+SYMBOL_COUNT = 162
+SYMBOL_TIME = 0.683                     # Seconds
+TX_DELAY = 1.0                          # Seconds from slot start to first symbol
+TX_LENGTH = TX_DELAY + SYMBOL_COUNT * SYMBOL_TIME
+
+# Link states of beacon
+LINK_DOWN = 'down'          # Device not present, wait for it to be plugged in
+LINK_BACKOFF = 'backoff'    # Open failed or link lost, retry later
+LINK_UP = 'up'
+RETRY_MIN = 1.0             # Seconds
+RETRY_MAX = 60.0
+MAX_NO_REPLY = 3            # Missing replies in a row before the link is down
+REPLY_TIMEOUT = 1.0         # Seconds
+READ_TIMEOUT = 0.1          # Seconds a read of the port may block
+EVENT_WAIT = 1.0            # Seconds the idle I/O thread waits for events before looking around
+
+# Line speed, see negotiate_speed()
+LINE_SPEEDS = (115200, 57600)   # Proposed with QB, fastest first
+SPEED_CONFIRM_TIME = 2.5        # Seconds, the firmware goes back to SPEED after 2
+SPEED_FILE = "fxk_wspr_speed.json"
+
+def compose_cat_command(cmd, parameters):
+    for parameter in parameters:
+        cmd = cmd + str(parameter) + ','
+#   print cmd
+    return cmd.rstrip(',') +';'
+
+def cat_to_dict(answer):
+    #print (answer)
+
+    return answer.strip('\r\n').split(',')
+
+def disable_hupcl(fd):
+    """Keep DTR up when the port is closed, so the next open does not reset the Arduino"""
+    if os.name == 'posix':
+        attr = termios.tcgetattr(fd)
+        attr[2] = attr[2] & ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attr)
+
+def speed_path():
+    if os.name == 'nt':
+        DB_DIR = os.environ["USERPROFILE"]
+    else:
+        DB_DIR = os.environ["HOME"]
+    return DB_DIR + os.sep + SPEED_FILE
+
+def load_speeds(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def remembered_speed(path, port):
+    """The last line speed that worked with the device, SPEED if none"""
+    if path is None:
+        return SPEED
+    return load_speeds(path).get(port, SPEED)
+
+def remember_speed(path, port, speed):
+    if path is None:
+        return
+    speeds = load_speeds(path)
+    if speeds.get(port, SPEED) == speed:
+        return
+    if speed == SPEED:
+        del speeds[port]
+    else:
+        speeds[port] = speed
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(speeds, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(e)
+
+class fixedPort:
+    """
+    Serial port configuration that is given on the command line instead
+    of being stored in the database. Same interface as serialPort.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def get(self):
+        return self.device
+
+    def set(self, dev_string):
+        self.device = dev_string
+
+class hotplugWatcher:
+    """
+    Detects that serial devices have been added or removed. On Linux the
+    /dev directory changes when a device node is created or deleted, so
+    one stat() per check is enough. Elsewhere there is nothing cheap to
+    watch, and the caller relies on the retry timer.
+    """
+    def __init__(self, path = '/dev'):
+        self.path = path
+        self.stamp = self.read_stamp()
+
+    def read_stamp(self):
+        if os.name != 'posix':
+            return None
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self):
+        stamp = self.read_stamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+class BeaconState:
+    """
+    Mirror of what the beacon keeps in its flash_layout: the configuration
+    written with QC, and band, interval and state. It is filled from the
+    replies to QC, WS ST and QH, or all at once from FS, and kept up to
+    date from successful
+    QC, WS TX and WS CA writes, so it only needs to be read from the
+    beacon once. None means not known. Everything is forgotten on a
+    reconnect or an unexpected reply.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.config = None          # wspr_proto.configReply
+        self.configured = None      # False when the beacon answered NC
+        self.status = None          # wspr_proto.statusReply
+        self.hw = None
+
+    def missing(self):
+        """The queries needed to fill in what is not known"""
+        commands = []
+        if self.configured is None:
+            commands.append(("QC", []))
+        if self.status is None:
+            commands.append(("WS", ['ST']))
+        if self.hw is None:
+            commands.append(("QH", []))
+        return commands
+
+    def update(self, cat_cmd, parameters, reply):
+        if wspr_proto.is_error(reply):
+            if reply.reason == wspr_proto.NOT_CONFIGURED:
+                self.configured = False
+                self.config = None
+            else:
+                self.invalidate()
+            return
+        key = wspr_proto.schema_key(cat_cmd, parameters)
+        if key == ('QC', 'get'):
+            self.config = reply
+            self.configured = True
+        elif key == ('QC', 'set'):
+            call, locator, power, offset = [str(p) for p in parameters]
+            try:
+                self.config = wspr_proto.configReply(call, locator, int(power), int(offset))
+                self.configured = True
+            except ValueError:
+                # The firmware has used atoi(), read back what it stored
+                self.config = None
+                self.configured = None
+            # The firmware resets band and interval in EEPROM but not the running state
+            self.status = None
+        elif key == ('WS', 'ST'):
+            self.status = reply
+        elif key == ('WS', 'TX'):
+            try:
+                self.status = wspr_proto.statusReply('WT', int(parameters[1]), int(parameters[2]))
+            except (ValueError, IndexError):
+                # The firmware has used atoi(), read back what it runs
+                self.status = None
+        elif key == ('WS', 'CA'):
+            if self.status is not None:
+                self.status = self.status._replace(state = 'DI')
+        elif key == ('QH', 'get'):
+            self.hw = reply.hw
+        elif key == ('FS', 'get'):
+            self.status = wspr_proto.statusReply(reply.state, reply.interval, reply.band)
+            self.hw = reply.hw
+            self.configured = reply.configured
+            self.config = None
+            if reply.configured:
+                self.config = wspr_proto.configReply(reply.call, reply.locator,
+                                                     reply.power, reply.offset)
+        elif cat_cmd == 'TX':
+            self.status = None
 
 class beacon:
     def __init__(self, config):
         self.config_data = config
-        if os.name == 'posix':
-            self.fd = sys.stdin.fileno()
-            # Stop resetting the arduino on serial connect
-            self.newattr = termios.tcgetattr(self.fd)
-            self.newattr[2] = self.newattr[2] & ~termios.HUPCL
-            termios.tcsetattr(self.fd, termios.TCSANOW, self.newattr)
 #        self.arduino = serial.Serial(serialdev, baudrate = SPEED, timeout=1, writeTimeout=3)
+        self.worker = None
+        self.requests = None
+        self.arduino = None
+        self.link_state = LINK_DOWN
+        self.retry_delay = RETRY_MIN
+        self.retry_at = 0.0
+        self.no_reply = 0
+        self.hotplug = hotplugWatcher()
+        self.framer = wspr_proto.catFramer()
+        self.state = BeaconState()
+        self.metrics = wspr_metrics.linkMetrics()
+        self.journal = None         # wspr_journal.transmissionJournal
+        self.trace = None           # wspr_trace.traceWriter
+        self.speed_file = speed_path()  # Line speed per device, None = always SPEED
+        self.speed = SPEED
+        self.answered = False       # A reply at self.speed since the port was opened
+        self.negotiated = False
+        self.subscribers = []       # Called with every wspr_proto.beaconEvent
+        self.wakeup = None          # Pipe that wakes the idle I/O thread
+
+    @property
+    def binary(self):
+        """The beacon sends binary frames, FS can be used"""
+        return self.framer.binary
+
+    @binary.setter
+    def binary(self, on):
+        # Without BM1 the framer takes FRAME_START for garbage
+        self.framer.binary = on
+
+    #=========================================================================#
+    # I/O worker
+    # Once started, all serial traffic is done by one thread that serves a
+    # command queue. Requests return a Future, so the caller (the Tk main
+    # loop) never waits for the beacon. While the beacon sends events, the
+    # idle thread reads them as they come.
+    #=========================================================================#
+    def start_worker(self):
+        if self.worker is None:
+            self.requests = queue.Queue()
+            if os.name == 'posix':
+                self.wakeup = os.pipe()
+                os.set_blocking(self.wakeup[1], False)
+            self.worker = threading.Thread(target=self.io_loop, name='beacon-io')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop_worker(self):
+        if self.worker is not None:
+            self.requests.put(None)
+            self.wake()
+            if threading.current_thread() is not self.worker:
+                self.worker.join()
+                for fd in self.wakeup or ():
+                    os.close(fd)
+                self.wakeup = None
+            self.worker = None
+
+    def wake(self):
+        if self.wakeup is not None:
+            try:
+                os.write(self.wakeup[1], b'\0')
+            except OSError:
+                # Full, the thread has plenty to wake up for
+                pass
+
+    def io_loop(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                break
+            future, function, args = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def run_async(self, function, *args):
+        future = Future()
+        if self.worker is None:
+            # No worker, run in the callers thread
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        else:
+            self.requests.put((future, function, args))
+            self.wake()
+        return future
+
+    def next_job(self):
+        """The next request, the events of the beacon are read meanwhile"""
+        while self.binary and self.arduino is not None:
+            try:
+                return self.requests.get_nowait()
+            except queue.Empty:
+                pass
+            waited = self.wait_for_input()
+            self.read_events(block = not waited)
+        return self.requests.get()
+
+    def wait_for_input(self):
+        """Sleep until the beacon sends or a request is queued, False if it cannot"""
+        try:
+            fd = self.arduino.fileno()
+        except (AttributeError, ValueError, OSError, serial.SerialException):
+            fd = None
+        if fd is None or self.wakeup is None:
+            return False
+        try:
+            ready = select.select([fd, self.wakeup[0]], [], [], EVENT_WAIT)[0]
+        except (OSError, ValueError):
+            return False
+        if self.wakeup[0] in ready:
+            os.read(self.wakeup[0], 1024)
+        return True
+
+    def read_events(self, block = False):
+        """
+        Read what the beacon has sent unasked and dispatch its events.
+        With block, wait up to READ_TIMEOUT for the first byte.
+        """
+        try:
+            waiting = self.arduino.in_waiting
+            if waiting == 0 and not block:
+                return
+            data = self.arduino.read(waiting or 1)
+        except (serial.SerialException, OSError, AttributeError):
+            self.link_lost()
+            return
+        if data:
+            self.metrics.inc('bytes_received_total', n = len(data))
+            if self.trace is not None:
+                self.trace.received(data)
+            self.framer.feed(data)
+            self.take_events()
+
+    def take_events(self):
+        """Dispatch the events in the framer, other frames are late replies and dropped"""
+        frame = self.framer.next_frame()
+        while frame is not None:
+            if wspr_proto.is_event(frame):
+                self.dispatch(frame)
+            frame = self.framer.next_frame()
 
+    #=========================================================================#
+    # Events
+    # After BM1 the beacon sends an event frame when its state, interval or
+    # band changes, when QC is written and when its clock is set. The state
+    # mirror is kept up to date from them, and the subscribers are called on
+    # the I/O thread, so they must not block.
+    #=========================================================================#
+    def subscribe(self, callback):
+        """Call callback(event) with every wspr_proto.beaconEvent"""
+        self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s is not callback]
+
+    def dispatch(self, frame):
+        event = wspr_proto.decode_event(frame)
+        if event is None:
+            self.metrics.inc('errors_total', wspr_proto.BAD_REPLY)
+            return
+        self.metrics.inc('events_total', event.event)
+        if event.event == 'state':
+            interval, band = event.interval, event.band
+            if event.state == 'DI' and self.state.configured is False:
+                interval = band = None
+            self.state.status = wspr_proto.statusReply(event.state, interval, band)
+            if self.journal is not None:
+                self.journal.status(self.metrics.device, event.state, interval, band)
+        elif event.event == 'config':
+            # Read back what was written, band and interval were reset as well
+            self.state.config = None
+            self.state.configured = None
+            self.state.status = None
+        for callback in self.subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print("Event subscriber failed: " + str(e))
+
+    def submit(self, cat_cmd, parameters = []):
+        return self.run_async(self.transact, cat_cmd, parameters)
+
+    def submit_batch(self, commands):
+        return self.run_async(self.transact_batch, commands)
+
+    def connect_async(self):
+        return self.run_async(self.connect)
+
+    def ensure_link_async(self):
+        return self.run_async(self.ensure_link)
+
+    #=========================================================================#
+    # Connection manager
+    #=========================================================================#
     def connect(self):
+        self.disconnect()
         try:
             port = self.config_data.get()
             print("configured port = ", end=' ') 
             print(port)
-            self.arduino = serial.Serial(port, baudrate = SPEED, timeout=1, writeTimeout=3)
-            return(True)
-        except:
+            self.speed = remembered_speed(self.speed_file, port)
+            self.answered = False
+            self.negotiated = False
+            self.binary = False
+            self.arduino = self.open_port(port)
+        except (serial.SerialException, OSError, ValueError) as e:
+            print(e)
+            self.link_lost()
             return(False)
-    def cat_to_dict(self, answer):
-        #print (answer)
+        if self.trace is not None:
+            self.trace.opened(port)
+        if os.name == 'posix':
+            try:
+                # Stop resetting the arduino on the next serial connect
+                disable_hupcl(self.arduino.fileno())
+            except (termios.error, AttributeError):
+                pass
+        self.link_state = LINK_UP
+        self.metrics.device = port
+        # Exported again after a close()
+        wspr_metrics.register(self.metrics)
+        self.metrics.inc('connects_total')
+        self.metrics.set('link_up', 1)
+        self.retry_delay = RETRY_MIN
+        self.no_reply = 0
+        # Could be another beacon now
+        self.state.invalidate()
+        return(True)
+
+    def open_port(self, port):
+        # A URL like socket://127.0.0.1:7373 reaches the beacon through wspr_server
+        return serial.serial_for_url(port, baudrate = self.speed, timeout=READ_TIMEOUT, writeTimeout=3)
+
+    def disconnect(self):
+        if self.arduino is not None:
+            if self.trace is not None:
+                self.trace.closed()
+            try:
+                self.arduino.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.arduino = None
+
+    def link_lost(self):
+        """Close the port and try again after an exponential backoff"""
+        if self.arduino is not None and not self.answered and '://' not in self.metrics.device:
+            # Silent from the start, the beacon may be at another speed:
+            # at SPEED after a power cycle, or at a speed we have forgotten
+            speed = SPEED if self.speed != SPEED else LINE_SPEEDS[0]
+            remember_speed(self.speed_file, self.metrics.device, speed)
+        self.disconnect()
+        if self.link_state == LINK_UP:
+            self.metrics.inc('link_lost_total')
+        self.metrics.set('link_up', 0)
+        self.link_state = LINK_BACKOFF
+        self.retry_at = time.monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, RETRY_MAX)
+
+    def ensure_link(self):
+        """
+        Called on every poll. Reopens the port when it is worth trying: the
+        device is present and either the backoff has expired or a device
+        has just been plugged in. Returns True when the link is up.
+        """
+        if self.link_state == LINK_UP:
+            return True
+        port = self.config_data.get()
+        plugged = self.hotplug.changed()
+        if os.name == 'posix' and '://' not in port and not os.path.exists(port):
+            self.link_state = LINK_DOWN
+            return False
+        if self.link_state == LINK_DOWN or plugged:
+            # The device has (re)appeared, no reason to wait
+            self.retry_delay = RETRY_MIN
+        elif time.monotonic() < self.retry_at:
+            return False
+        return self.connect()
+
+    def check_reply(self, frame):
+        if frame is None:
+            self.no_reply = self.no_reply + 1
+            if self.no_reply >= MAX_NO_REPLY:
+                print("No reply from beacon")
+                self.link_lost()
+        else:
+            self.no_reply = 0
+            self.answered = True
+
+    def negotiate_speed(self, speeds = LINE_SPEEDS):
+        """
+        Move the link to the fastest of speeds that works, once per
+        connection and after the beacon has answered. The beacon is asked
+        to change with QB<speed>, then both ends change and QB at the new
+        speed confirms it. An unconfirmed speed is dropped by the firmware
+        after 2 seconds, then the next one is tried. The speed that works
+        is remembered for the device and used by the next connect().
+        Returns the speed in use.
+        """
+        self.negotiated = True
+        if self.arduino is None or '://' in self.metrics.device or self.speed != SPEED:
+            # Through wspr_server the line is not ours, or already negotiated
+            return self.speed
+        for speed in speeds:
+            reply = self.query("QB", [speed])
+            if wspr_proto.is_error(reply) and reply.reason == wspr_proto.UNKNOWN_COMMAND:
+                # Firmware without QB
+                break
+            if not wspr_proto.is_error(reply):
+                try:
+                    self.arduino.baudrate = speed
+                    reply = self.query("QB")
+                except (serial.SerialException, ValueError):
+                    reply = None
+                if isinstance(reply, wspr_proto.speedReply) and reply.speed == speed:
+                    print("Line speed %d" % speed)
+                    self.speed = speed
+                    remember_speed(self.speed_file, self.metrics.device, speed)
+                    return speed
+                if self.arduino is None:
+                    break
+                self.arduino.baudrate = SPEED
+            elif reply.reason != wspr_proto.TIMEOUT:
+                continue
+            time.sleep(SPEED_CONFIRM_TIME)
+        return self.speed
+
+    def negotiate_speed_async(self):
+        return self.run_async(self.negotiate_speed)
+
+    def enable_binary(self):
+        """
+        Ask the beacon for binary frames with BM1. Then one FS reads the
+        status, configuration and hardware that otherwise take WS ST, QC
+        and QH, with a CRC. Old firmware does not know BM. Returns True
+        when binary frames are on.
+        """
+        self.binary = False
+        if self.arduino is not None and not wspr_proto.is_error(self.query("BM", [1])):
+            self.binary = True
+        return self.binary
+
+    def status_commands(self):
+        """The commands of a status poll"""
+        if self.binary:
+            return [("FS", [])]
+        return [("WS", ['ST'])]
 
-        return answer.strip('\r\n').split(',')
-    
+    def cat_to_dict(self, answer):
+        return cat_to_dict(answer)
 
-        
     def compose_cat_command(self, cmd, parameters):
-        for parameter in parameters:
-            cmd = cmd + str(parameter) + ','
-#       print cmd
-        return cmd.rstrip(',') +';'
-            
-            
-        
+        return compose_cat_command(cmd, parameters)
+
+    #=========================================================================#
+    # Requests
+    # send_cat_cmd() and send_cat_batch() return the reply split on commas,
+    # query() and query_batch() return typed replies from wspr_proto.
+    #=========================================================================#
     def send_cat_cmd(self, cat_cmd, parameters = []):
+        if self.worker is not None and threading.current_thread() is not self.worker:
+            return self.submit(cat_cmd, parameters).result()
+        return self.transact(cat_cmd, parameters)
+
+    def transact(self, cat_cmd, parameters = []):
+        return self.transact_batch([(cat_cmd, parameters)])[0]
+
+    def send_cat_batch(self, commands):
+        """
+        Send several CAT commands in one write.
+        commands is a list of (cat_cmd, parameters) tuples. The firmware
+        answers the commands in order, one frame each, so the replies are
+        returned as a list in the same order as the commands.
+        """
+        if self.worker is not None and threading.current_thread() is not self.worker:
+            return self.submit_batch(commands).result()
+        return self.transact_batch(commands)
+
+    def transact_batch(self, commands):
+        replies = []
+        frames = self.exchange(commands)
+        self.decode(commands, frames)
+        for frame in frames:
+            if frame is None:
+                replies.append(self.cat_to_dict('ER'))
+            else:
+                replies.append(self.cat_to_dict(frame.decode('ascii', 'replace')))
+        return replies
+
+    def query(self, cat_cmd, parameters = []):
+        return self.query_batch([(cat_cmd, parameters)])[0]
+
+    def query_batch(self, commands):
+        if self.worker is not None and threading.current_thread() is not self.worker:
+            return self.submit_query(commands).result()
+        return self.decode(commands, self.exchange(commands))
+
+    def decode(self, commands, frames):
+        """Typed replies, which also keep the state mirror up to date"""
+        replies = []
+        for (cat_cmd, parameters), frame in zip(commands, frames):
+            reply = wspr_proto.decode_reply(cat_cmd, parameters, frame)
+            if wspr_proto.is_error(reply):
+                self.metrics.inc('errors_total', reply.reason)
+                if cat_cmd == 'FS' and reply.reason == wspr_proto.UNKNOWN_COMMAND:
+                    # The beacon has been reset, set up the link again
+                    self.binary = False
+                    self.negotiated = False
+            self.state.update(cat_cmd, parameters, reply)
+            if self.journal is not None:
+                self.journal.observe(self.metrics.device, cat_cmd, parameters, reply)
+            replies.append(reply)
+        return replies
+
+    def load_state(self):
+        """Read what the state mirror does not know yet, in one batch"""
+        commands = self.state.missing()
+        if commands:
+            self.query_batch(commands)
+        return self.state
+
+    def submit_query(self, commands):
+        return self.run_async(self.query_batch, commands)
+
+    def exchange(self, commands):
+        """
+        Write the commands and collect one reply frame for each of them.
+        A frame is None when the beacon did not answer in time.
+        """
+        frames = []
+        if self.arduino is None:
+            return [None] * len(commands)
         try:
-            cat = self.compose_cat_command(cat_cmd, parameters)
-            self.arduino.write(str.encode(cat))
-            answer = self.arduino.readline()
-            #print(answer)
-
-            answer = answer.decode('utf-8')
-        except:
-            answer = 'ER'
-        return self.cat_to_dict(answer)
-        
+            cat = ''
+            for cat_cmd, parameters in commands:
+                cat = cat + self.compose_cat_command(cat_cmd, parameters)
+            # Late replies to earlier commands must not be taken for ours
+            if self.trace is not None or self.binary:
+                # Keep them in the trace, they are what goes wrong on a real link,
+                # and events can be among them
+                stale = self.arduino.read(self.arduino.in_waiting)
+                if stale:
+                    if self.trace is not None:
+                        self.trace.received(stale)
+                    if self.binary:
+                        self.framer.feed(stale)
+                        self.take_events()
+            self.arduino.reset_input_buffer()
+            # Keep an event frame that is still coming in
+            self.framer.clear(keep_frame = self.binary)
+            data = str.encode(cat)
+            self.arduino.write(data)
+            if self.trace is not None:
+                self.trace.sent(data)
+            metrics = self.metrics
+            metrics.inc('bytes_sent_total', n = len(data))
+            # The latency of a command is counted from the reply before it,
+            # the beacon handles the commands of a batch one at a time
+            start = time.perf_counter()
+            for cat_cmd, parameters in commands:
+                frame = self.read_frame()
+                done = time.perf_counter()
+                metrics.inc('commands_total', cat_cmd)
+                if frame is not None:
+                    metrics.observe('command_latency_seconds', cat_cmd, done - start)
+                start = done
+                self.check_reply(frame)
+                frames.append(frame)
+                if frame is None:
+                    break
+        except (serial.SerialException, OSError, AttributeError):
+            self.link_lost()
+        while len(frames) < len(commands):
+            frames.append(None)
+        return frames
+
+    def read_frame(self):
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            frame = self.framer.next_frame()
+            if frame is not None and wspr_proto.is_event(frame):
+                self.dispatch(frame)
+                continue
+            if frame is not None:
+                return frame
+            if time.monotonic() >= deadline:
+                return None
+            data = self.arduino.read(self.arduino.in_waiting or 1)
+            if data:
+                self.metrics.inc('bytes_received_total', n = len(data))
+                if self.trace is not None:
+                    self.trace.received(data)
+                self.framer.feed(data)
+
     def close(self):
-        self.arduino.close()
+        self.stop_worker()
+        self.disconnect()
+        self.link_state = LINK_DOWN
+        self.metrics.set('link_up', 0)
+        wspr_metrics.unregister(self.metrics)
 
 
 
@@ -90,7 +755,14 @@ class beacon:
 
 if __name__ == '__main__':
 
-    wsprdev = beacon(conf['ddsdev'])
+    if len(sys.argv) > 1:
+        device = sys.argv[1]
+    else:
+        device = conf['ddsdev']
+    wsprdev = beacon(fixedPort(device))
+    if not wsprdev.connect():
+        print("Cannot open " + device)
+        sys.exit(1)
     run =True                         
     while(run):
         action = input(">")
@@ -103,10 +775,10 @@ if __name__ == '__main__':
             print(R)
 
         if action == "stop":
-            wsprdev.send_cat_cmd('WS', {'action':'CA'}, ['action'])
+            print(wsprdev.send_cat_cmd('WS', ['CA']))
 
         if action == "time":
-            wsprdev.send_cat_cmd('QT', {}, [])
+            print(wsprdev.send_cat_cmd('QT'))
             
         if action == "exit":
             cat = wsprdev.compose_cat_command('WS', ['TX', '4', '20'])
@@ -117,6 +789,3 @@ if __name__ == '__main__':
     #print time.asctime( time.localtime(time_t) )
 
     wsprdev.close()
-
-
-
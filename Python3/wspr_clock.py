@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Clock synchronisation between the host and the WSPR beacon.
+
+QT only returns whole seconds, so one query says little. The sync engine
+makes several timestamped QT exchanges, spread over more than a second.
+Every exchange bounds the clock offset: the beacon read its clock after
+the command had arrived and before the reply was sent. The exchanges
+that straddle a second rollover give the tight bounds, like in NTP where
+the round trip bounds the offset.
+
+The time is set so that the command is complete at the beacon exactly on
+a whole host second. Writing the seconds register of the DS3231 restarts
+its one second countdown, so the beacon second starts in step with the
+host. Note that with HW_CLOCK the firmware only writes the RTC. now()
+picks the new time up at the next TimeLib sync, up to 300 s later, so
+measurements are ignored for that long after a set. Meanwhile the
+offset is taken to be the one that was set.
+
+The measured offsets are fitted to a linear drift model. The model says
+how long the beacon stays within MAX_OFFSET, so the clock is only
+queried as often as it is needed.
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import sys
+import time
+from wspr_cat import SPEED, compose_cat_command
+from wspr_proto import is_error
+
+SAMPLES = 8             # QT exchanges per measurement
+SAMPLE_SPACING = 0.157  # Seconds, not a divisor of 1 s so the phase is swept
+MAX_OFFSET = 0.5        # Seconds the beacon clock may be off
+SETTLE_TIME = 310.0     # Seconds until now() in the firmware has read the RTC
+MIN_CHECK = 60.0        # Seconds between measurements, limits
+MAX_CHECK = 3600.0
+MODEL_POINTS = 20       # Measurements kept for the drift model
+QT_REPLY_LENGTH = 12    # 10 digits and CR LF
+
+def wire_time(length, baudrate = SPEED):
+    """Seconds to send length bytes, 8N1"""
+    return length * 10.0 / baudrate
+
+class driftModel:
+    """Offset of the beacon clock as a straight line in host time"""
+    def __init__(self):
+        self.points = []
+
+    def clear(self):
+        self.points = []
+
+    def add(self, t, offset, uncertainty):
+        self.points.append((t, offset, max(uncertainty, 0.001)))
+        self.points = self.points[-MODEL_POINTS:]
+
+    def fit(self):
+        """Weighted least squares. Returns (t0, offset at t0, drift in s/s)."""
+        if not self.points:
+            return None
+        t0 = self.points[-1][0]
+        sw = swx = swy = swxx = swxy = 0.0
+        for t, offset, uncertainty in self.points:
+            w = 1.0 / (uncertainty * uncertainty)
+            x = t - t0
+            sw = sw + w
+            swx = swx + w * x
+            swy = swy + w * offset
+            swxx = swxx + w * x * x
+            swxy = swxy + w * x * offset
+        det = sw * swxx - swx * swx
+        if len(self.points) < 2 or det <= 0:
+            return (t0, swy / sw, 0.0)
+        drift = (sw * swxy - swx * swy) / det
+        offset = (swy - drift * swx) / sw
+        return (t0, offset, drift)
+
+    def predict(self, t):
+        model = self.fit()
+        if model is None:
+            return None
+        t0, offset, drift = model
+        return offset + drift * (t - t0)
+
+    def time_to_limit(self, t, limit):
+        """Seconds from t until the predicted offset reaches +-limit"""
+        model = self.fit()
+        if model is None:
+            return 0.0
+        t0, offset, drift = model
+        now = offset + drift * (t - t0)
+        if abs(now) >= limit:
+            return 0.0
+        if drift == 0:
+            return float('inf')
+        if drift > 0:
+            return (limit - now) / drift
+        return (-limit - now) / drift
+
+class clockSync:
+    """
+    Keeps the beacon clock in step with the host clock.
+    wsprdev is a beacon. Call sync() when due() says so, from the thread
+    that does the serial I/O. The wire times are those of the line speed
+    in use unless a baudrate is given.
+    """
+    def __init__(self, wsprdev, baudrate = None):
+        self.wsprdev = wsprdev
+        self.baudrate = baudrate
+        self.model = driftModel()
+        self.clock = time.time
+        self.sleep = time.sleep
+        self.settled_at = 0.0
+        self.next_check = 0.0
+        self.offset = None
+        self.uncertainty = None
+        self.rtt = 0.0
+
+    def line_speed(self):
+        return self.baudrate or getattr(self.wsprdev, 'speed', SPEED)
+
+    def exchange(self):
+        """One QT exchange, returns (send time, beacon time, receive time)"""
+        t0 = self.clock()
+        reply = self.wsprdev.query("QT")
+        t3 = self.clock()
+        if is_error(reply):
+            return None
+        return (t0, reply.time, t3)
+
+    def measure(self, samples = SAMPLES):
+        """
+        Estimate the offset (beacon - host) and its uncertainty in seconds.
+        Returns None if the beacon does not answer.
+        """
+        lo = -float('inf')
+        hi = float('inf')
+        rtts = []
+        baudrate = self.line_speed()
+        to_beacon = wire_time(3, baudrate)
+        from_beacon = wire_time(QT_REPLY_LENGTH, baudrate)
+        for i in range(samples):
+            sample = self.exchange()
+            if sample is not None:
+                t0, atime, t3 = sample
+                rtts.append(t3 - t0)
+                # The clock was read between these two host times
+                first = t0 + to_beacon
+                last = max(first, t3 - from_beacon)
+                lo = max(lo, atime - last)
+                hi = min(hi, atime + 1 - first)
+            if i < samples - 1:
+                self.sleep(SAMPLE_SPACING)
+        if not rtts:
+            return None
+        if lo > hi:
+            # The beacon clock was changed during the measurement
+            return None
+        self.offset = (lo + hi) / 2
+        self.uncertainty = (hi - lo) / 2
+        self.rtt = min(rtts)
+        return (self.offset, self.uncertainty)
+
+    def extra_delay(self):
+        """Round trip time of QT beyond the wire time, USB latency and the firmware"""
+        baudrate = self.line_speed()
+        return max(0.0, self.rtt - wire_time(3, baudrate) - wire_time(QT_REPLY_LENGTH, baudrate))
+
+    def one_way_delay(self, length):
+        """Seconds from writing a command of length bytes until the beacon has it"""
+        return wire_time(length, self.line_speed()) + self.extra_delay() / 2
+
+    def set_time(self):
+        """Set the beacon clock so that its second starts with the host second"""
+        target = int(self.clock()) + 2
+        cmd = compose_cat_command("QT", [target])
+        write_at = target - self.one_way_delay(len(cmd))
+        delay = write_at - self.clock()
+        if delay > 0.02:
+            self.sleep(delay - 0.02)
+        while self.clock() < write_at:
+            pass
+        reply = self.wsprdev.send_cat_cmd("QT", [target])
+        print("Syncronising time " + str(reply))
+        journal = getattr(self.wsprdev, 'journal', None)
+        if journal is not None:
+            journal.sync(self.wsprdev.metrics.device, self.offset or 0.0, "set " + str(reply))
+        self.model.clear()
+        self.settled_at = self.clock() + SETTLE_TIME
+        if reply[0] == 'Success':
+            # Right to within how the extra delay splits between the two
+            # directions, until the next measurement says otherwise
+            self.offset = 0.0
+            self.uncertainty = self.extra_delay() / 2
+            metrics = getattr(self.wsprdev, 'metrics', None)
+            if metrics is not None:
+                metrics.set('clock_offset_seconds', self.offset)
+                metrics.set('clock_uncertainty_seconds', self.uncertainty)
+        return reply
+
+    def sync(self):
+        """Measure, set the time if needed and plan the next check. Returns the offset."""
+        now = self.clock()
+        if self.measure() is None:
+            self.next_check = now + MIN_CHECK
+            return None
+        print("Beacon clock offset %.3f +- %.3f s" % (self.offset, self.uncertainty))
+        metrics = getattr(self.wsprdev, 'metrics', None)
+        if metrics is not None:
+            metrics.set('clock_offset_seconds', self.offset)
+            metrics.set('clock_uncertainty_seconds', self.uncertainty)
+        journal = getattr(self.wsprdev, 'journal', None)
+        if journal is not None:
+            journal.sync(self.wsprdev.metrics.device, self.offset)
+        if now >= self.settled_at:
+            self.model.add(now, self.offset, self.uncertainty)
+        if abs(self.offset) - self.uncertainty > MAX_OFFSET and now >= self.settled_at:
+            self.set_time()
+            self.next_check = self.settled_at
+        else:
+            self.plan(now)
+        return self.offset
+
+    def resync(self):
+        """Set the time now, without waiting for the offset to grow"""
+        if self.measure() is None:
+            return None
+        reply = self.set_time()
+        self.next_check = self.settled_at
+        return reply
+
+    def plan(self, now):
+        if now < self.settled_at:
+            self.next_check = self.settled_at
+            return
+        margin = MAX_OFFSET
+        if self.uncertainty is not None:
+            margin = max(MAX_OFFSET - self.uncertainty, 0.0)
+        wait = self.model.time_to_limit(now, margin)
+        if len(self.model.points) < 3:
+            # Not enough points for a drift estimate yet
+            wait = min(wait, MIN_CHECK * 2 ** len(self.model.points))
+        self.next_check = now + min(max(wait, MIN_CHECK), MAX_CHECK)
+
+    def due(self):
+        return self.clock() >= self.next_check
+
+    def device_time(self, t = None):
+        """Beacon time as predicted by the model, or the last measurement"""
+        if t is None:
+            t = self.clock()
+        offset = self.model.predict(t)
+        if offset is None:
+            offset = self.offset or 0.0
+        return t + offset
+
+if __name__ == '__main__':
+    from wspr_cat import beacon, fixedPort
+    if len(sys.argv) < 2:
+        print("Usage: wspr_clock.py DEVICE")
+        sys.exit(1)
+    wsprdev = beacon(fixedPort(sys.argv[1]))
+    if not wsprdev.connect():
+        sys.exit(1)
+    clock = clockSync(wsprdev)
+    clock.sync()
+    wsprdev.close()
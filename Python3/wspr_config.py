@@ -25,10 +25,42 @@ Author: Ulf Nordström SM0FXK
 from tkinter import *
 #from wspr_cat import beacon
 import shelve
-import serial.tools.list_ports
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wspr_cat import HW_NAMES, LINK_UP
+from wspr_proto import is_error
+
+POLL_FUTURE_MS = 20
+LOOKUP_MIN = 2.0        # Seconds between looks for a known beacon, doubled while none is found
+LOOKUP_MAX = 60.0
+
+def when_done(widget, future, callback, *args, failed = None):
+    """
+    Hand the result of a beacon request back to the Tk thread.
+    The future is checked from the Tk event loop, so callback always runs
+    in the Tk thread. When the request raised, the error is printed and
+    failed(*args) is called instead, so a caller waiting for the reply,
+    e.g. the status poll, can carry on.
+    """
+    if not widget.winfo_exists():
+        return
+    if future.done():
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Beacon request failed: " + str(e))
+            if failed is not None:
+                failed(*args)
+            return
+        callback(result, *args)
+    else:
+        widget.after(POLL_FUTURE_MS, when_done, widget, future, callback, *args, failed = failed)
 
 class WsprConfig:
+    open_windows = 0        # The main window does not poll while a config window is open
+
     def __init__(self, wsprdev):
         self.wsprdev=wsprdev
         
@@ -54,7 +86,22 @@ class WsprConfig:
         pow_ = self.dBm[self.transmit_power.get()]
         print(pow_)
         xtal_offset = self.offsetEntry.get()
-        self.wsprdev.send_cat_cmd("QC", [call_.upper(), loc_[0:4], pow_, xtal_offset])
+        try:
+            # Loaded when needed, numpy takes a while to import
+            import wspr_encode
+            import wspr_tuning
+        except ImportError:
+            wspr_encode = None      # No numpy, the configuration is not checked
+        if wspr_encode is not None:
+            for problem in wspr_encode.validate(call_.upper(), loc_[0:4], pow_):
+                print("Warning: " + problem)
+            if self.wsprdev.state.hw is not None:
+                # Frequencies the calibration offset gives on every band
+                for problem in wspr_tuning.check(self.wsprdev.state.hw, wspr_encode.atoi(xtal_offset)):
+                    print("Warning: " + problem)
+        # The state mirror of the beacon takes the new configuration
+        replies = self.wsprdev.submit_query([("QC", [call_.upper(), loc_[0:4], pow_, xtal_offset])])
+        when_done(self.root, replies, print)
         
     def config(self, wsprdev):
         power_levels = ("0.001",
@@ -121,6 +168,8 @@ class WsprConfig:
         self.transmit_power = StringVar()
         self.root = Toplevel()
         self.root.title("WSPR conf")
+        WsprConfig.open_windows += 1
+        self.root.bind('<Destroy>', self.closed)
 
 #       headLabel = Label(root,text = "WSPR Configuration", font=("Helvetica", 20))
 #       headLabel.grid(row=0, column=0)
@@ -163,18 +212,12 @@ class WsprConfig:
         self.offsetEntry = Entry(self.root, width = 8)
         self.offsetEntry.grid(row=5, column=1)
 
-    
-        cfgData = wsprdev.send_cat_cmd("QC")
-        print(cfgData)
-        if len(cfgData) == 4:
-            [call_, locator, power, offset] = wsprdev.send_cat_cmd("QC")
-            self.callEntry.insert(0, call_)
-#            self.powerEntry.insert(0, power)
-            self.transmit_power.set(Watts[power]) ###### FIX FIX
-            self.locatorEntry.insert(0, locator)
-            self.offsetEntry.insert(0, offset)
-        else:
-            self.transmit_power.set("0")
+        self.Watts = Watts
+        self.transmit_power.set("0")
+        if wsprdev.state.config is not None:
+            self.show_config([wsprdev.state.config])
+        elif wsprdev.state.configured is None:
+            when_done(self.root, wsprdev.submit_query([("QC", [])]), self.show_config)
             
         matchButton = Button(self.root, text="Apply", command=self.buttonApply)
         matchButton.grid(row=6,column=0)
@@ -182,9 +225,40 @@ class WsprConfig:
         stopButton.grid(row=6,column=1)
         #self.root.mainloop()
 
+    def closed(self, event):
+        if event.widget is self.root:
+            WsprConfig.open_windows -= 1
+
+    def show_config(self, replies):
+        [cfgData] = replies
+        print(cfgData)
+        if not is_error(cfgData):
+            self.callEntry.insert(0, cfgData.call)
+#            self.powerEntry.insert(0, power)
+            self.transmit_power.set(self.Watts[str(cfgData.power)]) ###### FIX FIX
+            self.locatorEntry.insert(0, cfgData.locator)
+            self.offsetEntry.insert(0, cfgData.offset)
+
 class serialPort:
+    """
+    The serial port setting in the database. get() is called by the
+    beacon I/O thread and the rest by the Tk thread, so the database is
+    only used with lock held.
+    """
     def __init__(self):
-        self.db = self.open_db()
+        self.database = None
+        self.lock = threading.RLock()
+        self.known = None           # Last result of wspr_discover.lookup()
+        self.lookup_at = 0.0
+        self.lookup_wait = LOOKUP_MIN
+
+    @property
+    def db(self):
+        # Opened on first use, not while the main window is being built
+        with self.lock:
+            if self.database is None:
+                self.database = self.open_db()
+            return self.database
         
     def __del__(self):
         print("Destructor called")
@@ -207,26 +281,50 @@ class serialPort:
         return(dbd)
 
     def lookup_db(self, key):
-        try:
-            object = self.db[key]
-        except:
-            object = None
-        return object
+        with self.lock:
+            try:
+                object = self.db[key]
+            except:
+                object = None
+            return object
 
     def delete_db(self, key):
-        if key in self.db:
-            del(self.db[key])
+        with self.lock:
+            if key in self.db:
+                del(self.db[key])
 
     def get(self):
         port = self.lookup_db('serial_device')
         if port == None:
-            
+            # Not configured, try a beacon found by an earlier scan
+            known = self.lookup()
+            if known is not None:
+                return known[0]
             return ('')
         else:
             return port
-        
+
+    def lookup(self):
+        """
+        wspr_discover.lookup(), which lists the ports, at most every
+        lookup_wait seconds. The wait grows while no known beacon is
+        connected, get() is called on every poll.
+        """
+        now = time.monotonic()
+        if now >= self.lookup_at:
+            import wspr_discover
+            with self.lock:
+                self.known = wspr_discover.lookup(self.db)
+            if self.known is None:
+                self.lookup_wait = min(self.lookup_wait * 2, LOOKUP_MAX)
+            else:
+                self.lookup_wait = LOOKUP_MIN
+            self.lookup_at = now + self.lookup_wait
+        return self.known
+
     def set(self, dev_string):
-        self.db['serial_device'] = dev_string
+        with self.lock:
+            self.db['serial_device'] = dev_string
         
     def pop_up_window(self, rfhw):
         self.radio = rfhw
@@ -234,6 +332,7 @@ class serialPort:
         portWindow = Toplevel()
         #portWindow=Tk()
         portWindow.title("Serial port")
+        import serial.tools.list_ports
         ports = serial.tools.list_ports.comports()
         com_devices = []
         for port in ports:
@@ -248,15 +347,48 @@ class serialPort:
         #self.devEnt = Entry(portWindow)
         self.devEnt.grid(row=0, column=1, padx=100, pady=10)
         #self.devEnt.insert('0', self.get())
+        self.scanResult = StringVar()
+        scanLabel = Label(portWindow, textvariable = self.scanResult)
+        scanLabel.grid(row=1, column=0, columnspan=2)
         saveButton = Button(portWindow, text = "Apply", command = self.save)
         saveButton.grid(row=2,column=0)
         
+        scanButton = Button(portWindow, text = "Scan", command = lambda: self.scan(portWindow))
+        scanButton.grid(row=2,column=1)
+
         dismissButton = Button(portWindow, text = "Close", command = portWindow.destroy)
-        dismissButton.grid(row=2,column=1, sticky="E")  
+        dismissButton.grid(row=2,column=2, sticky="E")  
         portWindow.mainloop()
+
+    def scan(self, portWindow):
+        """Probe all ports for beacons in the background"""
+        self.scanResult.set("Scanning...")
+        # The port the beacon has open is not probed
+        exclude = []
+        if self.radio.link_state == LINK_UP:
+            exclude = [self.get()]
+        import wspr_discover
+        pool = ThreadPoolExecutor(max_workers = 1)
+        found = pool.submit(wspr_discover.scan, exclude)
+        pool.shutdown(wait = False)
+        when_done(portWindow, found, self.scanned)
+
+    def scanned(self, found):
+        import wspr_discover
+        with self.lock:
+            wspr_discover.remember(self.db, found)
+        # Look for the beacons found at the next get()
+        self.lookup_at = 0.0
+        self.lookup_wait = LOOKUP_MIN
+        if found:
+            device, hw, key = found[0]
+            self.serial_device.set(device)
+            self.scanResult.set(", ".join([device + ": " + HW_NAMES[hw] for device, hw, key in found]))
+        else:
+            self.scanResult.set("No beacon found")
         
     def save(self):
         print(self.serial_device.get())
         self.set(self.serial_device.get())
-        self.radio.connect()
+        self.radio.connect_async()
         
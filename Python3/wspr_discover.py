@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Finds the serial ports that have a WSPR beacon connected.
+
+All candidate ports are probed at the same time with QH;. A beacon can
+have been left at a speed negotiated with QB, so the probe tries the
+speed remembered for the port first and then the others wspr_cat uses,
+and remembers the one that answered. A port is
+opened with DTR low and without flow control, as the rising edge of DTR
+is what resets the Arduino. On Linux the tty driver can still raise DTR
+when a port is opened the first time, before HUPCL can be cleared.
+HUPCL is cleared on every probed port, so DTR stays as it is when the
+probe closes it and the next open does not reset the Arduino. The beacons found are
+remembered by USB VID/PID/serial number in the GUI database, so a later
+start finds its beacon without opening any port, even when the device
+name has changed.
+
+Usage:
+  wspr_discover.py           Scan all ports
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+import serial.tools.list_ports
+from wspr_cat import SPEED, LINE_SPEEDS, HW_NAMES, disable_hupcl
+from wspr_cat import speed_path, remembered_speed, remember_speed
+from wspr_proto import catFramer
+
+PROBE_TIMEOUT = 0.3     # Seconds to wait for a reply to QH
+BOOT_WAIT = 2.0         # Keep probing this long, the open may have reset the Arduino
+DB_KEY = 'beacons'      # Database entry with the discovered beacons
+
+def port_key(port):
+    """Identity of a USB serial adapter that survives replugging"""
+    if port.vid is None:
+        return None
+    return "%04X:%04X:%s" % (port.vid, port.pid, port.serial_number or '')
+
+def probe_speeds(device, speed_file):
+    """The line speeds to probe device at, the one that worked last first"""
+    first = remembered_speed(speed_file, device)
+    return [first] + [speed for speed in (SPEED,) + LINE_SPEEDS if speed != first]
+
+def read_hw(port):
+    """The QH reply among the frames received within PROBE_TIMEOUT, or None"""
+    framer = catFramer()
+    deadline = time.monotonic() + PROBE_TIMEOUT
+    while time.monotonic() < deadline:
+        frame = framer.next_frame()
+        if frame is None:
+            framer.feed(port.read(port.in_waiting or 1))
+        elif frame.decode('latin-1') in HW_NAMES:
+            return frame.decode('latin-1')
+    return None
+
+def probe(device, boot_wait = BOOT_WAIT, speed_file = None):
+    """
+    Ask the device for its hardware. Returns the QH reply, or None if it
+    is no beacon. The speed that answered is remembered in speed_file.
+    """
+    speeds = probe_speeds(device, speed_file)
+    port = serial.Serial()
+    port.port = device
+    port.baudrate = speeds[0]
+    port.timeout = PROBE_TIMEOUT
+    port.write_timeout = PROBE_TIMEOUT
+    # Set before open(), so pyserial does not raise DTR
+    port.dsrdtr = False
+    port.rtscts = False
+    port.dtr = False
+    try:
+        port.open()
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        if os.name == 'posix':
+            disable_hupcl(port.fileno())
+        deadline = time.monotonic() + boot_wait
+        tries = 0
+        while time.monotonic() < deadline:
+            speed = speeds[tries % len(speeds)]
+            tries = tries + 1
+            port.baudrate = speed
+            port.reset_input_buffer()
+            # The first ; ends the garbage a try at another speed has left
+            port.write(b';QH;')
+            hw = read_hw(port)
+            if hw is not None:
+                remember_speed(speed_file, device, speed)
+                return hw
+        return None
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    finally:
+        port.close()
+
+def scan(exclude = [], db = None, speed_file = None):
+    """
+    Probe all serial ports in parallel. Returns a list of
+    (device, hw, key) for the ports with a beacon. Ports in exclude are
+    not touched. When db is given, the beacons are remembered in it.
+    The line speeds are those of wspr_cat, in speed_path() by default.
+    """
+    ports = [port for port in serial.tools.list_ports.comports() if port.device not in exclude]
+    if not ports:
+        return []
+    speed_file = speed_file or speed_path()
+    with ThreadPoolExecutor(max_workers = len(ports)) as pool:
+        replies = list(pool.map(lambda device: probe(device, speed_file = speed_file),
+                                [port.device for port in ports]))
+    found = []
+    for port, hw in zip(ports, replies):
+        if hw is not None:
+            found.append((port.device, hw, port_key(port)))
+    if db is not None:
+        remember(db, found)
+    return found
+
+def remember(db, found):
+    beacons = db.get(DB_KEY, {})
+    for device, hw, key in found:
+        if key is not None:
+            beacons[key] = hw
+    db[DB_KEY] = beacons
+
+def lookup(db):
+    """
+    Find a known beacon without opening any port. Returns (device, hw)
+    of the first connected adapter that has carried a beacon, or None.
+    """
+    beacons = db.get(DB_KEY, {})
+    if not beacons:
+        return None
+    for port in serial.tools.list_ports.comports():
+        key = port_key(port)
+        if key in beacons:
+            return (port.device, beacons[key])
+    return None
+
+if __name__ == '__main__':
+    start = time.monotonic()
+    found = scan()
+    for device, hw, key in found:
+        print(device + "  " + HW_NAMES[hw] + "  " + str(key))
+    print("%d beacon(s) found in %.1f s" % (len(found), time.monotonic() - start))
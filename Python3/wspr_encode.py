@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+WSPR message encoder, giving the same symbols as JTEncode in the firmware.
+
+At the start of every slot the firmware calls
+jtencode.wspr_encode(call, loc, dbm, tx_buffer) with the configuration in
+EEPROM. This module does the same on the host, so a configuration can be
+checked before it is written with QC, and the 162 channel symbols of a
+slot are known without asking the beacon.
+
+The steps are those of JTEncode:
+  - message preparation: callsign padding, unknown characters to space,
+    an invalid locator becomes AA00, the power is rounded down to a
+    valid level,
+  - packing into 28 bits of callsign and 22 bits of locator and power,
+  - the K=32, r=1/2 convolutional code (polynomials 0xf2d05351 and
+    0xe4613c47) over the 50 bits and 31 zero tail bits,
+  - interleaving by bit reversed index,
+  - merging with the sync vector: symbol = sync + 2 * data bit.
+The code and the interleaver are linear, so they are folded into one
+81 x 162 generator matrix over GF(2) and a batch of messages is encoded
+with a single matrix product.
+
+Only type 1 messages are made, as the firmware sends: a plain callsign
+of at most six characters and a four character locator.
+
+Usage:
+  wspr_encode.py CALL LOCATOR DBM
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import sys
+from functools import lru_cache
+import numpy as np
+
+SYMBOL_COUNT = 162
+BIT_COUNT = 81          # 50 message bits and 31 zero bits to flush the encoder
+POLY = (0xf2d05351, 0xe4613c47)
+CACHE_SIZE = 1024
+
+SYNC = np.array([1,1,0,0,0,0,0,0,1,0,0,0,1,1,1,0,0,0,1,0,0,1,0,1,1,1,1,0,0,0,
+                 0,0,0,0,1,0,0,1,0,1,0,0,0,0,0,0,1,0,1,1,0,0,1,1,0,1,0,0,0,1,
+                 1,0,1,0,0,0,0,1,1,0,1,0,1,0,1,0,1,0,0,1,0,0,1,0,1,1,0,0,0,1,
+                 1,0,1,0,1,0,0,0,1,0,0,0,0,0,1,0,0,1,0,0,1,1,1,0,1,1,0,0,1,1,
+                 0,1,0,0,0,1,1,1,0,0,0,0,0,1,0,1,0,0,1,1,0,0,0,0,0,0,0,1,1,0,
+                 1,0,1,1,0,0,0,1,1,0,0,0], dtype=np.uint8)
+
+VALID_DBM = (-30, -27, -23, -20, -17, -13, -10, -7, -3,
+             0, 3, 7, 10, 13, 17, 20, 23, 27, 30, 33, 37, 40,
+             43, 47, 50, 53, 57, 60)
+
+def interleave_order():
+    """order[i] is the position the i:th coded bit is sent in"""
+    order = []
+    for j in range(256):
+        rev = int('{:08b}'.format(j)[::-1], 2)
+        if rev < SYMBOL_COUNT:
+            order.append(rev)
+    return np.array(order[:SYMBOL_COUNT])
+
+def generator_matrix():
+    """
+    Row k is the interleaved code word of a lone 1 in input bit k. Input
+    bit k enters the shift registers at step k and is seen by tap d of
+    both polynomials at step k + d.
+    """
+    coded = np.zeros((BIT_COUNT, SYMBOL_COUNT), dtype=np.uint8)
+    for k in range(BIT_COUNT):
+        for d in range(32):
+            step = k + d
+            if step >= BIT_COUNT:
+                break
+            coded[k, 2 * step] = (POLY[0] >> d) & 1
+            coded[k, 2 * step + 1] = (POLY[1] >> d) & 1
+    generator = np.zeros_like(coded)
+    generator[:, interleave_order()] = coded
+    return generator
+
+GENERATOR = generator_matrix()
+
+#=============================================================================#
+# Message preparation, as wspr_message_prep() in JTEncode
+#=============================================================================#
+def atoi(text):
+    """As atoi() in the firmware, which turns the power of QC into a number"""
+    text = str(text).strip()
+    digits = ''
+    for i, c in enumerate(text):
+        if c.isdigit() or (i == 0 and c in '+-'):
+            digits = digits + c
+        else:
+            break
+    try:
+        return int(digits)
+    except ValueError:
+        return 0
+
+def char_code(c):
+    if c.isdigit():
+        return ord(c) - ord('0')
+    if 'A' <= c <= 'Z':
+        return ord(c) - ord('A') + 10
+    return 36
+
+def prepare(call, locator, dbm):
+    """
+    The message as JTEncode sends it: (callsign of 6 characters, locator,
+    power). dbm is what the firmware reads from EEPROM into a uint8_t and
+    JTEncode takes as int8_t, so only its low byte counts.
+    """
+    call = (str(call) + '\0' * 6)[:6]
+    # Callsigns with a digit as 2nd character are aligned with a space
+    if call[1].isdigit() and call[2].isupper():
+        call = ' ' + call[:5]
+    call = ''.join(c if (c.isdigit() or 'A' <= c <= 'Z') else ' '
+                   for c in call.upper())
+    locator = str(locator)
+    if len(locator) not in (4, 6):
+        locator = 'AA00'
+    loc = locator[:2].upper()
+    if not all('A' <= c <= 'R' for c in loc) or not locator[2:4].isdigit():
+        locator = 'AA00'
+    else:
+        locator = loc + locator[2:4]
+    dbm = atoi(dbm) & 0xff
+    if dbm > 127:
+        dbm = dbm - 256
+    dbm = min(dbm, 60)
+    power = VALID_DBM[0]
+    for level in VALID_DBM:
+        if level <= dbm:
+            power = level
+    return call, locator, power
+
+def pack(call, locator, power):
+    """The 28 bit callsign and the 22 bit locator and power of a prepared message"""
+    n = char_code(call[0])
+    n = n * 36 + char_code(call[1])
+    n = n * 10 + char_code(call[2])
+    for c in call[3:6]:
+        n = n * 27 + char_code(c) - 10
+    m = (179 - 10 * (ord(locator[0]) - ord('A')) - int(locator[2])) * 180 + \
+        10 * (ord(locator[1]) - ord('A')) + int(locator[3])
+    m = m * 128 + power + 64
+    return n & 0xfffffff, m & 0x3fffff
+
+def validate(call, locator, dbm):
+    """
+    What JTEncode would change in the configuration, as a list of
+    messages. An empty list means it is sent as written.
+    """
+    problems = []
+    sent_call, sent_locator, power = prepare(call, locator, dbm)
+    if '/' in str(call):
+        problems.append("compound callsigns are not supported")
+    if len(str(call)) > 6:
+        problems.append("callsign longer than 6 characters")
+    if sent_call.strip() != str(call).upper():
+        problems.append("callsign is sent as '%s'" % sent_call)
+    elif not sent_call[2].isdigit():
+        problems.append("the 3rd character of the callsign must be a digit")
+    if sent_locator != str(locator)[:4].upper():
+        problems.append("locator is sent as " + sent_locator)
+    if power != atoi(dbm) or str(atoi(dbm)) != str(dbm).strip():
+        problems.append("power is sent as %d dBm" % power)
+    return problems
+
+#=============================================================================#
+# Encoding
+#=============================================================================#
+def message_bits(messages):
+    """(N, 81) array of the encoder input bits of N (call, locator, dbm)"""
+    words = np.array([pack(*prepare(*message)) for message in messages],
+                     dtype=np.int64).reshape(-1, 2)
+    n_bits = (words[:, :1] >> np.arange(27, -1, -1)) & 1
+    m_bits = (words[:, 1:] >> np.arange(21, -1, -1)) & 1
+    tail = np.zeros((len(words), BIT_COUNT - 50), dtype=np.int64)
+    return np.hstack((n_bits, m_bits, tail))
+
+def encode_batch(messages):
+    """(N, 162) uint8 array with the channel symbols 0..3 of the messages"""
+    bits = message_bits(messages)
+    data = (bits @ GENERATOR) & 1
+    return (SYNC + 2 * data).astype(np.uint8)
+
+@lru_cache(maxsize = CACHE_SIZE)
+def encode(call, locator, dbm):
+    """The 162 symbols of one message, as a read only array"""
+    symbols = encode_batch([(call, locator, dbm)])[0]
+    symbols.flags.writeable = False
+    return symbols
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(1)
+    call, locator, dbm = sys.argv[1], sys.argv[2], sys.argv[3]
+    for problem in validate(call, locator, dbm):
+        print("Warning: " + problem)
+    print(' '.join(str(s) for s in encode(call, locator, dbm)))
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Headless daemon for running several WSPR beacons from one host.
+
+Every beacon is driven by its own asyncio task, and all ports are read
+by the one event loop, so there is no thread per beacon. The protocol is
+that of wspr_cat.beacon, the one the graphical user interface uses, so
+the fleet gets the same framing, batches, typed replies, line speed
+negotiation, binary frames and events. A port that hangs only stalls its
+own beacon, the tasks await the replies. A beacon is only told to start
+or stop when it does not already do so.
+
+Usage:
+  wspr_fleet.py DEVICE[,INTERVAL,BAND] [DEVICE[,INTERVAL,BAND] ...]
+  wspr_fleet.py /dev/ttyACM0,4,20 /dev/ttyACM1,2,40 /dev/ttyUSB0,stop
+
+A device given with interval and band is started, a device given with
+'stop' is stopped and a bare device is only monitored. The time of every
+beacon is kept in sync with the host clock by wspr_clock. Set WSPR_METRICS_PORT or
+WSPR_METRICS_FILE to export the link metrics of all beacons, see
+wspr_metrics.
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import asyncio
+import serial
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wspr_cat import beacon, fixedPort, REPLY_TIMEOUT
+from wspr_clock import clockSync
+import wspr_poll
+import wspr_proto
+import wspr_metrics
+from wspr_journal import transmissionJournal
+
+RETRY_MIN = 1.0         # Seconds before polling again after a failed poll
+RETRY_MAX = 60.0
+BLOCKING_WORKERS = 4    # Beacons that can negotiate or sync the clock at the same time
+
+status_text = {'DI':'Disabled',
+               'WT':'Waiting for timeslot',
+               'OA':'On Air',
+               'ER':'No connection',
+               'TU':'Tuning'}
+
+class asyncBeacon:
+    """
+    A wspr_cat.beacon whose port is read by the asyncio event loop, so one
+    thread serves all beacons. The beacon does the framing, decoding, state
+    mirror, journal and metrics; commands are written from the event loop
+    and the coroutine awaits the reply frames. Speed negotiation and clock
+    sync wait for the beacon and need exact timing, they run the blocking
+    code of wspr_cat and wspr_clock on the shared thread pool of the loop,
+    and the port is left to them meanwhile.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.wsprdev = beacon(fixedPort(device))
+        self.clock = clockSync(self.wsprdev)
+        self.metrics = self.wsprdev.metrics
+        self.loop = None
+        self.fd = None          # Port read by the event loop
+        self.frames = []        # Reply frames not taken yet
+        self.arrived = None     # Future set when a frame or link loss comes
+
+    def log(self, text):
+        print(time.strftime("%Y-%m-%d %H:%M:%S") + " " + self.device + ": " + text)
+
+    def start(self, on_event):
+        """on_event(event) is called on the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.wsprdev.subscribe(lambda event: self.loop.call_soon_threadsafe(on_event, event))
+
+    def close(self):
+        self.unwatch()
+        self.wsprdev.close()
+
+    #=========================================================================#
+    # Port
+    #=========================================================================#
+    def watch(self):
+        """Read the open port from the event loop"""
+        if self.fd is None and self.wsprdev.arduino is not None:
+            try:
+                fd = self.wsprdev.arduino.fileno()
+            except (AttributeError, ValueError, OSError, serial.SerialException):
+                return
+            self.loop.add_reader(fd, self.readable)
+            self.fd = fd
+
+    def unwatch(self):
+        """Before the port can be closed or used by another thread"""
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        self.wake()
+
+    def wake(self):
+        if self.arrived is not None and not self.arrived.done():
+            self.arrived.set_result(None)
+
+    def readable(self):
+        wsprdev = self.wsprdev
+        try:
+            data = wsprdev.arduino.read(wsprdev.arduino.in_waiting or 1)
+        except (serial.SerialException, OSError, AttributeError):
+            self.unwatch()
+            wsprdev.link_lost()
+            return
+        if not data:
+            return
+        wsprdev.metrics.inc('bytes_received_total', n = len(data))
+        if wsprdev.trace is not None:
+            wsprdev.trace.received(data)
+        wsprdev.framer.feed(data)
+        frame = wsprdev.framer.next_frame()
+        while frame is not None:
+            if wspr_proto.is_event(frame):
+                wsprdev.dispatch(frame)
+            else:
+                self.frames.append(frame)
+            frame = wsprdev.framer.next_frame()
+        if self.frames:
+            self.wake()
+
+    async def blocking(self, function, *args):
+        """Run function on the thread pool, with the port to itself"""
+        self.unwatch()
+        try:
+            return await self.loop.run_in_executor(None, function, *args)
+        finally:
+            self.watch()
+
+    #=========================================================================#
+    # Commands
+    #=========================================================================#
+    async def query_batch(self, commands):
+        """Typed replies, as wspr_cat.beacon.query_batch()"""
+        return self.wsprdev.decode(commands, await self.exchange(commands))
+
+    async def exchange(self, commands):
+        """As wspr_cat.beacon.exchange(), awaiting the replies"""
+        wsprdev = self.wsprdev
+        if wsprdev.arduino is None or self.fd is None:
+            return [None] * len(commands)
+        cat = ''
+        for cat_cmd, parameters in commands:
+            cat = cat + wsprdev.compose_cat_command(cat_cmd, parameters)
+        data = str.encode(cat)
+        # Late replies to earlier commands must not be taken for ours
+        self.frames = []
+        wsprdev.framer.clear(keep_frame = wsprdev.binary)
+        try:
+            wsprdev.arduino.write(data)
+        except (serial.SerialException, OSError):
+            self.unwatch()
+            wsprdev.link_lost()
+            return [None] * len(commands)
+        if wsprdev.trace is not None:
+            wsprdev.trace.sent(data)
+        metrics = self.metrics
+        metrics.inc('bytes_sent_total', n = len(data))
+        frames = []
+        start = time.perf_counter()
+        for cat_cmd, parameters in commands:
+            frame = await self.next_reply()
+            done = time.perf_counter()
+            metrics.inc('commands_total', cat_cmd)
+            if frame is not None:
+                metrics.observe('command_latency_seconds', cat_cmd, done - start)
+            start = done
+            wsprdev.check_reply(frame)
+            frames.append(frame)
+            if frame is None:
+                break
+        if wsprdev.arduino is None:
+            self.unwatch()
+        while len(frames) < len(commands):
+            frames.append(None)
+        return frames
+
+    async def next_reply(self):
+        """The next reply frame, None when none comes in time"""
+        deadline = self.loop.time() + REPLY_TIMEOUT
+        while not self.frames:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0 or self.fd is None:
+                return None
+            self.arrived = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.arrived, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self.arrived = None
+        return self.frames.pop(0)
+
+    async def poll(self, action = None):
+        """
+        Open the link when it is down, read the status and keep the clock
+        in sync. After a new connection the line speed is negotiated and
+        binary frames are switched on, and action, a WS command, is sent
+        unless the beacon already does what it asks. Returns the status,
+        None without a reply.
+        """
+        wsprdev = self.wsprdev
+        # Can close and reopen the port
+        self.unwatch()
+        if not wsprdev.ensure_link():
+            return None
+        self.watch()
+        reply = (await self.query_batch(wsprdev.status_commands()))[0]
+        if wspr_proto.is_error(reply):
+            return None
+        if not wsprdev.negotiated:
+            self.log("connected")
+            await self.blocking(self.set_up)
+            if action is not None and not self.doing(action):
+                reply = (await self.query_batch([('WS', action[1])]))[0]
+                self.log(action[0] + ": " + str(reply))
+        if self.clock.due():
+            await self.blocking(self.clock.sync)
+        return wsprdev.state.status
+
+    def set_up(self):
+        """On the thread pool, after a new connection"""
+        self.wsprdev.negotiate_speed()
+        self.wsprdev.enable_binary()
+        # The clock may have been set by someone else meanwhile
+        self.clock.next_check = 0
+
+    def doing(self, action):
+        """True when the last status read is what action asks for"""
+        status = self.wsprdev.state.status
+        if status is None:
+            return False
+        if action[1][0] == 'CA':
+            return status.state == 'DI'
+        return (status.state in ('WT', 'OA') and
+                [status.interval, status.band] == action[1][1:])
+
+class fleetMember:
+    """One beacon of the fleet and what the daemon should do with it"""
+    def __init__(self, spec, journal = None):
+        fields = spec.split(',')
+        self.wsprdev = asyncBeacon(fields[0])
+        self.action = None
+        if len(fields) == 2 and fields[1] == 'stop':
+            self.action = ('stop', ['CA'])
+        elif len(fields) == 3:
+            self.action = ('start', ['TX', int(fields[1]), int(fields[2])])
+        elif len(fields) != 1:
+            raise ValueError("bad beacon specification: " + spec)
+        self.state = None
+        # The beacon journals its replies, events and clock syncs
+        self.wsprdev.wsprdev.journal = journal
+
+    async def run(self):
+        wsprdev = self.wsprdev
+        wsprdev.start(self.event)
+        retry = RETRY_MIN
+        while True:
+            try:
+                delay = self.show(await wsprdev.poll(self.action))
+                retry = RETRY_MIN
+            except Exception as e:
+                # E.g. a reply the decoder did not expect, the task carries on
+                wsprdev.log("poll failed: " + str(e))
+                delay = retry
+                retry = min(retry * 2, RETRY_MAX)
+            await asyncio.sleep(delay)
+
+    def show(self, status):
+        """Show the status of a poll, returns the delay to the next poll"""
+        if status is None:
+            self.show_state('ER')
+            return wspr_poll.next_poll(None, 0, time.time())
+        self.show_state(status.state, status)
+        return wspr_poll.next_poll(status.state, status.interval or 0,
+                                   self.wsprdev.clock.device_time(), self.wsprdev.wsprdev.binary)
+
+    def event(self, event):
+        """A state change the beacon has reported by itself"""
+        if event.event == 'state':
+            self.show_state(event.state, event)
+
+    def show_state(self, state, status = None):
+        if state != self.state:
+            self.state = state
+            text = status_text[state]
+            if status is not None and status.interval is not None:
+                text = text + ", interval %s, band %s" % (status.interval, status.band)
+            self.wsprdev.log(text)
+
+async def run_fleet(specs):
+    journal = transmissionJournal()
+    fleet = [fleetMember(spec, journal) for spec in specs]
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(BLOCKING_WORKERS))
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set_result, None)
+    wspr_metrics.export_from_env()
+    tasks = [asyncio.ensure_future(member.run()) for member in fleet]
+    await stop
+    for task in tasks:
+        task.cancel()
+    for member in fleet:
+        member.wsprdev.close()
+    journal.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(run_fleet(sys.argv[1:]))
@@ -33,9 +33,17 @@ Author: Ulf Nordström SM0FXK
 
 """
 from tkinter import *
-from wspr_cat import beacon
+from wspr_cat import beacon, BANDS, INTERVALS, HW_NAMES, LINK_UP, SPEED
 from wspr_config import WsprConfig
 from wspr_config import serialPort
+from wspr_config import when_done
+from wspr_clock import clockSync, MIN_CHECK
+import wspr_poll
+import wspr_metrics
+from wspr_journal import transmissionJournal
+import wspr_trace
+from wspr_proto import is_error
+import queue
 import time
 
 
@@ -141,7 +149,7 @@ def band_frame(parent):
     subFrame = Frame(parent)
     
     bandCol=1
-    for band in [160,80,40,30,20,17,15,12,10]:
+    for band in BANDS:
         rad = Radiobutton(subFrame, text = str(band), value = band, variable=bandVar, background='grey')
         rad.grid(row=3,column=bandCol, padx=2)
         bandCol =bandCol + 1
@@ -152,7 +160,7 @@ def interval_frame(parent):
     
     intervalFrame = Frame(parent)
     intervalCol=0
-    for interval in [2, 4, 6, 8]:
+    for interval in INTERVALS:
         button = Radiobutton(intervalFrame, text = str(interval), value = interval, variable=intervalVar, background='grey')
         button.grid(row=3,column=intervalCol, padx=10)
         intervalCol =intervalCol + 1
@@ -160,12 +168,8 @@ def interval_frame(parent):
     
     
 def time_sync():
-    system_time = time.time()
-    pctime = int(round(system_time))
-    print(pctime)
-    st = wsprdev.send_cat_cmd("QT", [pctime])
-    print(st)
     print("Syncronising time")
+    when_done(root, wsprdev.run_async(clock.resync), print)
 #pctime = int(time.time())
 #ser.write('QT' + str(pctime) + ';')
 #print ser.readline()
@@ -175,68 +179,181 @@ def tune():
     global bandVar
     band = bandVar.get()
     print (band)
-    reply = wsprdev.send_cat_cmd("TX",[2, band]) 
-    print(reply)
+    when_done(root, wsprdev.submit("TX",[2, band]), poll_now)
+
+status_text = {'DI':'Disabled', 
+               'WT':'Waiting for timeslot',
+               'OA': '---= On Air =---',
+               'ER': 'No connection',
+               'TU': 'Tuning'}
 
 def fetch(first_poll):
-    global stime
-    global bandvar
-    global connected
-    status_text = {'DI':'Disabled', 
-                   'WT':'Waiting for timeslot',
-                   'OA': '---= On Air =---',
-                   'ER': 'No connection',
-                   'TU': 'Tuning'}
-    
+    """
+    Poll the beacon. Status and, on the first poll, hardware are
+    requested in one batch that is queued to the beacon I/O thread, or
+    with one FS when the beacon sends binary frames. The
+    replies are handled by show_poll(), which plans the next poll from
+    the state of the beacon. Only one poll is in flight at a time.
+    The beacon clock is only read when the drift model of clock says so.
+    No polls are made while a config window is open.
+    """
+    global poll_busy, poll_again
 #   print "fetch called"
+    if poll_busy:
+        poll_again = True
+        return
+    if WsprConfig.open_windows > 0:
+        schedule_poll(1.0, first_poll)
+        return
     if connected:
+        if wsprdev.answered and not wsprdev.negotiated:
+            wsprdev.negotiated = True       # Once per connection
+            when_done(root, wsprdev.negotiate_speed_async(), speed_done, failed = setup_failed)
+            when_done(root, wsprdev.run_async(wsprdev.enable_binary), lambda binary: None,
+                      failed = setup_failed)
+        if clock.due():
+            clock.next_check = float('inf')    # One sync at a time
+            when_done(root, wsprdev.run_async(clock.sync), lambda offset: None,
+                      failed = sync_failed)
+        commands = wsprdev.status_commands()
+        if wsprdev.state.hw is None and not wsprdev.binary:
+            commands.append(("QH", []))
+        poll_busy = True
+        when_done(root, wsprdev.submit_query(commands), show_poll, first_poll, failed = poll_failed)
+    else:
+        statusVar.set(status_text['ER'])
+        center.configure(background='red')
+        poll_busy = True
+        when_done(root, wsprdev.ensure_link_async(), link_up, failed = poll_failed)
 
-        [atime] = wsprdev.send_cat_cmd("QT")
-        #print(atime)
-        htime = time.time()
-        stime.set(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(htime)))
-        if atime == 'ER' or atime== '':
-            wsprtime.set("No connection")
-        else:
-            center.configure(background='#eeeeee')
-            wsprtime.set(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(atime))))
-            if abs(int(round(htime)) - int(atime)) > 10:
-                time_sync()
+def schedule_poll(delay, first_poll = False):
+    global poll_timer
+    if poll_timer is not None:
+        root.after_cancel(poll_timer)
+    poll_timer = root.after(int(delay * 1000), fetch, first_poll)
+
+def poll_now(reply = None):
+    """Read the status at once, e.g. after a command has changed it"""
+    if reply is not None:
+        print(reply)
+    schedule_poll(0)
+
+def poll_done(delay, first_poll = False):
+    global poll_busy, poll_again
+    poll_busy = False
+    if poll_again:
+        poll_again = False
+        delay = 0
+    schedule_poll(delay, first_poll)
+
+def poll_failed(first_poll = False):
+    """The poll raised in the I/O thread, e.g. on a garbled reply, try again later"""
+    poll_done(wspr_poll.ERROR_POLL, first_poll)
+
+def link_up(result):
+    global connected
+    connected = result
+    if connected:
+        clock.next_check = 0
+        # The open may have reset the Arduino, give it time to boot
+        poll_done(BOOT_DELAY, True)
+    else:
+        poll_done(wspr_poll.ERROR_POLL)
+
+def speed_done(speed):
+    if speed != SPEED:
+        # The wire times of the last clock measurement are stale
+        clock.next_check = 0
+
+def setup_failed():
+    """Speed negotiation or BM1 raised, set the link up again at the next poll"""
+    wsprdev.negotiated = False
+
+def sync_failed():
+    """The clock sync raised, try again after the shortest check interval"""
+    clock.next_check = clock.clock() + MIN_CHECK
+
+def watch_events():
+    """Show the events the I/O thread has queued, in the Tk thread"""
+    while True:
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            break
+        show_event(event)
+    root.after(EVENT_CHECK_MS, watch_events)
+
+def show_event(event):
+    """A change the beacon has reported by itself, e.g. a slot start"""
+    if event.event == 'state' and wsprdev.state.status is not None:
+        show_state(wsprdev.state.status)
+    elif event.event == 'config':
+        poll_now()
+
+def show_poll(replies, first_poll):
+    show_hw()
+    show_status(replies[0], first_poll)
+
+def show_time():
+    htime = time.time()
+    stime.set(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(htime)))
+    if clock.offset is None:
+        wsprtime.set("No connection")
+    else:
+        # Beacon time from the drift model, no need to ask the beacon
+        atime = clock.device_time(htime)
+        wsprtime.set(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(atime))))
 #   print htime 
-        st = wsprdev.send_cat_cmd("WS", ['ST'])
-        if len(st) == 3:
-            [wstate, interval, band] = st
-            statusVar.set(status_text[wstate])
-            if first_poll:
-                [hw] = wsprdev.send_cat_cmd("QH")
-                if hw == '1':
-                    hwType.set("SA6VEE board with AD9850")
-                elif hw == '2':
-                    hwType.set("Arduino UNO with Si5351 and DS3231 real time clock")
-                else:
-                    hwType.set("Unknown")
-                    print("Unknown hw")
-                bandVar.set(int(band))
-                intervalVar.set(int(interval))
-            if wstate == 'WT':
-                remaining_time = int(interval) *60 - (int(htime) % (int(interval)*60))
-                #print(remaining_time)
-                progressBar.set(int(remaining_time/(int(interval)/2)))
-            
-            elif wstate == 'OA':
-                #print((int(htime) % (int(interval)*60)))
-                progressBar.set((int(htime) % (int(interval)*60)))
-        elif len(st) == 1:
-            wstate = 'ER'
-            statusVar.set(status_text[wstate])
-            center.configure(background='red')
-            Connected = False
+
+def tick():
+    """Update the clocks and the progress bar from local state, no serial traffic"""
+    global tick_due
+    now = time.monotonic()
+    # How late the event loop ran us, a sign of work done in Tk callbacks
+    wsprdev.metrics.observe('tk_loop_lag_seconds', None, max(now - tick_due, 0.0),
+                            wspr_metrics.LAG_BUCKETS)
+    tick_due = now + 1.0
+    show_time()
+    htime = time.time()
+    if wstate in ('WT', 'OA') and winterval > 0:
+        if wstate == 'WT':
+            remaining_time = wspr_poll.slot_end(htime, winterval) - int(htime)
+            #print(remaining_time)
+            progressBar.set(int(remaining_time/(winterval/2)))
+        else:
+            #print((int(htime) % (int(interval)*60)))
+            progressBar.set(int(htime) - wspr_poll.slot_start(htime, winterval))
+    root.after(1000, tick)
+
+def show_status(st, first_poll):
+    show_state(st, first_poll)
+    poll_done(wspr_poll.next_poll(wstate, winterval, clock.device_time(), wsprdev.binary))
+
+def show_state(st, first_poll = False):
+    global connected, wstate, winterval
+    if not is_error(st):
+        wstate = st.state
+        winterval = st.interval or 0
+        center.configure(background='#eeeeee')
+        statusVar.set(status_text[wstate])
+        if first_poll and st.interval is not None:
+            bandVar.set(st.band)
+            intervalVar.set(st.interval)
     else:
-        statusVar.set(status_text['ER'])
+        wstate = 'ER'
+        statusVar.set(status_text[wstate])
         center.configure(background='red')
-        connected = wsprdev.connect()
+        connected = wsprdev.link_state == LINK_UP
 
-    root.after(1000, fetch, False)
+def show_hw():
+    hw = wsprdev.state.hw
+    if hw is None:
+        hwType.set("")
+    elif hw in HW_NAMES:
+        hwType.set(HW_NAMES[hw])
+    else:
+        hwType.set("Unknown")
+        print("Unknown hw")
 
 def alert(info):
     alertWindow = Toplevel()
@@ -248,19 +365,36 @@ def start():
     band = bandVar.get()
     interval =intervalVar.get()
     if band !=0 and interval !=0:
-        R = wsprdev.send_cat_cmd('WS', ['TX', interval, band])
-        print(R)
+        when_done(root, wsprdev.submit('WS', ['TX', interval, band]), poll_now)
 
     else:
         alert("band")
 
 def stop():
     print("stop")
-    wsprdev.send_cat_cmd("WS",['CA'])
+    when_done(root, wsprdev.submit("WS",['CA']), poll_now)
+
+BOOT_DELAY = 2.0        # Seconds from opening the port to the first poll
+EVENT_CHECK_MS = 50     # How often the queue of beacon events is looked at
 
 config_data = serialPort()
 wsprdev = beacon(config_data)
-connected = wsprdev.connect()
+wsprdev.journal = transmissionJournal()
+wsprdev.trace = wspr_trace.from_env()
+# Subscribed once for good, no event is missed between two Tk callbacks
+events = queue.Queue()
+wsprdev.subscribe(events.put)
+# The port is opened by the I/O thread once the window is up
+connected = False
+wsprdev.start_worker()
+clock = clockSync(wsprdev)
+poll_timer = None
+poll_busy = False
+poll_again = False
+wstate = None
+winterval = 0
+tick_due = time.monotonic() + 1.0
+wspr_metrics.export_from_env()
 #while(connected == False):
 #    config_data = serialPort()
 #    port = config_data.get()
@@ -294,6 +428,9 @@ footer = foot_frame(root)
 footer.grid(row=4, column=0, pady=40)
 copyright = Label(root, text = "© Ulf Nordström, SM0FXK")
 copyright.grid(row=5, column=0, sticky="W")
-root.after(2000, fetch, True)
+poll_busy = True
+when_done(root, wsprdev.connect_async(), link_up, failed = poll_failed)
+root.after(1000, tick)
+root.after(EVENT_CHECK_MS, watch_events)
 root.mainloop()
 
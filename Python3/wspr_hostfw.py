@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+The beacon firmware built for the host, run behind a pseudo terminal.
+
+firmware/host builds Si5351.ino unmodified against stub Arduino, EEPROM,
+Time, DS3232RTC, Si5351 and JTEncode libraries. The program prints the
+path of its pty, which the host code opens as it opens /dev/ttyACM0, so
+the GUI, wspr_cat and the other tools can be run against the real
+firmware logic without hardware. Unlike wspr_sim, nothing of the
+firmware is rewritten: the command parser, the call_after() scheduler
+and the symbol timing are the ones of the sketch.
+
+The firmware runs on a simulated clock that can be faster than real
+time, and writes an event log of its pin writes and synthesiser calls.
+From the log the symbols sent and their timing are read. The serial
+input is paced to the line speed and goes through a receive ring of 64
+bytes as on the AVR, so bytes the firmware does not read in time are
+lost and logged.
+
+What the host build cannot show: int is 32 bits instead of 16, so the
+offsets in flash_layout and the EEPROM image differ from the AVR build,
+although the firmware logic is the same. An EEPROM file of the host
+build cannot be loaded into an Arduino or the other way around.
+
+Usage:
+  wspr_hostfw.py [-s SPEED]            Run the firmware and print its device
+  wspr_hostfw.py --bench [-s SPEED]    Parser throughput, buffer overflow and symbol timing
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from wspr_cat import SYMBOL_COUNT, SYMBOL_TIME, TX_DELAY, beacon, fixedPort
+
+HOST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'firmware', 'host')
+BUILD_DIR = os.path.join(tempfile.gettempdir(), 'fxk_wspr_host')
+PROGRAM = 'fxk_wspr_host'
+BUFFER_SIZE = 80            # commandbuffer in the firmware
+TONE_SPACING = 146          # 0.01 Hz
+FREQ_MULT = 100
+BENCH_SPEED = 10.0
+BENCH_COMMANDS = 500
+BENCH_CALL = ('SM0FXK', 'JO89', '23')
+
+def build(host_dir = HOST_DIR, build_dir = BUILD_DIR):
+    """Build the host program with make in build_dir, not in the source tree. Returns its path."""
+    subprocess.check_call(['make', '-s', '-C', host_dir, 'BUILD_DIR=' + os.path.abspath(build_dir)],
+                          stdout = subprocess.DEVNULL)
+    return os.path.join(build_dir, PROGRAM)
+
+class hostFirmware:
+    """
+    A running host build of the firmware. device is the pty to open. The
+    EEPROM and the event log are kept in a temporary directory unless
+    files are given.
+    """
+    def __init__(self, speed = 1.0, start_time = None, eeprom = None, log = None):
+        self.speed = speed
+        self.directory = tempfile.TemporaryDirectory(prefix = 'fxk_wspr_host')
+        self.eeprom = eeprom or os.path.join(self.directory.name, 'eeprom.bin')
+        self.log = log or os.path.join(self.directory.name, 'events.log')
+        command = [build(), '-s', str(speed), '-e', self.eeprom, '-l', self.log]
+        if start_time is not None:
+            command = command + ['-t', str(int(start_time))]
+        self.started = time.monotonic()
+        self.process = subprocess.Popen(command, stdout = subprocess.PIPE, universal_newlines = True)
+        self.device = self.process.stdout.readline().strip()
+        if not self.device:
+            raise OSError("the host firmware did not start")
+
+    def sleep(self, seconds):
+        """Sleep seconds of simulated time"""
+        time.sleep(seconds / self.speed)
+
+    def events(self):
+        """The event log as (milliseconds, [fields])"""
+        result = []
+        with open(self.log) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    result.append((float(fields[0]), fields[1:]))
+        return result
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.directory.cleanup()
+
+def transmissions(events):
+    """
+    The transmissions in the event log, as (output on time, [(time,
+    frequency)]) with a time and frequency in 0.01 Hz for every symbol.
+    """
+    result = []
+    symbols = None
+    for t, fields in events:
+        if fields[:2] == ['si5351', 'pwr'] and fields[2] == '0':
+            if fields[3] == '1':
+                symbols = []
+                result.append((t, symbols))
+            else:
+                symbols = None
+        elif fields[:2] == ['si5351', 'freq'] and symbols is not None:
+            symbols.append((t, int(fields[3])))
+    return result
+
+def symbol_timing(start, symbols):
+    """Timing of one transmission in milliseconds of simulated time"""
+    times = [t for t, f in symbols]
+    steps = [b - a for a, b in zip(times, times[1:])]
+    ideal = SYMBOL_TIME * 1000.0
+    return {'symbols': len(symbols),
+            'first_delay_ms': times[0] - start if times else None,
+            'mean_step_ms': sum(steps) / len(steps) if steps else None,
+            'max_step_error_ms': max(abs(s - ideal) for s in steps) if steps else None,
+            'drift_ms': times[-1] - times[0] - (len(times) - 1) * ideal if steps else None}
+
+def tones(symbols, frequency):
+    """The channel symbols, from the frequencies set and the carrier in Hz"""
+    return [int(round((f - frequency * FREQ_MULT) / float(TONE_SPACING))) for t, f in symbols]
+
+#=============================================================================#
+# Measurements
+#=============================================================================#
+def bench_parser(wsprdev, count = BENCH_COMMANDS):
+    """Commands per second through the command parser, QH in batches of 10"""
+    start = time.perf_counter()
+    for i in range(count // 10):
+        wsprdev.query_batch([("QH", [])] * 10)
+    return count / (time.perf_counter() - start)
+
+def bench_overflow(firmware):
+    """
+    What the parser does with BUFFER_SIZE bytes without a ;. Returns the
+    replies to QH before and after, None when there was no reply.
+    """
+    wsprdev = beacon(fixedPort(firmware.device))
+    wsprdev.connect()
+    before = wsprdev.query("QH")
+    wsprdev.arduino.write(b'X' * BUFFER_SIZE)
+    after = wsprdev.query("QH")
+    wsprdev.close()
+    return before, after
+
+def bench_transmission(speed = BENCH_SPEED):
+    """Start a 2 minute slot and time the symbols of the transmission"""
+    # Start 5 s before an even minute, so the slot starts soon
+    start_time = (int(time.time()) // 120 + 1) * 120 - 5
+    firmware = hostFirmware(speed, start_time)
+    try:
+        wsprdev = beacon(fixedPort(firmware.device))
+        wsprdev.connect()
+        wsprdev.query_batch([("QC", list(BENCH_CALL) + [0]), ("WS", ['TX', 2, 20])])
+        firmware.sleep(5 + TX_DELAY + SYMBOL_COUNT * SYMBOL_TIME + 2)
+        status = wsprdev.query("WS", ['ST'])
+        wsprdev.close()
+        sent = transmissions(firmware.events())
+    finally:
+        firmware.close()
+    if not sent:
+        return None, status, None
+    start, symbols = sent[0]
+    timing = symbol_timing(start, symbols)
+    try:
+        import wspr_encode
+        from wspr_tuning import BAND_FREQUENCY
+        timing['symbols_match'] = tones(symbols, BAND_FREQUENCY[20]) == \
+            list(wspr_encode.encode(*BENCH_CALL))
+    except ImportError:
+        pass
+    return timing, status, symbols
+
+def bench(speed = BENCH_SPEED):
+    firmware = hostFirmware(speed)
+    try:
+        wsprdev = beacon(fixedPort(firmware.device))
+        wsprdev.connect()
+        rate = bench_parser(wsprdev)
+        wsprdev.close()
+        print("Parser: %.0f commands/s" % rate)
+        before, after = bench_overflow(firmware)
+        print("%d bytes without ';': QH answered %s before, %s after" % (BUFFER_SIZE, before, after))
+    finally:
+        firmware.close()
+    timing, status, symbols = bench_transmission(speed)
+    if timing is None:
+        print("No transmission, status " + str(status))
+        return
+    print("Transmission at %gx speed: %d symbols, first after %.0f ms" %
+          (speed, timing['symbols'], timing['first_delay_ms']))
+    print("Symbol step %.2f ms mean, %.2f ms worst error, %.0f ms drift over the transmission" %
+          (timing['mean_step_ms'], timing['max_step_error_ms'], timing['drift_ms']))
+    if 'symbols_match' in timing:
+        print("Symbols match wspr_encode: " + str(timing['symbols_match']))
+    print("Status after: " + str(status))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Run the beacon firmware on the host")
+    parser.add_argument('-s', '--speed', type = float, help = "speed of the simulated clock")
+    parser.add_argument('--bench', action = 'store_true',
+                        help = "measure the parser and the symbol timing")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.speed or BENCH_SPEED)
+        sys.exit(0)
+    firmware = hostFirmware(args.speed or 1.0)
+    print(firmware.device)
+    try:
+        firmware.process.wait()
+    except KeyboardInterrupt:
+        pass
+    firmware.close()
@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Journal of what the WSPR beacon did.
+
+Every observed state change, clock sync and command result is appended to
+an SQLite database, and every slot seen on air is stored once in a table
+of its own, indexed on band and time. That keeps queries like slots per
+band per day, or the slots that should have been sent but were not, at a
+few milliseconds even after months of operation.
+
+Recording only puts the event on a queue. A writer thread inserts the
+events in batches, so the journal never adds latency to the serial I/O
+or to the GUI.
+
+Usage:
+  wspr_journal.py [-d DAYS] [DATABASE]      Slots per band per day and missed slots
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+import wspr_proto
+from wspr_poll import slot_start, slot_end
+
+DB_NAME = "fxk_wspr_journal.sqlite"
+FLUSH_INTERVAL = 5.0    # Seconds an event may wait in the queue
+BATCH = 200             # Events written in one transaction at most
+SEEN_MARGIN = 10.0      # Seconds into a slot before it is known whether it was sent
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    device TEXT NOT NULL,
+    kind TEXT NOT NULL,         -- state, sync or command
+    state TEXT,
+    interval INTEGER,
+    band INTEGER,
+    detail TEXT);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS slots (
+    slot INTEGER NOT NULL,      -- Host time of the slot start
+    device TEXT NOT NULL,
+    band INTEGER,
+    interval INTEGER,
+    PRIMARY KEY (device, slot)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS slots_band ON slots (band, slot);
+CREATE INDEX IF NOT EXISTS slots_time ON slots (slot);
+"""
+
+def journal_path():
+    if os.name == 'nt':
+        DB_DIR = os.environ["USERPROFILE"]
+    else:
+        DB_DIR = os.environ["HOME"]
+    return DB_DIR + os.sep + DB_NAME
+
+def connect(path):
+    db = sqlite3.connect(path, timeout = 10)
+    db.execute("PRAGMA journal_mode=WAL")     # Readers do not wait for the writer
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(schema)
+    return db
+
+class transmissionJournal:
+    """
+    Append only journal. The record methods may be called from any thread,
+    the queries from any thread but the writer.
+    """
+    def __init__(self, path = None):
+        self.path = path or journal_path()
+        self.events = queue.Queue()
+        self.last_state = {}        # device -> (state, interval, band), writer thread only
+        self.reader = None
+        self.reader_thread = None
+        self.writer = threading.Thread(target=self.write_loop, name='journal')
+        self.writer.daemon = True
+        self.writer.start()
+
+    #=========================================================================#
+    # Recording, called from the poll path: no I/O here
+    #=========================================================================#
+    def status(self, device, state, interval = None, band = None, t = None):
+        """An observed status, the writer keeps only the changes"""
+        self.events.put((t or time.time(), device, 'state', state, interval, band, None))
+
+    def sync(self, device, offset, detail = None, t = None):
+        self.events.put((t or time.time(), device, 'sync', None, None, None,
+                         detail or "%.3f" % offset))
+
+    def command(self, device, cat_cmd, parameters, result, t = None):
+        text = cat_cmd + ','.join(str(p) for p in parameters)
+        self.events.put((t or time.time(), device, 'command', None, None, None,
+                         text + ' ' + str(result)))
+
+    def observe(self, device, cat_cmd, parameters, reply):
+        """Journal a typed reply from wspr_proto, as beacon.decode() gets it"""
+        key = wspr_proto.schema_key(cat_cmd, parameters)
+        if key in (('WS', 'ST'), ('FS', 'get')):
+            if not wspr_proto.is_error(reply):
+                self.status(device, reply.state, reply.interval, reply.band)
+            elif reply.reason == wspr_proto.TIMEOUT:
+                self.status(device, 'ER')
+        elif key[1] != 'get' and key != ('QT', 'set'):
+            # Commands that change the beacon. QT is journalled as a sync.
+            self.command(device, cat_cmd, parameters, getattr(reply, 'text', None) or
+                         getattr(reply, 'value', reply))
+
+    #=========================================================================#
+    # Writer thread
+    #=========================================================================#
+    def write_loop(self):
+        db = connect(self.path)
+        running = True
+        while running:
+            # Collect for a while, one transaction per batch
+            batch = [self.events.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH and batch[-1]:
+                try:
+                    batch.append(self.events.get(timeout = max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+            self.write(db, [event for event in batch if event])
+            for event in batch:
+                self.events.task_done()
+        db.close()
+
+    def write(self, db, batch):
+        rows = []
+        slots = []
+        for event in batch:
+            t, device, kind, state, interval, band = event[:6]
+            if kind == 'state':
+                if state == 'OA' and interval:
+                    slots.append((slot_start(t, interval), device, band, interval))
+                if self.last_state.get(device) == (state, interval, band):
+                    continue
+                self.last_state[device] = (state, interval, band)
+            rows.append(event)
+        try:
+            with db:
+                db.executemany("INSERT INTO events VALUES (?,?,?,?,?,?,?)", rows)
+                db.executemany("INSERT OR IGNORE INTO slots VALUES (?,?,?,?)", slots)
+        except sqlite3.Error as e:
+            print("Journal write failed: " + str(e))
+
+    def flush(self):
+        """Wait until everything recorded so far is in the database"""
+        self.events.put(())     # Ends the batch at once
+        self.events.join()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.events.put(None)
+            self.writer.join()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    #=========================================================================#
+    # Queries
+    #=========================================================================#
+    def query(self, sql, args = ()):
+        if self.reader is None or self.reader_thread is not threading.current_thread():
+            self.reader = connect(self.path)
+            self.reader_thread = threading.current_thread()
+        return self.reader.execute(sql, args).fetchall()
+
+    def slots_per_band_per_day(self, start = 0, end = None, device = None):
+        """[(day, band, slots)] for the slots started in [start, end), UTC days"""
+        sql = ("SELECT date(slot, 'unixepoch'), band, count(*) FROM slots "
+               "WHERE slot >= ? AND slot < ?")
+        args = [int(start), int(end or time.time())]
+        if device is not None:
+            sql = sql + " AND device = ?"
+            args.append(device)
+        return self.query(sql + " GROUP BY 1, 2 ORDER BY 1, 2", args)
+
+    def missed_slots(self, start, end = None, device = None):
+        """
+        [(slot, device, band, interval)] of the slots in [start, end) that
+        the beacon should have sent, being in WT or OA, but was never seen
+        on air in. Time without a reply (ER) is not counted, it is not
+        known what the beacon did then.
+        """
+        end = min(int(end or time.time()), time.time() - SEEN_MARGIN)
+        sql = "SELECT time, device, state, interval, band FROM events WHERE kind = 'state' AND time < ?"
+        args = [end]
+        if device is not None:
+            sql = sql + " AND device = ?"
+            args.append(device)
+        # The state at start is the last change before it
+        before = self.query("SELECT device, max(time) FROM events WHERE kind = 'state' AND time < ? "
+                            "GROUP BY device", [start])
+        since = min([t for d, t in before] + [start])
+        changes = self.query(sql + " AND time >= ? ORDER BY time", args + [since])
+        seen = set(self.query("SELECT device, slot FROM slots WHERE slot >= ? AND slot < ?",
+                              [int(start), int(end)]))
+        periods = {}
+        for t, dev, state, interval, band in changes:
+            periods.setdefault(dev, []).append((t, state, interval, band))
+        missed = []
+        for dev, changes in periods.items():
+            for n, (t0, state, interval, band) in enumerate(changes):
+                if state not in ('WT', 'OA') or not interval:
+                    continue
+                t1 = changes[n + 1][0] if n + 1 < len(changes) else end
+                # Every slot that starts while the beacon is waiting or on air
+                slot = slot_start(max(t0, start), interval)
+                if slot < max(t0, start):
+                    slot = slot_end(slot, interval)
+                while slot < min(t1, end):
+                    if (dev, slot) not in seen:
+                        missed.append((slot, dev, band, interval))
+                    slot = slot_end(slot, interval)
+        missed.sort()
+        return missed
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Transmission journal of the WSPR beacon")
+    parser.add_argument('-d', '--days', type = int, default = 7, help = "days back from now")
+    parser.add_argument('database', nargs = '?', default = journal_path())
+    args = parser.parse_args()
+    journal = transmissionJournal(args.database)
+    start = time.time() - args.days * 86400
+    t = time.perf_counter()
+    rows = journal.slots_per_band_per_day(start)
+    missed = journal.missed_slots(start)
+    elapsed = time.perf_counter() - t
+    print("Day          Band  Slots")
+    for day, band, count in rows:
+        print("%s  %4sm  %5d" % (day, band, count))
+    print("%d missed slot(s)" % len(missed))
+    for slot, device, band, interval in missed:
+        print("  " + time.strftime("%Y-%m-%d %H:%M", time.gmtime(slot)) + "  %sm  %s" % (band, device))
+    print("Queries took %.1f ms" % (elapsed * 1000))
+    journal.close()
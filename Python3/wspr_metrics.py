@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the CAT link.
+
+Every beacon has a linkMetrics with counters, gauges and latency
+histograms, filled in from the serial I/O path: the latency of every
+command, timeouts and error replies (ER, ?;, NC), bytes to and from the
+beacon, reconnects and the clock offset. The GUI adds the lag of the Tk
+event loop. Recording is a dict lookup and an add, so it can stay on in
+normal use.
+
+The numbers can be read in process with snapshot(), or exported in the
+Prometheus text format, to a file for the node exporter textfile
+collector or from a small HTTP server on localhost. The export is
+switched on with environment variables:
+  WSPR_METRICS_FILE=/var/lib/node_exporter/wspr.prom
+  WSPR_METRICS_PORT=9477
+A beacon is exported until it is closed.
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import bisect
+import os
+import threading
+
+PREFIX = 'wspr_'
+# Seconds. A command at 9600 baud takes about 15 ms on the wire.
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+LAG_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 5.0)
+WRITE_INTERVAL = 15.0   # Seconds between writes of the metrics file
+
+descriptions = {'command_latency_seconds': ('histogram', "Round trip time of a CAT command"),
+                'tk_loop_lag_seconds': ('histogram', "Lateness of the 1 s GUI tick"),
+                'commands_total': ('counter', "CAT commands sent"),
+                'errors_total': ('counter', "Error replies and missing replies"),
+                'bytes_sent_total': ('counter', "Bytes written to the beacon"),
+                'bytes_received_total': ('counter', "Bytes read from the beacon"),
+                'connects_total': ('counter', "Successful opens of the serial port"),
+                'link_lost_total': ('counter', "Times the link was given up"),
+                'clock_offset_seconds': ('gauge', "Beacon clock minus host clock"),
+                'clock_uncertainty_seconds': ('gauge', "Uncertainty of the clock offset"),
+                'link_up': ('gauge', "1 when the serial link is up"),
+                'cache_hits_total': ('counter', "Client reads answered by wspr_server without the beacon"),
+                'clients': ('gauge', "Clients connected to wspr_server"),
+                'events_total': ('counter', "Event frames sent by the beacon")}
+
+class histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q quantile is in, None when empty"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen = seen + n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class linkMetrics:
+    """
+    Metrics of one beacon. Series are keyed by name and one optional label
+    (the command for latencies, the reason for errors). Recording takes no
+    lock, readers copy the dicts under the lock.
+    """
+    def __init__(self, device = ''):
+        self.device = device
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        register(self)
+
+    def inc(self, name, label = None, n = 1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, label, value, buckets = LATENCY_BUCKETS):
+        key = (name, label)
+        h = self.histograms.get(key)
+        if h is None:
+            with self.lock:
+                h = self.histograms[key] = histogram(buckets)
+        h.observe(value)
+
+    def snapshot(self):
+        """Plain dict of the current values, for use in process"""
+        with self.lock:
+            result = {'device': self.device, 'gauges': dict(self.gauges), 'counters': {}, 'latency': {}}
+            for (name, label), value in list(self.counters.items()):
+                result['counters'][name if label is None else name + ':' + label] = value
+            for (name, label), h in list(self.histograms.items()):
+                result['latency'][name if label is None else name + ':' + label] = \
+                    {'count': h.count, 'sum': h.sum,
+                     'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+        return result
+
+    def label_name(self, name):
+        return 'reason' if name == 'errors_total' else 'command'
+
+    def labels(self, extra = None):
+        text = 'device="%s"' % escape(self.device)
+        if extra is not None:
+            text = text + ',' + extra
+        return '{' + text + '}'
+
+    def samples(self):
+        """(name, label text, value) of every series, Prometheus style"""
+        with self.lock:
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+            histograms = list(self.histograms.items())
+        for (name, label), value in counters:
+            extra = None
+            if label is not None:
+                extra = '%s="%s"' % (self.label_name(name), escape(label))
+            yield name, self.labels(extra), value
+        for name, value in gauges:
+            if value is not None:
+                yield name, self.labels(), value
+        for (name, label), h in histograms:
+            extra = '' if label is None else 'command="%s",' % escape(label)
+            seen = 0
+            for bound, n in zip(h.buckets, h.counts):
+                seen = seen + n
+                yield name + '_bucket', self.labels(extra + 'le="%g"' % bound), seen
+            yield name + '_bucket', self.labels(extra + 'le="+Inf"'), h.count
+            extra = extra.rstrip(',') or None
+            yield name + '_sum', self.labels(extra), h.sum
+            yield name + '_count', self.labels(extra), h.count
+
+registry = []       # The linkMetrics of the open beacons in this process
+registry_lock = threading.Lock()
+
+def register(metrics):
+    """Export metrics, again after unregister()"""
+    with registry_lock:
+        if metrics not in registry:
+            registry.append(metrics)
+
+def unregister(metrics):
+    """Stop exporting metrics, e.g. of a beacon that has been closed"""
+    with registry_lock:
+        if metrics in registry:
+            registry.remove(metrics)
+
+def escape(text):
+    return str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def base_name(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in descriptions:
+            return name[:-len(suffix)]
+    return name
+
+def prometheus_text(sets = None):
+    """All metrics in the Prometheus text exposition format"""
+    if sets is None:
+        with registry_lock:
+            sets = list(registry)
+    series = {}
+    for metrics in sets:
+        for name, labels, value in metrics.samples():
+            series.setdefault(base_name(name), []).append((name, labels, value))
+    lines = []
+    for base in sorted(series):
+        kind, text = descriptions.get(base, ('untyped', base))
+        lines.append('# HELP %s%s %s' % (PREFIX, base, text))
+        lines.append('# TYPE %s%s %s' % (PREFIX, base, kind))
+        for name, labels, value in series[base]:
+            lines.append('%s%s%s %s' % (PREFIX, name, labels, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path, sets = None):
+    """Write the metrics atomically, the collector never sees half a file"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text(sets))
+    os.replace(tmp, path)
+
+def metrics_handler():
+    # http.server is only imported when the metrics are served
+    from http.server import BaseHTTPRequestHandler
+
+    class metricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return metricsHandler
+
+def serve(port, host = '127.0.0.1'):
+    """Serve /metrics from a daemon thread. Returns the server."""
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), metrics_handler())
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def file_writer(path, interval = WRITE_INTERVAL):
+    """Rewrite the metrics file every interval seconds from a daemon thread"""
+    stop = threading.Event()
+    def loop():
+        while not stop.wait(interval):
+            try:
+                write_textfile(path)
+            except OSError as e:
+                print("Cannot write metrics: " + str(e))
+    thread = threading.Thread(target=loop, name='metrics-file')
+    thread.daemon = True
+    thread.start()
+    return stop
+
+def export_from_env():
+    """Start the exports asked for in the environment"""
+    port = os.environ.get('WSPR_METRICS_PORT')
+    if port:
+        try:
+            serve(int(port))
+        except (OSError, ValueError) as e:
+            print("Cannot serve metrics on port " + port + ": " + str(e))
+    path = os.environ.get('WSPR_METRICS_FILE')
+    if path:
+        file_writer(path)
+
+if __name__ == '__main__':
+    # Metrics of a short session with a simulated beacon
+    import wspr_sim
+    from wspr_cat import beacon, fixedPort
+    server = wspr_sim.simulatorServer()
+    sim = server.add(wspr_sim.simulatedBeacon())
+    server.start()
+    wsprdev = beacon(fixedPort(sim.device))
+    wsprdev.connect()
+    for i in range(20):
+        wsprdev.query_batch([("WS", ['ST']), ("QT", []), ("XX", [])])
+    wsprdev.close()
+    server.stop()
+    print(prometheus_text([wsprdev.metrics]), end='')
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Poll planning for the WSPR beacon.
+
+The state of the beacon only changes on its own at the slot boundaries:
+WT becomes OA when a slot starts and OA becomes WT when the last symbol
+has been sent. Everything else is changed by the host. So instead of
+asking for the status every second, the planner picks the time of the
+next poll from the current state: shortly after the next expected
+transition to confirm it, otherwise only a slow keepalive. A beacon that
+sends events reports the transitions itself, then the keepalive is all.
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+from wspr_cat import SYMBOL_COUNT, SYMBOL_TIME, TX_DELAY
+
+ERROR_POLL = 1.0        # Seconds between polls while there is no connection
+TUNE_POLL = 5.0         # While tuning
+KEEPALIVE = 30.0        # Longest time without a poll while the link is up
+CONFIRM_DELAY = 1.5     # Seconds after an expected transition before it is confirmed
+MIN_POLL = 0.5
+HOUR = 3600             # Seconds, the slots start over every hour
+# The firmware leaves on_air right after the last symbol has been set
+TX_END = TX_DELAY + (SYMBOL_COUNT - 1) * SYMBOL_TIME
+
+def slot_start(t, interval):
+    """
+    Start of the slot of length interval minutes that t is in. The
+    firmware starts a slot when minute() % interval == 0, so the slots are
+    counted from the start of every hour. With 8 minutes the slot at
+    minute 56 is cut short by the one at minute 0.
+    """
+    t = int(t)
+    hour = t - t % HOUR
+    return hour + (t - hour) // (interval * 60) * (interval * 60)
+
+def slot_end(t, interval):
+    """Start of the slot after the one t is in"""
+    start = slot_start(t, interval)
+    return min(start + interval * 60, start - start % HOUR + HOUR)
+
+def next_transition(state, interval, t):
+    """Beacon time of the next state change the beacon makes by itself, or None"""
+    if interval <= 0:
+        return None
+    if state == 'WT':
+        return slot_end(t, interval)
+    if state == 'OA':
+        return slot_start(t, interval) + TX_END
+    return None
+
+def next_poll(state, interval, t, events = False):
+    """
+    Seconds from beacon time t until the status should be read again.
+    state is the last status read, ER or None when there is no reply.
+    events is True when the beacon sends its state changes.
+    """
+    if state is None or state == 'ER':
+        return ERROR_POLL
+    if events:
+        return KEEPALIVE
+    if state == 'TU':
+        return TUNE_POLL
+    transition = next_transition(state, interval, t)
+    if transition is None:
+        return KEEPALIVE
+    wait = transition + CONFIRM_DELAY - t
+    if wait < MIN_POLL:
+        # Expected transition has not shown up yet, look again soon
+        wait = CONFIRM_DELAY
+    return min(wait, KEEPALIVE)
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+CAT protocol of the WSPR beacon: reply framing and typed replies.
+
+The firmware answers most commands with one line, but not all:
+  - an unknown command is answered with ?; and no line end,
+  - the TIME_REQUEST bell character (ASCII 7) can come at any time,
+  - after a reset the line can start with garbage,
+  - after BM1; some replies are binary frames: FRAME_START, type, length,
+    payload and a CRC-16/CCITT of type, length and payload,
+  - after BM1; event frames come unasked, between replies.
+catFramer splits the received bytes into reply frames incrementally, so
+partial reads are fine and no timeout is needed to find the end of a
+reply. Binary frames are only looked for once binary is set, before that
+FRAME_START is garbage like any other. A binary frame with a bad CRC or
+an impossible header is returned as CORRUPT_FRAME, so a corrupted reply
+is reported instead of being taken for another one. Only its start byte
+is dropped, the length may be wrong too, and the bytes after it are
+scanned again up to the next frame or line.
+
+The reply formats of the commands in cmd_table of the firmware are kept
+in a registry, which turns a reply frame into a typed result.
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import binascii
+import struct
+from collections import namedtuple
+
+TIME_REQUEST = 7            # Bell character, the firmware wants the time
+ERROR_FRAME = b'?;'         # Reply to an unknown command
+NOISE = b'\r\x00\xff'       # Stripped from both ends of a line
+FRAME_START = 0xA5          # First byte of a binary frame, never in a line
+FRAME_HEADER = 3            # Start, type and length
+FRAME_CRC = 2
+CORRUPT_FRAME = bytes([FRAME_START])    # A binary frame that failed the CRC
+FRAME_MAX_PAYLOAD = 64      # Longer than any frame of the firmware
+
+# Binary frame types
+FRAME_STATUS = 1            # Reply to FS
+FRAME_EVENT = 2             # Sent by the beacon on a change
+
+# Events
+EVENT_STATE = 1             # State, interval or band has changed
+EVENT_CONFIG = 2            # QC has been written
+EVENT_TIME = 3              # The clock has been set with QT
+EVENT_NAMES = {EVENT_STATE: 'state', EVENT_CONFIG: 'config', EVENT_TIME: 'time'}
+
+#=============================================================================#
+# Framing
+#=============================================================================#
+class catFramer:
+    """
+    Incremental framer of the bytes received from the beacon.
+    feed() takes whatever the port returned; next_frame() returns the
+    complete frames one at a time: a line without its line end,
+    ERROR_FRAME, or None when no frame is complete yet.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.time_requests = 0
+        self.binary = False         # FRAME_START starts a binary frame, after BM1
+
+    def clear(self, keep_frame = False):
+        """Drop what is buffered, keep_frame keeps the start of a binary frame"""
+        if keep_frame and self.buffer[:1] == bytes([FRAME_START]):
+            return
+        del self.buffer[:]
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        buf = self.buffer
+        # Garbage in front of a frame, e.g. after a reset, and time requests
+        start = 0
+        while start < len(buf) and (buf[start] in NOISE or buf[start] == TIME_REQUEST or
+                                    (buf[start] == FRAME_START and not self.binary)):
+            if buf[start] == TIME_REQUEST:
+                self.time_requests = self.time_requests + 1
+            start = start + 1
+        if start:
+            del buf[:start]
+        if not buf:
+            return None
+        if buf[0] == FRAME_START:
+            return self.binary_frame()
+        if buf[:2] == ERROR_FRAME:
+            del buf[:2]
+            return ERROR_FRAME
+        end = buf.find(b'\n')
+        if self.binary:
+            start = buf.find(FRAME_START)
+            if start > 0 and (end < 0 or start < end):
+                # The rest of a corrupt frame, FRAME_START is never in a line
+                del buf[:start]
+                return self.binary_frame()
+        if end < 0:
+            return None
+        frame = bytes(memoryview(buf)[:end]).strip(NOISE)
+        del buf[:end + 1]
+        if TIME_REQUEST in frame:
+            # Out of band, the only copy made is for this rare case
+            self.time_requests = self.time_requests + frame.count(TIME_REQUEST)
+            frame = frame.replace(bytes([TIME_REQUEST]), b'').strip(NOISE)
+        return frame
+
+    def binary_frame(self):
+        buf = self.buffer
+        if len(buf) < FRAME_HEADER:
+            return None
+        if buf[1] not in (FRAME_STATUS, FRAME_EVENT) or buf[2] > FRAME_MAX_PAYLOAD:
+            # Do not wait for a length that is not there
+            del buf[:1]
+            return CORRUPT_FRAME
+        end = FRAME_HEADER + buf[2] + FRAME_CRC
+        if len(buf) < end:
+            return None
+        frame = bytes(memoryview(buf)[:end])
+        if frame_crc(memoryview(frame)[1:-FRAME_CRC]) != frame[-2] | frame[-1] << 8:
+            # Look for the next frame or line right after the start byte
+            del buf[:1]
+            return CORRUPT_FRAME
+        del buf[:end]
+        return frame
+
+def frame_crc(data):
+    """CRC-16/CCITT with initial value 0xFFFF, as crc16_update() in the firmware"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def make_frame(frame_type, payload):
+    """A binary frame as the firmware sends it"""
+    body = bytes([frame_type, len(payload)]) + payload
+    crc = frame_crc(body)
+    return bytes([FRAME_START]) + body + bytes([crc & 0xff, crc >> 8])
+
+#=============================================================================#
+# Typed replies
+#=============================================================================#
+statusReply = namedtuple('statusReply', ['state', 'interval', 'band'])
+configReply = namedtuple('configReply', ['call', 'locator', 'power', 'offset'])
+timeReply = namedtuple('timeReply', ['time'])
+hwReply = namedtuple('hwReply', ['hw'])
+ackReply = namedtuple('ackReply', ['text'])
+tuneReply = namedtuple('tuneReply', ['value'])
+speedReply = namedtuple('speedReply', ['speed'])
+fullStatus = namedtuple('fullStatus', ['time', 'state', 'interval', 'band', 'symbol',
+                                       'configured', 'hw', 'call', 'locator', 'power', 'offset'])
+beaconEvent = namedtuple('beaconEvent', ['event', 'time', 'state', 'interval', 'band'])
+errorReply = namedtuple('errorReply', ['reason', 'text'])
+
+# errorReply reasons
+UNKNOWN_COMMAND = 'unknown command'     # ?;
+NOT_CONFIGURED = 'not configured'       # NC
+TIMEOUT = 'no reply'
+BAD_REPLY = 'unexpected reply'
+CORRUPT = 'corrupt frame'
+
+STATES = ('DI', 'WT', 'OA', 'TU')
+
+def parse_status(text):
+    fields = text.split(',')
+    if fields[0] not in STATES:
+        return None
+    if len(fields) == 1:
+        # Disabled and never configured
+        return statusReply(fields[0], None, None)
+    if len(fields) == 3:
+        return statusReply(fields[0], int(fields[1]), int(fields[2]))
+    return None
+
+def parse_config(text):
+    if text == 'NC':
+        return errorReply(NOT_CONFIGURED, text)
+    fields = text.split(',')
+    if len(fields) != 4:
+        return None
+    return configReply(fields[0], fields[1], int(fields[2]), int(fields[3]))
+
+def parse_time(text):
+    return timeReply(int(text))
+
+def parse_hw(text):
+    return hwReply(text) if text in ('1', '2') else None
+
+def parse_ack(*expected):
+    def parse(text):
+        if text == 'NC':
+            return errorReply(NOT_CONFIGURED, text)
+        if text in expected:
+            return ackReply(text)
+        return None
+    return parse
+
+def parse_tune(text):
+    return tuneReply(text)
+
+def parse_speed(text):
+    return speedReply(int(text))
+
+# Payload of FRAME_STATUS, see full_status() in the firmware
+STATUS_FORMAT = struct.Struct('<IBBBBBB8s5sbi')
+
+def parse_full_status(payload):
+    if len(payload) != STATUS_FORMAT.size:
+        return None
+    (time, state, interval, band, symbol, configured, hw,
+     call, locator, power, offset) = STATUS_FORMAT.unpack_from(payload)
+    if state >= len(STATES):
+        return None
+    if not configured:
+        call = locator = power = offset = None
+        if state == 0:
+            # As the bare DI of WS ST
+            interval = band = None
+    else:
+        call = call.split(b'\0', 1)[0].decode('ascii', 'replace')
+        locator = locator.split(b'\0', 1)[0].decode('ascii', 'replace')
+    return fullStatus(time, STATES[state], interval, band, symbol, bool(configured),
+                      str(hw), call, locator, power, offset)
+
+# (command, action) -> reply parser. The action is the first parameter of
+# WS, and 'get' or 'set' for the other commands.
+schemas = {('WS', 'ST'): parse_status,
+           ('WS', 'TX'): parse_ack('OK'),
+           ('WS', 'CA'): parse_ack('stop'),
+           ('WS', 'get'): parse_ack('WS'),
+           ('QC', 'get'): parse_config,
+           ('QC', 'set'): parse_ack('OK'),
+           ('QT', 'get'): parse_time,
+           ('QT', 'set'): parse_ack('Success'),
+           ('QH', 'get'): parse_hw,
+           ('TX', 'set'): parse_tune,
+           ('TX', 'get'): parse_tune,
+           ('QB', 'get'): parse_speed,
+           ('QB', 'set'): parse_ack('OK'),
+           ('BM', 'get'): parse_ack('0', '1'),
+           ('BM', 'set'): parse_ack('OK')}
+
+# Payload of FRAME_EVENT, see send_event() in the firmware
+EVENT_FORMAT = struct.Struct('<BIBBB')
+
+def is_event(frame):
+    return len(frame) > FRAME_HEADER and frame[0] == FRAME_START and frame[1] == FRAME_EVENT
+
+def decode_event(frame):
+    """A beaconEvent from an event frame, None when it cannot be read"""
+    payload = memoryview(frame)[FRAME_HEADER:-FRAME_CRC]
+    if len(payload) != EVENT_FORMAT.size:
+        return None
+    event, time, state, interval, band = EVENT_FORMAT.unpack_from(payload)
+    if event not in EVENT_NAMES or state >= len(STATES):
+        return None
+    return beaconEvent(EVENT_NAMES[event], time, STATES[state], interval, band)
+
+# (command, action) -> (frame type, payload parser) of binary replies
+frame_schemas = {('FS', 'get'): (FRAME_STATUS, parse_full_status)}
+
+def schema_key(cat_cmd, parameters):
+    if cat_cmd == 'WS' and parameters:
+        return (cat_cmd, str(parameters[0]))
+    return (cat_cmd, 'set' if parameters else 'get')
+
+def decode_reply(cat_cmd, parameters, frame):
+    """Typed result of the reply frame to a command. frame is None on timeout."""
+    if frame is None:
+        return errorReply(TIMEOUT, '')
+    if frame == ERROR_FRAME:
+        return errorReply(UNKNOWN_COMMAND, '?;')
+    if frame == CORRUPT_FRAME:
+        return errorReply(CORRUPT, '')
+    if not frame:
+        # A blank line, e.g. reset garbage ending in CR LF
+        return errorReply(BAD_REPLY, '')
+    if frame[0] == FRAME_START:
+        return decode_frame(cat_cmd, parameters, frame)
+    text = frame.decode('ascii', 'replace')
+    parse = schemas.get(schema_key(cat_cmd, parameters))
+    if parse is None:
+        return errorReply(UNKNOWN_COMMAND, text)
+    try:
+        result = parse(text)
+    except ValueError:
+        result = None
+    if result is None:
+        return errorReply(BAD_REPLY, text)
+    return result
+
+def decode_frame(cat_cmd, parameters, frame):
+    frame_type, parse = frame_schemas.get(schema_key(cat_cmd, parameters), (None, None))
+    result = None
+    if frame[1] == frame_type:
+        result = parse(memoryview(frame)[FRAME_HEADER:-FRAME_CRC])
+    if result is None:
+        return errorReply(BAD_REPLY, frame.hex())
+    return result
+
+def is_error(reply):
+    return isinstance(reply, errorReply)
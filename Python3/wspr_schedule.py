@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Band hopping scheduler for the WSPR beacon.
+
+The firmware starts a transmission when minute() % interval == 0 and
+reads the band from EEPROM at that moment. A band change must therefore
+be written with WS TX after the previous transmission has ended and
+before the next slot starts. Writing it while the beacon is on air would
+stop the transmission.
+
+The scheduler precomputes the upcoming slots of a hopping plan and keeps
+them in a heap, a few slots ahead. It sleeps until the next command time,
+so it costs no CPU and no serial traffic between slots. WS TX is only sent
+when the band actually changes.
+
+Usage:
+  wspr_schedule.py DEVICE [BAND,BAND,...]
+  wspr_schedule.py DEVICE PLAN.json       Hourly plan from wspr_spots.py -o
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import heapq
+import sys
+import time
+from wspr_cat import BANDS, TX_LENGTH
+from wspr_poll import slot_end
+
+LOOKAHEAD = 10          # Slots kept in the heap
+COMMAND_LEAD = 5.0      # Seconds before slot start a band change is sent
+SYNC_LEAD = 5.0         # Seconds a clock check may take before a command
+# Coordinated band hopping of the WSPR community, band by minute % 20
+ROTATION = (160, 80, 60, 40, 30, 20, 17, 15, 12, 10)
+
+def rotation_plan(bands = BANDS):
+    """
+    Coordinated minute of hour band rotation: the slot at minute m of the
+    hour goes out on ROTATION[m % 20 // 2], so every band is visited three
+    times an hour at the same minutes as the other hopping stations. The
+    slots of a band that is not in bands, e.g. 60 m that the beacon cannot
+    send, are left quiet.
+    """
+    def plan(slot_time):
+        band = ROTATION[int(slot_time // 60) % 20 // 2]
+        if band in bands:
+            return band
+        return None
+    return plan
+
+def fixed_plan(band):
+    """Always the same band"""
+    def plan(slot_time):
+        return band
+    return plan
+
+class hoppingScheduler:
+    """
+    Drive a beacon through a hopping plan.
+    wsprdev is anything with send_cat_cmd(), i.e. a beacon. plan is a
+    function that returns the band for a slot start time, or None to let
+    the beacon stay quiet during that slot. With a wspr_clock.clockSync
+    the slots are timed on the beacon clock, which starts them, and the
+    clock is checked between slots when it is due.
+    """
+    def __init__(self, wsprdev, plan, interval = 2, lookahead = LOOKAHEAD, clock = None):
+        if interval * 60 - TX_LENGTH <= COMMAND_LEAD:
+            raise ValueError("no gap between transmissions")
+        self.wsprdev = wsprdev
+        self.plan = plan
+        self.interval = interval
+        self.lookahead = lookahead
+        self.heap = []
+        self.next_slot = None
+        self.band = None        # Band the beacon runs, None if stopped
+        self.sync = clock
+        self.clock = time.time if clock is None else clock.device_time
+        self.sleep = time.sleep
+
+    def first_slot(self, now):
+        """First slot whose band can still be changed"""
+        slot = slot_end(now, self.interval)
+        if slot - COMMAND_LEAD < now:
+            slot = slot_end(slot, self.interval)
+        return slot
+
+    def fill(self):
+        """Top up the heap with slots from the plan"""
+        while len(self.heap) < self.lookahead:
+            slot = self.next_slot
+            heapq.heappush(self.heap, (slot - COMMAND_LEAD, slot, self.plan(slot)))
+            self.next_slot = slot_end(slot, self.interval)
+
+    def timeline(self, now = None, count = LOOKAHEAD):
+        """List of (command time, slot time, band) for the next slots"""
+        if now is None:
+            now = self.clock()
+        slots = [self.first_slot(now)]
+        while len(slots) < count:
+            slots.append(slot_end(slots[-1], self.interval))
+        return [(s - COMMAND_LEAD, s, self.plan(s)) for s in slots]
+
+    def read_state(self):
+        st = self.wsprdev.send_cat_cmd("WS", ['ST'])
+        if len(st) == 3 and st[0] in ('WT', 'OA') and int(st[1]) == self.interval:
+            self.band = int(st[2])
+        else:
+            self.band = None
+
+    def apply(self, slot, band):
+        if band == self.band:
+            return
+        if band is None:
+            reply = self.wsprdev.send_cat_cmd("WS", ['CA'])
+        else:
+            reply = self.wsprdev.send_cat_cmd("WS", ['TX', self.interval, band])
+        print(time.strftime("%H:%M:%S", time.localtime(slot)) + " band " + str(band) + ": " + str(reply))
+        if reply[0] in ('OK', 'stop'):
+            self.band = band
+        else:
+            # Unknown state, read it again at next change
+            self.read_state()
+
+    def step(self):
+        """Wait for the next command time and run it. Late commands are skipped."""
+        self.fill()
+        command_time, slot, band = heapq.heappop(self.heap)
+        if self.sync is not None and self.sync.due() and command_time - self.clock() > SYNC_LEAD:
+            self.sync.sync()
+        delay = command_time - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        if self.clock() < slot:
+            self.apply(slot, band)
+        else:
+            print("Missed slot " + time.strftime("%H:%M:%S", time.localtime(slot)))
+
+    def run(self, slots = None):
+        self.read_state()
+        self.heap = []
+        self.next_slot = self.first_slot(self.clock())
+        while slots is None or slots > 0:
+            self.step()
+            if slots is not None:
+                slots = slots - 1
+
+if __name__ == '__main__':
+    from wspr_cat import beacon, fixedPort
+    from wspr_clock import clockSync
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    plan = rotation_plan(BANDS)
+    if len(sys.argv) > 2 and sys.argv[2].endswith('.json'):
+        import json
+        from wspr_spots import hourly_plan
+        with open(sys.argv[2]) as f:
+            plan = hourly_plan(json.load(f)['hours'])
+    elif len(sys.argv) > 2:
+        plan = rotation_plan([int(band) for band in sys.argv[2].split(',')])
+    wsprdev = beacon(fixedPort(sys.argv[1]))
+    if not wsprdev.connect():
+        print("Cannot open " + sys.argv[1])
+        sys.exit(1)
+    clock = clockSync(wsprdev)
+    clock.sync()
+    scheduler = hoppingScheduler(wsprdev, plan, clock = clock)
+    for command_time, slot, band in scheduler.timeline():
+        print(time.strftime("%H:%M", time.localtime(slot)) + "  " + str(band))
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    wsprdev.close()
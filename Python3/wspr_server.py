@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+CAT server that lets several programs share one WSPR beacon.
+
+A serial port can only be opened by one process. The server owns the
+port and accepts any number of clients on a local TCP port and, on
+Linux, a Unix socket. The clients speak the CAT protocol of the beacon:
+commands ending with ; in, the reply lines of the firmware out. The GUI
+uses the server when the serial port is set to socket://127.0.0.1:7373,
+and a script only needs a socket:
+
+  echo -n "WSST;" | nc -q 1 127.0.0.1 7373
+
+All commands go through the one I/O thread of wspr_cat.beacon, so the
+commands of different clients are never interleaved on the serial line.
+The reads are answered from the state mirror of the beacon instead:
+WS ST, QC and QH from the last reply, and QT from the clock model of
+wspr_clock. The server polls the status itself, planned with wspr_poll,
+and keeps the beacon clock in sync. A status read that has gone stale,
+because a slot has started or ended since, is sent to the beacon once
+and the reply is given to every client that asked meanwhile. So any
+number of clients cost one poll stream on the serial link. The server
+negotiates the line speed with the beacon, QB from a client only reads it.
+
+Usage:
+  wspr_server.py [-p PORT] [-u SOCKET] [DEVICE]
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import socketserver
+import threading
+import time
+import wspr_poll
+import wspr_proto
+from wspr_cat import beacon, fixedPort, conf, LINK_UP, SPEED
+from wspr_clock import clockSync, SETTLE_TIME
+
+SERVER_PORT = 7373
+SOCKET_NAME = "fxk_wspr.sock"
+BUFFER_SIZE = 80            # Longest command, as commandbuffer in the firmware
+RECEIVE_SIZE = 1024
+MAX_UNCERTAINTY = 0.25      # Seconds, QT is answered from the clock model below this
+
+# Replies that give or change the status of the beacon
+STATUS_KEYS = (('WS', 'ST'), ('FS', 'get'), ('WS', 'TX'), ('WS', 'CA'), ('TX', 'set'), ('TX', 'get'))
+
+def socket_path():
+    return os.environ["HOME"] + os.sep + SOCKET_NAME
+
+def parse_command(command):
+    """(cat_cmd, parameters) of a command without its ;"""
+    text = command.decode('latin-1')
+    parameters = text[2:].split(',') if len(text) > 2 else []
+    return text[:2], parameters
+
+# (command, action) -> (parameter count, the parameters that are numbers),
+# the firmware reads the numbers with atoi()
+PARAMETERS = {('WS', 'TX'): (3, (1, 2)),
+              ('QC', 'set'): (4, (2, 3)),
+              ('QT', 'set'): (1, (0,))}
+
+def valid_parameters(key, parameters):
+    """
+    False when the firmware would take the parameters for something else
+    than they say, e.g. WS TX,abc,20 for interval 0
+    """
+    if key not in PARAMETERS:
+        return True
+    count, numbers = PARAMETERS[key]
+    if len(parameters) != count:
+        return False
+    try:
+        for n in numbers:
+            int(parameters[n])
+    except ValueError:
+        return False
+    return True
+
+def format_status(status):
+    if status.interval is None:
+        return status.state
+    return "%s,%d,%d" % status
+
+def format_config(config):
+    return "%s,%s,%d,%d" % config
+
+class beaconMultiplexer:
+    """
+    Shares one beacon among the clients. handle() may be called from any
+    thread; the serial I/O is done on the I/O worker of the beacon.
+    """
+    def __init__(self, wsprdev):
+        self.wsprdev = wsprdev
+        self.clock = clockSync(wsprdev)
+        self.lock = threading.Lock()
+        self.status_read = None     # Future of the status read in flight
+        self.status_time = 0.0      # Host time the status in the mirror was read or set
+        self.clients = 0
+        self.stopping = threading.Event()
+        self.poller = None
+        wsprdev.subscribe(self.event)
+
+    #=========================================================================#
+    # Clients
+    #=========================================================================#
+    def handle(self, command):
+        """Reply bytes to one command, None when the beacon did not answer"""
+        cat_cmd, parameters = parse_command(command)
+        key = wspr_proto.schema_key(cat_cmd, parameters)
+        if key in (('QB', 'set'), ('BM', 'set')):
+            # The line speed and mode are set up by the server, not by a client
+            return b'ER\r\n'
+        if not valid_parameters(key, parameters):
+            return b'ER\r\n'
+        text = self.cached(key)
+        if text is not None:
+            self.wsprdev.metrics.inc('cache_hits_total', cat_cmd)
+            return str.encode(text + '\r\n')
+        if key == ('WS', 'ST'):
+            future = self.read_status()
+        else:
+            future = self.wsprdev.run_async(self.transact, [(cat_cmd, parameters)])
+        frame = future.result()[0]
+        if frame is None:
+            return None
+        if frame == wspr_proto.ERROR_FRAME or frame[:1] == bytes([wspr_proto.FRAME_START]):
+            return frame
+        return frame + b'\r\n'
+
+    def cached(self, key):
+        """The reply from the state mirror, or None when the beacon must be asked"""
+        if self.wsprdev.link_state != LINK_UP:
+            return None
+        state = self.wsprdev.state
+        if key == ('WS', 'ST'):
+            if self.status_fresh():
+                return format_status(state.status)
+        elif key == ('QC', 'get'):
+            if state.configured is False:
+                return 'NC'
+            if state.config is not None:
+                return format_config(state.config)
+        elif key == ('QH', 'get'):
+            return state.hw
+        elif key == ('QB', 'get'):
+            return str(self.wsprdev.speed)
+        elif key == ('BM', 'get'):
+            return '1' if self.wsprdev.binary else '0'
+        elif key == ('QT', 'get'):
+            clock = self.clock
+            if (clock.uncertainty is not None and clock.uncertainty <= MAX_UNCERTAINTY and
+                    clock.clock() >= clock.settled_at):
+                return str(int(clock.device_time()))
+        return None
+
+    def status_fresh(self):
+        """True while the beacon cannot have changed its status by itself"""
+        status = self.wsprdev.state.status
+        if status is None:
+            return False
+        now = time.time()
+        if now - self.status_time > wspr_poll.KEEPALIVE:
+            return False
+        if self.wsprdev.binary:
+            # The beacon reports its transitions
+            return True
+        transition = wspr_poll.next_transition(status.state, status.interval or 0,
+                                               self.clock.device_time(self.status_time))
+        return transition is None or self.clock.device_time(now) < transition
+
+    def read_status(self):
+        """
+        Future of the WS ST reply frame, as a list of one. Clients that ask
+        while a read is in flight get the reply of that read.
+        """
+        with self.lock:
+            if self.status_read is None or self.status_read.done():
+                self.status_read = self.wsprdev.run_async(self.transact, [("WS", ['ST'])])
+            return self.status_read
+
+    #=========================================================================#
+    # Beacon, on the I/O worker
+    #=========================================================================#
+    def transact(self, commands):
+        """Reply frames of the commands, the mirror and clock kept up to date"""
+        wsprdev = self.wsprdev
+        if not wsprdev.ensure_link():
+            return [None] * len(commands)
+        frames = wsprdev.exchange(commands)
+        wsprdev.decode(commands, frames)
+        for (cat_cmd, parameters), frame in zip(commands, frames):
+            key = wspr_proto.schema_key(cat_cmd, parameters)
+            if key in STATUS_KEYS and frame is not None:
+                self.status_time = time.time()
+            elif key == ('QT', 'set') and frame is not None:
+                # A client has set the clock, measure it again once settled
+                clock = self.clock
+                clock.model.clear()
+                clock.settled_at = clock.clock() + SETTLE_TIME
+                clock.next_check = clock.settled_at
+        return frames
+
+    def poll(self):
+        """Keep the mirror and the beacon clock up to date, returns the delay to the next poll"""
+        wsprdev = self.wsprdev
+        if wsprdev.ensure_link() and self.clock.due():
+            self.clock.sync()
+        commands = wsprdev.status_commands()
+        if not wsprdev.binary:
+            commands = commands + [c for c in wsprdev.state.missing() if c != ("WS", ['ST'])]
+        frames = self.transact(commands)
+        status = wsprdev.state.status
+        if frames[0] is not None and not wsprdev.negotiated:
+            if wsprdev.negotiate_speed() != SPEED:
+                self.clock.next_check = 0
+            wsprdev.enable_binary()
+        if frames[0] is None or status is None:
+            return wspr_poll.next_poll(None, 0, time.time())
+        return wspr_poll.next_poll(status.state, status.interval or 0, self.clock.device_time(),
+                                   wsprdev.binary)
+
+    def event(self, event):
+        """On the I/O worker: a state event is as good as a status read"""
+        if event.event == 'state':
+            self.status_time = time.time()
+
+    def poll_loop(self):
+        delay = 0.0
+        while not self.stopping.wait(delay):
+            try:
+                delay = self.wsprdev.run_async(self.poll).result()
+            except Exception as e:
+                # E.g. a reply the decoder did not expect, keep polling
+                print("Poll failed: " + str(e))
+                delay = wspr_poll.ERROR_POLL
+
+    def start(self):
+        self.wsprdev.start_worker()
+        self.poller = threading.Thread(target=self.poll_loop, name='server-poll')
+        self.poller.daemon = True
+        self.poller.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.poller is not None:
+            self.poller.join()
+        self.wsprdev.close()
+
+    def client_count(self, change):
+        with self.lock:
+            self.clients = self.clients + change
+            self.wsprdev.metrics.set('clients', self.clients)
+
+class catHandler(socketserver.BaseRequestHandler):
+    """One client. The commands of a client are answered in order."""
+    def handle(self):
+        mux = self.server.mux
+        mux.client_count(1)
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.request.recv(RECEIVE_SIZE)
+                if not data:
+                    break
+                buffer += data
+                end = buffer.find(b';')
+                while end >= 0:
+                    command = bytes(buffer[:end]).strip(b' \r\n\x00')
+                    del buffer[:end + 1]
+                    try:
+                        reply = mux.handle(command)
+                    except Exception as e:
+                        # Answered as if the beacon had not, the client carries on
+                        print("Command %r failed: %s" % (command, e))
+                        reply = None
+                    if reply is not None:
+                        self.request.sendall(reply)
+                    end = buffer.find(b';')
+                if len(buffer) > BUFFER_SIZE:
+                    # No command is that long, skip the garbage
+                    del buffer[:]
+        except OSError:
+            pass
+        finally:
+            mux.client_count(-1)
+
+class catTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if os.name == 'posix':
+    class catUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+def serve(mux, port = SERVER_PORT, path = None, host = '127.0.0.1'):
+    """Start the listeners on daemon threads. Returns the servers."""
+    servers = []
+    if port:
+        servers.append(catTCPServer((host, port), catHandler))
+    if path and os.name == 'posix':
+        if os.path.exists(path):
+            os.unlink(path)     # Left by a server that was killed
+        servers.append(catUnixServer(path, catHandler))
+    for server in servers:
+        server.mux = mux
+        thread = threading.Thread(target=server.serve_forever, name='cat-server')
+        thread.daemon = True
+        thread.start()
+    return servers
+
+if __name__ == '__main__':
+    import argparse
+    import signal
+    import wspr_metrics
+    from wspr_journal import transmissionJournal
+    import wspr_trace
+    parser = argparse.ArgumentParser(description = "Share a WSPR beacon between several programs")
+    parser.add_argument('-p', '--port', type = int, default = SERVER_PORT,
+                        help = "TCP port on 127.0.0.1, 0 for none")
+    parser.add_argument('-u', '--unix', nargs = '?', const = socket_path(),
+                        help = "also listen on a Unix socket, by default ~/" + SOCKET_NAME)
+    parser.add_argument('device', nargs = '?', default = conf['ddsdev'])
+    args = parser.parse_args()
+    wsprdev = beacon(fixedPort(args.device))
+    wsprdev.journal = transmissionJournal()
+    wsprdev.trace = wspr_trace.from_env()
+    wspr_metrics.export_from_env()
+    mux = beaconMultiplexer(wsprdev)
+    mux.start()
+    servers = serve(mux, args.port, args.unix)
+    print("Serving " + args.device + " on" + (" 127.0.0.1:%d" % args.port if args.port else "") +
+          (" " + args.unix if args.unix else ""))
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    while not stop.wait(1.0):
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    if args.unix and os.path.exists(args.unix):
+        os.unlink(args.unix)
+    mux.stop()
+    wsprdev.journal.close()
+    if wsprdev.trace is not None:
+        wsprdev.trace.close()
@@ -0,0 +1,620 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Software simulator of the WSPR beacon firmware.
+
+A simulated beacon opens a pseudo terminal and answers the CAT commands
+the same way as Si5351.ino does: the command table (WS, TX, QC, QT, QH, QB,
+BM, FS and the ?; error reply), and after BM1 the event frames, the wspr_state_t transitions, the flash_layout
+EEPROM image and the 162 symbol x 683 ms transmission timing. The host
+code opens the pty path exactly as it would open /dev/ttyACM0.
+
+The serial line can be paced to a baud rate, which QB changes as in the
+firmware. When the host port is set to another speed than the firmware
+uses, what either side sends arrives as garbage. Latency and faults can
+be injected: dropped bytes, commands without reply and a reset of the
+Arduino when the port is opened. One server thread serves any number of
+simulated beacons.
+
+Usage:
+  wspr_sim.py [COUNT]        Start COUNT beacons and print their devices
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import random
+import select
+import struct
+import sys
+import termios
+import threading
+import time
+import tty
+from collections import deque
+import wspr_proto
+from wspr_cat import SPEED, SYMBOL_COUNT, SYMBOL_TIME, TX_DELAY
+
+BUFFER_SIZE = 80            # commandbuffer in the firmware
+EEPROM_SIZE = 1024          # Arduino UNO
+BOOT_TIME = 1.6             # Seconds the bootloader runs after a reset
+BAUD_CONFIRM_TIME = 2.0     # Seconds a new line speed waits for QB
+LINE_SPEEDS = (9600, 19200, 38400, 57600, 115200)
+TERMIOS_SPEEDS = dict((getattr(termios, 'B%d' % rate), rate) for rate in LINE_SPEEDS)
+SYNC_INTERVAL = 300         # TimeLib default, seconds between RTC reads
+DEFAULT_TIME = 1357041600   # Jan 1 2013
+MAGIC = b'fxk'
+
+# wspr_state_t
+inactive, waiting_for_timeslot, on_air, tuning = range(4)
+
+# Offsets of flash_layout with AVR sizes, int is 2 bytes
+flash_layout = {'magic': 0,
+                'xtal_offset': 4,
+                'call': 6,
+                'locator': 14,
+                'power': 19,
+                'band': 21,
+                'interval': 23,
+                'state': 25,
+                'error_log': 27}
+
+class eeprom:
+    """EEPROM image, erased to 0xff like a new Arduino"""
+    def __init__(self):
+        self.mem = bytearray(b'\xff' * EEPROM_SIZE)
+
+    def put_int(self, name, value):
+        struct.pack_into('<H', self.mem, flash_layout[name], int(value) & 0xffff)
+
+    def get_int(self, name):
+        return struct.unpack_from('<h', self.mem, flash_layout[name])[0]
+
+    def get_uint(self, name):
+        return struct.unpack_from('<H', self.mem, flash_layout[name])[0]
+
+    def put_str(self, name, value):
+        # eestrput() does not check the length, a long value runs into the next field
+        address = flash_layout[name]
+        for c in value + b'\0':
+            if address < EEPROM_SIZE:
+                self.mem[address] = c
+            address = address + 1
+
+    def get_str(self, name, maxlen):
+        # Same as eestrget(), reads up to maxlen + 1 characters
+        address = flash_layout[name]
+        dest = bytearray()
+        while address < EEPROM_SIZE and self.mem[address] != 0:
+            if len(dest) > maxlen:
+                break
+            dest.append(self.mem[address])
+            address = address + 1
+        return bytes(dest)
+
+    def has_magic(self):
+        return self.get_str('magic', 4) == MAGIC
+
+def atoi(field):
+    """C atoi(), leading digits only, 0 if there are none"""
+    field = field.strip()
+    digits = ''
+    for i, c in enumerate(field):
+        if c.isdigit() or (i == 0 and c in '+-'):
+            digits = digits + c
+        else:
+            break
+    try:
+        return int(digits)
+    except ValueError:
+        return 0
+
+class simulatedBeacon:
+    """
+    One simulated beacon on its own pseudo terminal.
+
+    hw              Reply to QH, 1 = AD9850 board, 2 = Si5351
+    baudrate        Line speed after a reset, changed with QB. None = no pacing
+    latency         Extra seconds before a reply starts
+    drop_rate       Probability that a byte sent by the beacon is lost
+    no_reply_rate   Probability that a command is executed without reply
+    reset_on_open   Reset the Arduino when the host opens the port, like DTR does
+    hw_clock        DS3231 present (HW_CLOCK in config.h)
+    rtc_offset      Seconds the RTC is off from the host clock
+    drift           Relative error of the Arduino millis() clock
+    """
+    def __init__(self, hw = 2, baudrate = SPEED, latency = 0.0, drop_rate = 0.0,
+                 no_reply_rate = 0.0, reset_on_open = False, hw_clock = True,
+                 rtc_offset = 0.0, drift = 0.0, seed = None):
+        self.hw = hw
+        self.baudrate = baudrate
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.no_reply_rate = no_reply_rate
+        self.reset_on_open = reset_on_open
+        self.hw_clock = hw_clock
+        self.rtc_offset = rtc_offset
+        self.drift = drift
+        self.random = random.Random(seed)
+        self.eeprom = eeprom()
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.device = os.ttyname(slave)
+        # No slave fd is kept, so the master sees a hangup until the host opens the port
+        os.close(slave)
+        self.connected = False
+        self.lock = threading.Lock()
+        self.rx = deque()           # (time the byte has arrived, byte)
+        self.rx_free = 0.0          # Time the line from host is free
+        self.tx = bytearray()
+        self.tx_free = 0.0          # Time the line to host is free
+        self.tx_due = deque()       # (time, byte, speed) written by the firmware
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.commands = 0
+        self.reset(time.monotonic())
+        # Powered up long ago, the bootloader is done
+        self.booting_until = 0.0
+
+    #=========================================================================#
+    # Clocks
+    #=========================================================================#
+    def rtc_now(self):
+        return time.time() + self.rtc_offset
+
+    def millis(self, now):
+        return (now - self.boot) * (1.0 + self.drift) * 1000.0
+
+    def set_time(self, t, now):
+        """TimeLib setTime()"""
+        self.sys_time = int(t)
+        self.sys_millis = self.millis(now)
+        self.next_sync = self.sys_time + SYNC_INTERVAL
+
+    def now(self, t = None):
+        """TimeLib now() in the simulated Arduino"""
+        if t is None:
+            t = time.monotonic()
+        elapsed = int((self.millis(t) - self.sys_millis) // 1000)
+        sys_time = self.sys_time + elapsed
+        if self.hw_clock and sys_time >= self.next_sync:
+            self.set_time(self.rtc_now(), t)
+            return self.sys_time
+        return sys_time
+
+    #=========================================================================#
+    # Firmware
+    #=========================================================================#
+    def reset(self, now):
+        """setup()"""
+        self.boot = now
+        self.booting_until = now + BOOT_TIME
+        self.pos = 0
+        self.commandbuffer = bytearray()
+        self.wedged = False
+        self.wspr_state = inactive
+        self.timeslot = 4
+        self.bands = 0
+        self.wspr_symbol = 0
+        self.tx_start = None
+        self.last_start = None
+        self.cal_factor = 0
+        self.sys_time = 0
+        self.sys_millis = 0
+        self.next_sync = 0
+        self.speed = self.baudrate or SPEED
+        self.speed_revert_at = None
+        self.binary_frames = False
+        self.reported = (inactive, self.timeslot, self.bands)
+        if self.hw_clock:
+            self.set_time(self.rtc_now(), now)
+        if self.eeprom.has_magic():
+            self.wspr_state = self.eeprom.get_int('state')
+            self.timeslot = self.eeprom.get_uint('interval')
+            self.bands = self.eeprom.get_uint('band')
+
+    def println(self, text):
+        self.print_(text + '\r\n')
+
+    def print_(self, text):
+        self.write(text.encode())
+
+    def write(self, data):
+        if not self.mute:
+            self.output.extend(data)
+
+    def poll_serial(self, ch, now):
+        if self.wedged:
+            return
+        if self.pos < BUFFER_SIZE:
+            if ch == ord(';'):
+                command = bytes(self.commandbuffer)
+                self.commandbuffer = bytearray()
+                self.pos = 0
+                self.parse_command(command, now)
+            else:
+                self.commandbuffer.append(ch)
+                self.pos = self.pos + 1
+        else:
+            # The firmware never leaves this state, bytes stay in the Serial buffer
+            self.wedged = True
+
+    def parse_command(self, command, now):
+        self.commands = self.commands + 1
+        self.output = bytearray()
+        self.mute = self.random.random() < self.no_reply_rate
+        cmd = command[:2].decode('latin-1')
+        param = command[2:].decode('latin-1')
+        table = {'WS': self.wspr,
+                 'TX': self.tune,
+                 'QC': self.configure_wspr,
+                 'QT': self.time_sync,
+                 'QH': self.query_hw,
+                 'QB': self.serial_speed,
+                 'BM': self.binary_mode,
+                 'FS': self.full_status}
+        table.get(cmd, self.error)(param, now)
+        if self.output:
+            self.send(bytes(self.output), now)
+
+    def wspr(self, command, now):
+        if len(command) == 0:
+            self.println("WS")
+            return
+        fields = command.split(',')
+        action = fields[0]
+        if action == 'TX':
+            if self.eeprom.has_magic():
+                self.timeslot = atoi(fields[1]) if len(fields) > 1 else 0
+                self.bands = atoi(fields[2]) if len(fields) > 2 else 0
+                self.println("OK")
+                self.wspr_state = waiting_for_timeslot
+                self.eeprom.put_int('state', self.wspr_state)
+                self.eeprom.put_int('interval', self.timeslot)
+                self.eeprom.put_int('band', self.bands)
+            else:
+                self.println("NC")
+        elif action == 'CA':
+            self.println("stop")
+            self.wspr_state = inactive
+            self.tx_start = None
+            self.eeprom.put_int('state', self.wspr_state)
+        elif action == 'ST':
+            if self.wspr_state == inactive:
+                self.print_("DI")
+                if self.eeprom.has_magic():
+                    self.timeslot = self.eeprom.get_uint('interval')
+                    self.bands = self.eeprom.get_uint('band')
+                    self.println(",%d,%d" % (self.timeslot, self.bands))
+                else:
+                    self.println("")
+            else:
+                state = {waiting_for_timeslot: 'WT', on_air: 'OA', tuning: 'TU'}[self.wspr_state]
+                self.println("%s,%d,%d" % (state, self.timeslot, self.bands))
+
+    def tune(self, command, now):
+        if self.wspr_state == inactive:
+            fields = command.split(',')
+            option = atoi(fields[0])
+            self.bands = atoi(fields[1]) if len(fields) > 1 else 0
+            if option == 2:
+                if self.hw == 2:
+                    self.cal_factor = -self.eeprom.get_int('xtal_offset') * 100
+                self.wspr_state = tuning
+                self.println(str(self.cal_factor))
+            else:
+                self.println("TX;")
+        elif self.wspr_state == tuning:
+            self.wspr_state = inactive
+            self.println(str(self.wspr_state))
+        else:
+            self.println(";")
+
+    def configure_wspr(self, command, now):
+        if len(command) == 0:
+            if self.eeprom.has_magic():
+                call = self.eeprom.get_str('call', 7).decode('latin-1')
+                locator = self.eeprom.get_str('locator', 5).decode('latin-1')
+                self.println("%s,%s,%d,%d" % (call, locator, self.eeprom.get_int('power'),
+                                              self.eeprom.get_int('xtal_offset')))
+            else:
+                self.println("NC")
+        else:
+            fields = command.split(',') + ['', '', '', '']
+            self.eeprom.put_str('call', fields[0].encode('latin-1'))
+            self.eeprom.put_str('locator', fields[1].encode('latin-1'))
+            self.eeprom.put_int('power', atoi(fields[2]))
+            self.eeprom.put_int('xtal_offset', atoi(fields[3]))
+            self.eeprom.put_int('state', inactive)
+            self.eeprom.put_int('interval', 2)
+            self.eeprom.put_int('band', 80)
+            self.eeprom.put_str('magic', MAGIC)
+            self.println("OK")
+            self.write(self.event_frame(wspr_proto.EVENT_CONFIG, now))
+
+    def time_sync(self, param, now):
+        if len(param) == 0:
+            self.println(str(self.now(now)))
+        else:
+            pctime = atoi(param)
+            if self.hw_clock:
+                # RTC.set() only, now() follows at the next RTC read
+                self.rtc_offset = pctime - time.time()
+                self.println("Success")
+                self.write(self.event_frame(wspr_proto.EVENT_TIME, now))
+            elif pctime >= DEFAULT_TIME:
+                self.set_time(pctime, now)
+                self.println("Success")
+                self.write(self.event_frame(wspr_proto.EVENT_TIME, now))
+            else:
+                self.println("Failed")
+
+    def query_hw(self, param, now):
+        if len(param) == 0:
+            self.println(str(self.hw))
+        else:
+            self.println("ER")
+
+    def serial_speed(self, param, now):
+        if len(param) == 0:
+            self.speed_revert_at = None
+            self.println(str(self.speed))
+            return
+        rate = atoi(param)
+        if rate in LINE_SPEEDS:
+            # The reply goes at the old speed, Serial.flush() before Serial.begin()
+            self.println("OK")
+            self.send(bytes(self.output), now)
+            self.output = bytearray()
+            self.speed = rate
+            self.speed_revert_at = now + BAUD_CONFIRM_TIME
+            self.commandbuffer = bytearray()
+            self.pos = 0
+        else:
+            self.println("ER")
+
+    def binary_mode(self, param, now):
+        if len(param) == 0:
+            self.println("1" if self.binary_frames else "0")
+        elif param in ('0', '1'):
+            self.binary_frames = param == '1'
+            self.println("OK")
+        else:
+            self.println("ER")
+
+    def full_status(self, param, now):
+        if not self.binary_frames or param:
+            self.error(param, now)
+            return
+        interval = self.timeslot
+        band = self.bands
+        call = locator = b''
+        power = offset = 0
+        configured = self.eeprom.has_magic()
+        if configured:
+            if self.wspr_state == inactive:
+                interval = self.eeprom.get_uint('interval')
+                band = self.eeprom.get_uint('band')
+            call = self.eeprom.get_str('call', 6)
+            locator = self.eeprom.get_str('locator', 3)
+            power = self.eeprom.get_int('power')
+            offset = self.eeprom.get_int('xtal_offset')
+        payload = wspr_proto.STATUS_FORMAT.pack(
+            self.now(now) & 0xffffffff, self.wspr_state, interval & 0xff, band & 0xff,
+            self.wspr_symbol, int(configured), self.hw, call, locator,
+            (power + 128 & 0xff) - 128, offset)
+        self.write(wspr_proto.make_frame(wspr_proto.FRAME_STATUS, payload))
+
+    def event_frame(self, event, now):
+        """send_event(), nothing before BM1"""
+        if not self.binary_frames:
+            return b''
+        payload = wspr_proto.EVENT_FORMAT.pack(event, self.now(now) & 0xffffffff, self.wspr_state,
+                                               self.timeslot & 0xff, self.bands & 0xff)
+        return wspr_proto.make_frame(wspr_proto.FRAME_EVENT, payload)
+
+    def error(self, param, now):
+        self.print_("?;")
+
+    def loop(self, now):
+        """Time driven part of loop() and the symbol timer"""
+        if self.wspr_state == on_air:
+            symbol = int((now - self.tx_start - TX_DELAY) / SYMBOL_TIME) + 1
+            self.wspr_symbol = max(0, min(symbol, SYMBOL_COUNT))
+            if self.wspr_symbol == SYMBOL_COUNT:
+                self.wspr_state = waiting_for_timeslot
+                self.tx_start = None
+        if self.speed_revert_at is not None and now >= self.speed_revert_at:
+            # Not confirmed, back to the speed after a reset
+            self.speed = self.baudrate or SPEED
+            self.speed_revert_at = None
+            self.commandbuffer = bytearray()
+            self.pos = 0
+        t = self.now(now)
+        if self.wspr_state == waiting_for_timeslot and self.timeslot != 0:
+            if (t // 60) % self.timeslot == 0 and t % 60 == 0 and self.last_start != t:
+                # start_wspr_transmission()
+                self.last_start = t
+                self.wspr_symbol = 0
+                self.tx_start = now
+                self.wspr_state = on_air
+        # check_state_change()
+        current = (self.wspr_state, self.timeslot, self.bands)
+        if current != self.reported:
+            self.reported = current
+            frame = self.event_frame(wspr_proto.EVENT_STATE, now)
+            if frame:
+                self.send(frame, now)
+
+    #=========================================================================#
+    # Serial line
+    #=========================================================================#
+    def byte_time(self):
+        if self.baudrate:
+            return 10.0 / self.speed
+        return 0.0
+
+    def host_speed(self):
+        """Speed the host has set on its end of the pty"""
+        try:
+            return TERMIOS_SPEEDS.get(termios.tcgetattr(self.master)[5])
+        except termios.error:
+            return None
+
+    def receive(self, data, now):
+        """Bytes written by the host, they arrive at the line speed"""
+        if self.baudrate and self.host_speed() not in (None, self.speed):
+            data = b'\xff' * len(data)
+        with self.lock:
+            self.bytes_in = self.bytes_in + len(data)
+            t = max(now, self.rx_free)
+            for ch in data:
+                t = t + self.byte_time()
+                self.rx.append((t, ch))
+            self.rx_free = t
+
+    def send(self, data, now):
+        """Bytes written by the firmware"""
+        t = max(now + self.latency, self.tx_free)
+        for ch in data:
+            t = t + self.byte_time()
+            if self.random.random() >= self.drop_rate:
+                self.tx_due.append((t, ch, self.speed))
+        self.tx_free = t
+
+    def opened(self, now):
+        self.connected = True
+        if self.reset_on_open:
+            self.reset(now)
+            self.rx.clear()
+            self.tx_due.clear()
+
+    def service(self, now):
+        """Run the firmware up to now and write the bytes that are due"""
+        with self.lock:
+            while self.rx and self.rx[0][0] <= now:
+                t, ch = self.rx.popleft()
+                if t >= self.booting_until:
+                    self.poll_serial(ch, t)
+            self.loop(now)
+            out = bytearray()
+            host_speed = self.host_speed() if self.tx_due and self.baudrate else None
+            while self.tx_due and self.tx_due[0][0] <= now:
+                t, ch, speed = self.tx_due.popleft()
+                out.append(ch if host_speed in (None, speed) else 0xff)
+        if out and self.connected:
+            self.bytes_out = self.bytes_out + len(out)
+            try:
+                os.write(self.master, bytes(out))
+            except OSError:
+                pass
+
+    def next_event(self, now):
+        """Time of the next byte to process or write"""
+        t = now + 0.05
+        with self.lock:
+            if self.rx:
+                t = min(t, self.rx[0][0])
+            if self.tx_due:
+                t = min(t, self.tx_due[0][0])
+        return t
+
+    def close(self):
+        os.close(self.master)
+
+class simulatorServer:
+    """One thread serving any number of simulated beacons"""
+    def __init__(self):
+        self.beacons = {}
+        self.poller = select.poll()
+        self.stopping = False
+        self.thread = None
+
+    def add(self, sim):
+        self.beacons[sim.master] = sim
+        self.poller.register(sim.master, select.POLLIN)
+        return sim
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='wspr-sim')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+        for sim in self.beacons.values():
+            sim.close()
+
+    def serve_forever(self):
+        while not self.stopping:
+            now = time.monotonic()
+            wake = min([sim.next_event(now) for sim in self.beacons.values()] + [now + 0.05])
+            for fd, event in self.poller.poll(max(0, (wake - now) * 1000)):
+                sim = self.beacons[fd]
+                now = time.monotonic()
+                if event & select.POLLIN:
+                    try:
+                        data = os.read(fd, 1024)
+                    except OSError:
+                        data = b''
+                    if data:
+                        if not sim.connected:
+                            sim.opened(now)
+                        sim.receive(data, now)
+                        continue
+                if event & select.POLLHUP:
+                    # Host has closed the port. A hangup is reported by every
+                    # poll, so look for the next open in check_open() instead.
+                    sim.connected = False
+                    self.poller.unregister(fd)
+            now = time.monotonic()
+            for fd, sim in self.beacons.items():
+                if not sim.connected:
+                    self.check_open(fd, sim, now)
+                sim.service(now)
+
+    def check_open(self, fd, sim, now):
+        probe = select.poll()
+        probe.register(fd, select.POLLIN)
+        events = probe.poll(0)
+        if not events or not events[0][1] & select.POLLHUP:
+            sim.opened(now)
+            self.poller.register(fd, select.POLLIN)
+
+def simulate(count = 1, **options):
+    """Start count simulated beacons in one server thread"""
+    server = simulatorServer()
+    for i in range(count):
+        server.add(simulatedBeacon(**options))
+    return server.start()
+
+if __name__ == '__main__':
+    count = 1
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    server = simulate(count)
+    for sim in server.beacons.values():
+        print(sim.device)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Analyser of WSPR spot archives, to choose the bands and intervals of the
+beacon.
+
+The monthly archives of wsprnet.org (wsprspots-YYYY-MM.csv or .csv.gz)
+hold one line per spot:
+  spot id, time, reporter, reporter grid, SNR, frequency (MHz), call,
+  grid, power, drift, distance (km), azimuth, band, version, code
+They are far too big to load. The analyser streams an archive once,
+keeps only the spots of one callsign (the one written with QC), and
+stores them as NumPy columns in a cache directory. Later runs map the
+columns from disk, so a query over months of spots takes milliseconds.
+Several archives are read in parallel, one process each.
+
+The result is aggregated per band and UTC hour: spots, transmissions
+heard, distinct reporters, and distance. hourly_plan() turns it into a
+plan for the band hopping scheduler in wspr_schedule.
+
+Usage:
+  wspr_spots.py CALL ARCHIVE [ARCHIVE ...]
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from wspr_cat import BANDS
+
+CACHE_DIR = ".fxk_wspr_spots"
+CACHE_VERSION = 3               # 1 had the spots the call reported as well, 2 missed quoted calls
+READ_BUFFER = 1 << 20
+CHUNK_LINES = 100000            # Spots converted to columns at a time
+DISTANCE_BINS = (0, 500, 1000, 2000, 5000, 10000, 20000)   # km
+
+# Column of each field in the archive lines
+TIME, REPORTER, SNR, FREQUENCY, CALL, POWER, DRIFT, DISTANCE = 1, 2, 4, 5, 6, 8, 9, 10
+
+columns = {'time': np.int64, 'band': np.int16, 'snr': np.int8, 'power': np.int8,
+           'drift': np.int8, 'distance': np.int32, 'reporter': np.int32}
+
+# Whole MHz of the frequency -> band in meters
+MHZ_TO_BAND = {1: 160, 3: 80, 5: 60, 7: 40, 10: 30, 14: 20, 18: 17, 21: 15, 24: 12, 28: 10}
+
+def cache_root():
+    if os.name == 'nt':
+        DB_DIR = os.environ["USERPROFILE"]
+    else:
+        DB_DIR = os.environ["HOME"]
+    return DB_DIR + os.sep + CACHE_DIR
+
+def cache_path(archive, call, root = None):
+    name = os.path.basename(archive)
+    for suffix in ('.gz', '.csv'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return os.path.join(root or cache_root(), name + '.' + call.replace('/', '_'))
+
+def open_archive(archive):
+    if archive.endswith('.gz'):
+        return gzip.open(archive, 'rb')
+    return open(archive, 'rb', buffering = READ_BUFFER)
+
+#=============================================================================#
+# First pass: archive -> column cache
+#=============================================================================#
+def parse_lines(lines, reporters, call):
+    """
+    Columns of the spots of call in a chunk of spot lines. Spots that call
+    reported and unknown bands are left out.
+    """
+    call = call.upper()
+    data = {name: [] for name in columns}
+    for line in lines:
+        fields = line.decode('latin-1').split(',')
+        try:
+            if fields[CALL].strip('"').upper() != call:
+                continue
+            band = MHZ_TO_BAND.get(int(float(fields[FREQUENCY])))
+            if band is None:
+                continue
+            data['time'].append(int(fields[TIME]))
+            data['band'].append(band)
+            data['snr'].append(int(fields[SNR]))
+            data['power'].append(int(fields[POWER]))
+            data['drift'].append(int(fields[DRIFT]))
+            data['distance'].append(int(fields[DISTANCE]))
+        except (ValueError, IndexError):
+            continue
+        reporter = fields[REPORTER].strip('"')
+        data['reporter'].append(reporters.setdefault(reporter, len(reporters)))
+    return {name: np.array(values, dtype=columns[name]) for name, values in data.items()}
+
+def build_cache(archive, call, root = None):
+    """
+    Read the archive once and store the spots of call as .npy columns.
+    Returns the cache directory. An up to date cache is not rebuilt.
+    """
+    path = cache_path(archive, call, root)
+    stat = os.stat(archive)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'version': CACHE_VERSION}
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f)['source'] == source:
+                return path
+    os.makedirs(path, exist_ok = True)
+    # The call is a field of its own, quoted in some archives, find it as
+    # bytes before parsing anything. It can be the reporter as well,
+    # parse_lines() checks.
+    needle = (',' + call.upper() + ',').encode('ascii')
+    quoted = (',"' + call.upper() + '",').encode('ascii')
+    reporters = {}
+    parts = []
+    chunk = []
+    with open_archive(archive) as f:
+        for line in f:
+            if needle in line or quoted in line:
+                chunk.append(line)
+                if len(chunk) >= CHUNK_LINES:
+                    parts.append(parse_lines(chunk, reporters, call))
+                    chunk = []
+    parts.append(parse_lines(chunk, reporters, call))
+    rows = 0
+    for name, dtype in columns.items():
+        values = np.concatenate([part[name] for part in parts])
+        rows = len(values)
+        np.save(os.path.join(path, name + '.npy'), values)
+    with open(os.path.join(path, 'reporters.json'), 'w') as f:
+        json.dump(sorted(reporters, key = reporters.get), f)
+    # Written last, a cache without it is rebuilt
+    with open(meta_file, 'w') as f:
+        json.dump({'source': source, 'call': call, 'rows': rows}, f)
+    return path
+
+def load_cache(path):
+    """The columns of a cache, memory mapped"""
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r') for name in columns}
+
+def load(archives, call, root = None, processes = None):
+    """
+    Spots of call in all archives as one set of columns. The archives
+    without an up to date cache are read in parallel processes.
+    """
+    call = call.upper()
+    if len(archives) > 1:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            paths = list(pool.map(build_cache, archives, [call] * len(archives),
+                                  [root] * len(archives)))
+    else:
+        paths = [build_cache(archive, call, root) for archive in archives]
+    caches = [load_cache(path) for path in paths]
+    if len(caches) == 1:
+        return caches[0]
+    # Reporter numbers are per archive, renumber them into one list
+    reporters = {}
+    renumbered = []
+    for path, cache in zip(paths, caches):
+        with open(os.path.join(path, 'reporters.json')) as f:
+            names = json.load(f)
+        mapping = np.array([reporters.setdefault(name, len(reporters)) for name in names] or [0],
+                           dtype=np.int32)
+        renumbered.append(mapping[cache['reporter']])
+    spots = {name: np.concatenate([cache[name] for cache in caches]) for name in columns}
+    spots['reporter'] = np.concatenate(renumbered)
+    return spots
+
+#=============================================================================#
+# Aggregation
+#=============================================================================#
+def aggregate(spots, bands = BANDS):
+    """
+    Statistics per band (rows, in the order of bands) and UTC hour
+    (columns):
+      spots         spots reported
+      slots         transmissions heard by at least one reporter
+      reporters     distinct reporters
+      per_slot      spots per transmission heard
+      distance      spots per distance bin (band, bin), bins DISTANCE_BINS
+      median_km     median distance per band
+      max_km        longest distance per band
+    """
+    band = np.asarray(spots['band'], dtype=np.int64)
+    # Bands in the spots but not in bands are left out
+    size = max(max(bands), int(band.max()) if len(band) else 0) + 1
+    band_index = np.full(size, -1, dtype=np.int64)
+    band_index[list(bands)] = np.arange(len(bands))
+    index = band_index[band]
+    keep = index >= 0
+    index = index[keep]
+    t = np.asarray(spots['time'])[keep]
+    hour = (t // 3600) % 24
+    cell = index * 24 + hour
+    shape = (len(bands), 24)
+    result = {'bands': list(bands)}
+    result['spots'] = np.bincount(cell, minlength = shape[0] * 24).reshape(shape)
+    # Distinct (cell, slot) and (cell, reporter) pairs, as one int64 key each
+    slot = t // 120
+    pairs = np.unique((cell << 40) | slot) >> 40
+    result['slots'] = np.bincount(pairs, minlength = shape[0] * 24).reshape(shape)
+    reporter = np.asarray(spots['reporter'], dtype=np.int64)[keep]
+    pairs = np.unique((cell << 40) | reporter) >> 40
+    result['reporters'] = np.bincount(pairs, minlength = shape[0] * 24).reshape(shape)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        result['per_slot'] = np.where(result['slots'] > 0, result['spots'] / result['slots'], 0.0)
+    distance = np.asarray(spots['distance'])[keep]
+    bins = np.searchsorted(DISTANCE_BINS, distance, side = 'right') - 1
+    result['distance'] = np.bincount(index * len(DISTANCE_BINS) + bins,
+                                     minlength = shape[0] * len(DISTANCE_BINS)
+                                     ).reshape(shape[0], len(DISTANCE_BINS))
+    result['median_km'] = np.zeros(shape[0])
+    result['max_km'] = np.zeros(shape[0])
+    for i in range(shape[0]):
+        d = distance[index == i]
+        if len(d):
+            result['median_km'][i] = np.median(d)
+            result['max_km'][i] = d.max()
+    return result
+
+def best_bands(result, min_slots = 3):
+    """
+    The band with most spots per transmission for every UTC hour, None
+    for an hour with too few transmissions to tell.
+    """
+    score = np.where(result['slots'] >= min_slots, result['per_slot'], -1.0)
+    best = []
+    for hour in range(24):
+        i = int(np.argmax(score[:, hour]))
+        best.append(result['bands'][i] if score[i, hour] >= 0 else None)
+    return best
+
+def hourly_plan(best, default = None):
+    """
+    A plan for hoppingScheduler in wspr_schedule: the band of the UTC hour
+    of the slot, from best_bands(). Hours without a band use default, by
+    default the band that is best in most hours, so the beacon keeps
+    sending where there is nothing to tell the bands apart.
+    """
+    if default is None:
+        bands = [band for band in best if band is not None]
+        if not bands:
+            raise ValueError("no band has enough transmissions heard")
+        default = max(bands, key = bands.count)
+    def plan(slot_time):
+        band = best[int(slot_time // 3600) % 24]
+        return default if band is None else band
+    return plan
+
+def report(result, best):
+    print("UTC  " + ''.join("%6dm" % band for band in result['bands']) + "   best")
+    for hour in range(24):
+        cells = ''.join("%7.1f" % result['per_slot'][i, hour] for i in range(len(result['bands'])))
+        print("%02d   %s   %s" % (hour, cells, best[hour] if best[hour] is not None else '-'))
+    print("Spots per transmission heard, per band and UTC hour")
+    for i, band in enumerate(result['bands']):
+        spots = result['spots'][i].sum()
+        if spots:
+            print("%3dm  %7d spots  %6d reporters  median %5d km  max %5d km" %
+                  (band, spots, result['reporters'][i].sum(),
+                   result['median_km'][i], result['max_km'][i]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "WSPR spot archive analyser")
+    parser.add_argument('-j', '--jobs', type = int, help = "processes reading archives")
+    parser.add_argument('-o', '--output', help = "write the hourly band plan as JSON")
+    parser.add_argument('call')
+    parser.add_argument('archives', nargs = '+')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    spots = load(args.archives, args.call, processes = args.jobs)
+    loaded = time.perf_counter()
+    result = aggregate(spots)
+    best = best_bands(result)
+    done = time.perf_counter()
+    report(result, best)
+    print("%d spots, loaded in %.2f s, aggregated in %.1f ms" %
+          (len(spots['time']), loaded - start, (done - loaded) * 1000))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'call': args.call.upper(), 'hours': best}, f, indent = 2)
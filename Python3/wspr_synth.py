@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+WSPR waveform synthesiser for a soundcard or SDR transmit path.
+
+The beacon hardware makes the WSPR signal by retuning the Si5351 or
+AD9850 for every symbol. This module makes the same signal as samples:
+continuous phase 4-FSK, as real audio at an audio offset for an SSB
+transmitter, or as complex IQ for an SDR.
+
+The samples come from a generator as NumPy chunks of a fixed size, so a
+whole transmission (110.6 s) is never held in memory and the chunks can
+be written to an audio or SDR stream as they are made. The phase is
+accumulated with a cumulative sum over each chunk and carried between
+chunks, so there are no phase jumps at symbol or chunk boundaries.
+
+The tone spacing and symbol time default to those of the WSPR standard,
+12000/8192 Hz and 8192/12000 s. The firmware uses 1.46 Hz and 683 ms,
+see FIRMWARE_TONE_SPACING and SYMBOL_TIME in wspr_cat.
+
+Usage:
+  wspr_synth.py [-r RATE] [-f OFFSET] [--iq] CALL LOCATOR DBM FILE.wav
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import argparse
+import wave
+import numpy as np
+from wspr_cat import TX_DELAY
+import wspr_encode
+
+TONE_SPACING = 12000.0 / 8192       # Hz
+SYMBOL_PERIOD = 8192.0 / 12000      # Seconds
+FIRMWARE_TONE_SPACING = 1.46        # TONE_SPACING of the firmware, in Hz
+SAMPLE_RATE = 48000
+AUDIO_OFFSET = 1500.0               # Hz, centre of the 200 Hz WSPR window in SSB
+CHUNK = 4096                        # Samples per chunk
+AMPLITUDE = 0.5
+RAMP_TIME = 0.005                   # Seconds of raised cosine at start and end
+
+def symbol_starts(count, sample_rate, symbol_period):
+    """First sample of every symbol, and the sample after the last one"""
+    return np.round(np.arange(count + 1) * symbol_period * sample_rate).astype(np.int64)
+
+def synthesize(symbols, sample_rate = SAMPLE_RATE, offset = AUDIO_OFFSET,
+               chunk = CHUNK, iq = False, amplitude = AMPLITUDE,
+               tone_spacing = TONE_SPACING, symbol_period = SYMBOL_PERIOD,
+               delay = 0.0):
+    """
+    Generator of chunks of the signal of the channel symbols (0..3).
+    Every chunk has chunk samples, float32 for audio or complex64 for IQ.
+    The tone of symbol s is offset + s * tone_spacing Hz; with IQ, offset
+    can be 0 or negative. delay seconds of silence come before the first
+    symbol, e.g. TX_DELAY when the stream is started at the slot start.
+    The last chunk is padded with silence.
+    """
+    symbols = np.asarray(symbols, dtype=np.float64)
+    lead = int(round(delay * sample_rate))
+    starts = symbol_starts(len(symbols), sample_rate, symbol_period) + lead
+    total = int(starts[-1])
+    ramp = max(1, int(RAMP_TIME * sample_rate))
+    step = 2 * np.pi / sample_rate
+    phase = 0.0
+    for first in range(0, total, chunk):
+        n = np.arange(first, first + chunk)
+        # Symbol of every sample, -1 before the first and len(symbols) after the last
+        index = np.searchsorted(starts, n, side='right') - 1
+        sending = (index >= 0) & (index < len(symbols))
+        tone = symbols[np.clip(index, 0, len(symbols) - 1)]
+        omega = (offset + tone * tone_spacing) * step
+        phases = phase + np.cumsum(omega * sending)
+        phase = float(phases[-1]) % (2 * np.pi)
+        # Raised cosine ramps keep the spectrum clean at key up and key down
+        envelope = sending * amplitude
+        rise = (n - lead) < ramp
+        if rise.any():
+            envelope = envelope * np.where(rise, 0.5 - 0.5 * np.cos(np.pi * np.clip(n - lead, 0, ramp) / ramp), 1.0)
+        fall = (total - n) < ramp
+        if fall.any():
+            envelope = envelope * np.where(fall, 0.5 - 0.5 * np.cos(np.pi * np.clip(total - n, 0, ramp) / ramp), 1.0)
+        # The phase is that at the end of the sample, start from the one before
+        phases = phases - omega * sending
+        if iq:
+            yield (envelope * np.exp(1j * phases)).astype(np.complex64)
+        else:
+            yield (envelope * np.cos(phases)).astype(np.float32)
+
+def message_stream(call, locator, dbm, **options):
+    """Chunks of the transmission of a message, as synthesize()"""
+    return synthesize(wspr_encode.encode(call, locator, dbm), **options)
+
+def slot_stream(call, locator, dbm, **options):
+    """Chunks to be played from the start of a slot, with the TX_DELAY of the firmware"""
+    options.setdefault('delay', TX_DELAY)
+    return message_stream(call, locator, dbm, **options)
+
+def write_wav(path, chunks, sample_rate = SAMPLE_RATE, iq = False):
+    """Write the chunks as 16 bit WAV, IQ as two channels. Returns the number of samples."""
+    count = 0
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(2 if iq else 1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        for chunk in chunks:
+            if iq:
+                chunk = np.column_stack((chunk.real, chunk.imag))
+            w.writeframes((np.clip(chunk, -1, 1) * 32767).astype('<i2').tobytes())
+            count = count + len(chunk)
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Write a WSPR transmission as a WAV file")
+    parser.add_argument('-r', '--rate', type = int, default = SAMPLE_RATE, help = "sample rate")
+    parser.add_argument('-f', '--offset', type = float, default = AUDIO_OFFSET,
+                        help = "frequency of tone 0 in Hz")
+    parser.add_argument('--iq', action = 'store_true', help = "complex IQ as two channels")
+    parser.add_argument('--firmware', action = 'store_true',
+                        help = "tone spacing and symbol time of the firmware")
+    parser.add_argument('call')
+    parser.add_argument('locator')
+    parser.add_argument('dbm')
+    parser.add_argument('file')
+    args = parser.parse_args()
+    options = {'sample_rate': args.rate, 'offset': args.offset, 'iq': args.iq}
+    if args.firmware:
+        from wspr_cat import SYMBOL_TIME
+        options['tone_spacing'] = FIRMWARE_TONE_SPACING
+        options['symbol_period'] = SYMBOL_TIME
+    for problem in wspr_encode.validate(args.call, args.locator, args.dbm):
+        print("Warning: " + problem)
+    count = write_wav(args.file, message_stream(args.call, args.locator, args.dbm, **options),
+                      args.rate, args.iq)
+    print("%d samples, %.1f s" % (count, count / float(args.rate)))
@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Record and replay of the serial traffic of the WSPR beacon.
+
+A trace holds every byte written to and read from the beacon with a
+monotonic timestamp, so what happened on a real link (replies split over
+several reads, stray bell characters, garbage after a reset) can be
+played back to the host code as often as needed.
+
+The file has a fixed header, HEADER, followed by records of RECORD and
+the data: time in microseconds since the start of the trace, kind and
+length. Recording is a struct.pack() and a buffered write, cheap enough
+to leave on. Set WSPR_TRACE to a file or a directory to record the
+sessions of the GUI or wspr_server.
+
+traceReplay plays a trace back as a serial port: the bytes read become
+readable after the write that came before them, as fast as possible or
+with the timing of the trace. What the host writes is compared with the
+trace, so a difference in the commands sent shows up as a mismatch.
+replayBeacon is a wspr_cat.beacon that opens the trace instead of a port.
+
+Usage:
+  wspr_trace.py dump TRACE                   Print the records
+  wspr_trace.py replay [--realtime] TRACE    Send the recorded commands again
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import struct
+import threading
+import time
+import serial
+from wspr_cat import beacon, fixedPort, SPEED, READ_TIMEOUT
+from wspr_proto import is_error
+
+MAGIC = b'FXKTRACE'
+VERSION = 1
+HEADER = struct.Struct('<8sHHdI')   # magic, version, flags, wall clock start, baud rate
+RECORD = struct.Struct('<QBH')      # microseconds since start, kind, length
+MAX_DATA = 0xffff
+FLUSH_INTERVAL = 5.0                # Seconds buffered data may wait
+BUFFERING = 1 << 16
+
+# Record kinds
+WRITE, READ, OPEN, CLOSE = range(1, 5)
+KIND_NAMES = {WRITE: 'write', READ: 'read', OPEN: 'open', CLOSE: 'close'}
+
+#=============================================================================#
+# Recording
+#=============================================================================#
+class traceWriter:
+    """
+    Recorder given to beacon as its trace. The methods are called by
+    beacon when it opens, closes, writes and reads the port.
+    """
+    def __init__(self, path, baudrate = SPEED):
+        self.file = open(path, 'wb', buffering = BUFFERING)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.flushed = self.start
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, time.time(), baudrate))
+
+    def record(self, kind, data = b''):
+        with self.lock:
+            if self.file is None:
+                return
+            now = time.monotonic()
+            t = int((now - self.start) * 1000000)
+            for first in range(0, max(len(data), 1), MAX_DATA):
+                part = data[first:first + MAX_DATA]
+                self.file.write(RECORD.pack(t, kind, len(part)))
+                self.file.write(part)
+            if kind == CLOSE or now - self.flushed > FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushed = now
+
+    def opened(self, port):
+        self.record(OPEN, str(port).encode('utf-8'))
+
+    def closed(self):
+        self.record(CLOSE)
+
+    def sent(self, data):
+        self.record(WRITE, bytes(data))
+
+    def received(self, data):
+        self.record(READ, bytes(data))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def from_env():
+    """A traceWriter when WSPR_TRACE is set, a new file per run if it is a directory"""
+    path = os.environ.get('WSPR_TRACE')
+    if not path:
+        return None
+    if os.path.isdir(path):
+        path = os.path.join(path, time.strftime("fxk_wspr_%Y%m%d-%H%M%S.trace"))
+    try:
+        trace = traceWriter(path)
+    except OSError as e:
+        print("Cannot record trace: " + str(e))
+        return None
+    print("Recording serial trace in " + path)
+    return trace
+
+#=============================================================================#
+# Reading
+#=============================================================================#
+def read_trace(path):
+    """(header, records), header as a dict and records as (seconds, kind, data)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, flags, started, baudrate = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path + " is not a trace of version %d" % VERSION)
+    header = {'started': started, 'baudrate': baudrate, 'flags': flags}
+    records = []
+    view = memoryview(data)
+    position = HEADER.size
+    while position + RECORD.size <= len(data):
+        t, kind, length = RECORD.unpack_from(data, position)
+        position = position + RECORD.size
+        if position + length > len(data):
+            break       # Cut short, the recorder was killed
+        records.append((t / 1000000.0, kind, bytes(view[position:position + length])))
+        position = position + length
+    return header, records
+
+#=============================================================================#
+# Replay
+#=============================================================================#
+class traceReplay:
+    """
+    A trace played back as the ports of the sessions in it. With realtime
+    the bytes read come with the delays of the trace, counted from the
+    write before them, otherwise as soon as the write has been made.
+    """
+    def __init__(self, path, realtime = False):
+        self.header, self.records = read_trace(path)
+        self.realtime = realtime
+        self.position = 0
+        self.mismatches = []        # (record number, recorded, written)
+
+    def next_index(self, kinds):
+        for i in range(self.position, len(self.records)):
+            if self.records[i][1] in kinds:
+                return i
+        return None
+
+    def open(self):
+        """The port of the next session in the trace"""
+        i = self.next_index((OPEN,))
+        if i is None:
+            raise serial.SerialException("end of trace")
+        self.position = i + 1
+        return replayPort(self, self.records[i][0])
+
+    def done(self):
+        return self.next_index((WRITE, OPEN)) is None
+
+class replayPort:
+    """The part of the serial.Serial interface that beacon uses"""
+    def __init__(self, replay, t):
+        self.replay = replay
+        self.timeout = READ_TIMEOUT
+        self.buffer = bytearray()
+        self.is_open = True
+        self.sync(t)
+
+    def sync(self, t):
+        """Trace time t is now"""
+        self.base = t - time.monotonic()
+
+    def fetch(self):
+        """Move the bytes that have arrived by now into the buffer"""
+        replay = self.replay
+        records = replay.records
+        now = time.monotonic() + self.base
+        while replay.position < len(records):
+            t, kind, data = records[replay.position]
+            if kind != READ or (replay.realtime and t > now):
+                break
+            self.buffer += data
+            replay.position = replay.position + 1
+
+    def check_open(self):
+        if not self.is_open:
+            raise serial.SerialException("port closed")
+
+    @property
+    def in_waiting(self):
+        self.check_open()
+        self.fetch()
+        return len(self.buffer)
+
+    def read(self, size = 1):
+        self.check_open()
+        if size == 0:
+            return b''
+        self.fetch()
+        if not self.buffer:
+            replay = self.replay
+            delay = self.timeout
+            if replay.realtime and replay.position < len(replay.records):
+                t, kind, data = replay.records[replay.position]
+                if kind == READ:
+                    delay = min(delay, max(0.0, t - time.monotonic() - self.base))
+            # Nothing more before the next write: the beacon did not answer
+            time.sleep(delay)
+            self.fetch()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def write(self, data):
+        self.check_open()
+        replay = self.replay
+        i = replay.next_index((WRITE, OPEN, CLOSE))
+        if i is None or replay.records[i][1] != WRITE:
+            # The link was lost at this point of the trace
+            replay.position = len(replay.records) if i is None else i
+            raise serial.SerialException("write failed in trace")
+        t, kind, recorded = replay.records[i]
+        if recorded != bytes(data):
+            replay.mismatches.append((i, recorded, bytes(data)))
+        # What was read before the write has arrived and stays unread, as
+        # on a real port, until the host reads it or resets the input
+        for t_read, kind, received in replay.records[replay.position:i]:
+            if kind == READ:
+                self.buffer += received
+        replay.position = i + 1
+        self.sync(t)
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.check_open()
+        self.fetch()
+        self.buffer = bytearray()
+
+    def close(self):
+        self.is_open = False
+
+class replayBeacon(beacon):
+    """A beacon that talks to a trace instead of a serial port"""
+    def __init__(self, path, realtime = False):
+        self.replay = traceReplay(path, realtime)
+        beacon.__init__(self, fixedPort('replay://' + path))
+
+    def open_port(self, port):
+        return self.replay.open()
+
+def commands_of(data):
+    """(cat_cmd, parameters) of the commands in one write"""
+    commands = []
+    for command in data.decode('latin-1').split(';')[:-1]:
+        parameters = command[2:].split(',') if len(command) > 2 else []
+        commands.append((command[:2], parameters))
+    return commands
+
+def replay_commands(path, realtime = False):
+    """
+    Send the commands of the trace again through a replayBeacon.
+    Returns (beacon, typed replies).
+    """
+    wsprdev = replayBeacon(path, realtime)
+    replay = wsprdev.replay
+    replies = []
+    while not replay.done():
+        i = replay.next_index((WRITE, OPEN))
+        if replay.records[i][1] == OPEN:
+            wsprdev.connect()
+        elif wsprdev.arduino is None:
+            # Written after a reconnect the trace has no open for
+            replay.position = i + 1
+        else:
+            commands = commands_of(replay.records[i][2])
+            batch = wsprdev.query_batch(commands)
+            for (cat_cmd, parameters), reply in zip(commands, batch):
+                if cat_cmd == 'BM' and parameters and not is_error(reply):
+                    # As enable_binary(), the events are told from the replies
+                    wsprdev.binary = parameters[0] == '1'
+            replies.extend(batch)
+    wsprdev.close()
+    return wsprdev, replies
+
+def dump(path):
+    header, records = read_trace(path)
+    print("Started %s, %d baud, %d records" %
+          (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header['started'])),
+           header['baudrate'], len(records)))
+    for t, kind, data in records:
+        print("%12.6f %-5s %r" % (t, KIND_NAMES.get(kind, kind), data))
+
+if __name__ == '__main__':
+    import argparse
+    import wspr_proto
+    parser = argparse.ArgumentParser(description = "Serial traces of the WSPR beacon")
+    parser.add_argument('action', choices = ('dump', 'replay'))
+    parser.add_argument('--realtime', action = 'store_true', help = "replay with the timing of the trace")
+    parser.add_argument('trace')
+    args = parser.parse_args()
+    if args.action == 'dump':
+        dump(args.trace)
+    else:
+        start = time.perf_counter()
+        wsprdev, replies = replay_commands(args.trace, args.realtime)
+        elapsed = time.perf_counter() - start
+        errors = [reply for reply in replies if wspr_proto.is_error(reply)]
+        print("%d commands replayed in %.3f s, %d error replies, %d mismatching writes" %
+              (len(replies), elapsed, len(errors), len(wsprdev.replay.mismatches)))
+        for i, recorded, written in wsprdev.replay.mismatches:
+            print("  record %d: recorded %r, written %r" % (i, recorded, written))
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Tuning words and frequency errors of the beacon synthesisers.
+
+The firmware computes the synthesiser settings at every slot start:
+  - AD9850: FreqWord = freq * pow(2,32) / xtal_fq with xtal_fq = fCLK -
+    offset, and the tone offsets OffsetFreq[] from 1.46, 2.93 and 4.39
+    Hz, in the 32 bit float arithmetic of the AVR. The frequency and
+    clock are rounded to 24 bit floats before the word is truncated, so
+    the carrier is off by up to about 2 Hz, 0.7 Hz with offset 0, above
+    or below depending on the band and the offset.
+  - Si5351: set_correction(-offset * 100) in parts per billion, PLLA fixed
+    at 800 MHz and set_freq(freq * 100 + symbol * 146) in 0.01 Hz, with
+    the fractional dividers of the Etherkit library (denominator 1048575).
+This module repeats those computations for every band, all four tones
+and a whole range of calibration offsets at once, with NumPy arrays, so
+the frequencies a configuration sends are known without a trial
+transmission, and a calibration is a lookup in a table.
+
+The firmware puts the carrier at the low edge of the 200 Hz WSPR window
+of every band, so a carrier that comes out low is outside the window.
+check() flags that, as well as tone spacings that are off.
+
+Usage:
+  wspr_tuning.py [--hw 1|2] [--offset N] [--measured HZ --band M]
+
+ License
+ -------
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import argparse
+import numpy as np
+from wspr_cat import BANDS
+
+# Carrier of every band, band_to_frequency() of the firmware. It is
+# the low edge of the WSPR window, dial frequency + 1400 Hz.
+BAND_FREQUENCY = {160: 1838000, 80: 3570000, 60: 5288600, 40: 7040000,
+                  30: 10140100, 20: 14097000, 17: 18106000, 15: 21096000,
+                  12: 24926000, 10: 28126000}
+WINDOW = 200.0                  # Hz, width of the WSPR window
+WSPR_SPACING = 12000.0 / 8192   # Hz, tone spacing of the WSPR standard
+SPACING_TOLERANCE = 0.02        # Hz the tone spacing may be off
+HW_AD9850 = '1'                 # QH replies, see HW_NAMES
+HW_SI5351 = '2'
+
+# AD9850
+FCLK = 125000000                # fCLK of the firmware
+AD9850_TONES = (0.0, 1.46, 2.93, 4.39)
+
+# Si5351 and the Etherkit library
+XTAL_FREQ = 25000000
+FREQ_MULT = 100                 # set_freq() takes 0.01 Hz
+PLL_FIXED = 800000000 * FREQ_MULT
+RFRAC_DENOM = 1048575
+SI5351_TONE_SPACING = 146       # TONE_SPACING of the firmware, 0.01 Hz
+
+OFFSETS = np.arange(-2000, 2001)
+
+def trunc_div(a, b):
+    """Integer division that rounds towards zero, as in C"""
+    q = np.abs(a) // np.abs(b)
+    return np.where((a < 0) != (b < 0), -q, q)
+
+#=============================================================================#
+# AD9850
+#=============================================================================#
+def ad9850_words(freq, offsets):
+    """
+    FreqWord and the four tone words for each offset, in the float
+    arithmetic of the firmware (double is 32 bits on the AVR).
+    Returns (offsets, 4) uint32 words.
+    """
+    xtal = np.asarray(FCLK - np.asarray(offsets), dtype=np.float32)
+    scale = np.float32(2.0 ** 32)
+    word = (np.float32(freq) * scale / xtal).astype(np.uint32)
+    tone = np.array([(np.float32(t) * scale / xtal) for t in AD9850_TONES])
+    # OffsetFreq[] is unsigned int, 16 bits on the AVR
+    tone = tone.astype(np.uint32) & 0xffff
+    return word[:, None] + tone.T
+
+def ad9850_frequency(words, clock):
+    """Output frequency of a tuning word with the real clock frequency"""
+    return words.astype(np.float64) * np.asarray(clock, dtype=np.float64)[:, None] / 2.0 ** 32
+
+#=============================================================================#
+# Si5351
+#=============================================================================#
+def si5351_reference(offsets):
+    """The crystal frequency the library assumes after set_correction(), in 0.01 Hz"""
+    ref = np.int64(XTAL_FREQ * FREQ_MULT)
+    correction = -np.asarray(offsets, dtype=np.int64) * 100
+    q = trunc_div(correction << 31, np.int64(1000000000))
+    return ref + ((q * ref) >> 31)
+
+def si5351_pll(offsets):
+    """PLLA feedback ratio a + b/c for each offset"""
+    ref = si5351_reference(offsets)
+    a = PLL_FIXED // ref
+    b = (PLL_FIXED % ref) * RFRAC_DENOM // ref
+    return a + b / float(RFRAC_DENOM)
+
+def si5351_divider(freq):
+    """Multisynth ratio a + b/c for the output frequencies freq, in 0.01 Hz"""
+    freq = np.asarray(freq, dtype=np.int64)
+    a = PLL_FIXED // freq
+    b = (PLL_FIXED % freq) * RFRAC_DENOM // freq
+    return a + b / float(RFRAC_DENOM)
+
+def si5351_frequency(freq, offsets, xtal):
+    """
+    (offsets, 4) output frequencies of the four tones on carrier freq
+    when the crystal really runs at xtal Hz
+    """
+    tones = freq * FREQ_MULT + np.arange(4) * SI5351_TONE_SPACING
+    pll = si5351_pll(offsets)
+    xtal = np.asarray(xtal, dtype=np.float64)
+    return (xtal * pll)[:, None] / si5351_divider(tones)[None, :]
+
+#=============================================================================#
+# Planner
+#=============================================================================#
+def calibrated_clock(hw, offsets):
+    """The reference frequency for which offsets is the right calibration"""
+    offsets = np.asarray(offsets)
+    if hw == HW_AD9850:
+        return (FCLK - offsets).astype(np.float64)
+    return si5351_reference(offsets) / float(FREQ_MULT)
+
+def tone_frequencies(hw, band, offsets = OFFSETS, clock = None):
+    """
+    (offsets, 4) frequencies of the tones on band for each calibration
+    offset. clock is the real reference frequency (Hz) for each offset;
+    by default the one the offset calibrates for.
+    """
+    offsets = np.atleast_1d(offsets)
+    freq = BAND_FREQUENCY[band]
+    if clock is None:
+        clock = calibrated_clock(hw, offsets)
+    clock = np.broadcast_to(np.asarray(clock, dtype=np.float64), offsets.shape)
+    if hw == HW_AD9850:
+        return ad9850_frequency(ad9850_words(freq, offsets), clock)
+    return si5351_frequency(freq, offsets, clock)
+
+def plan(hw, offsets = OFFSETS, bands = BANDS):
+    """
+    Table of every band: {band: (offsets, 4) tone frequencies} when the
+    offset matches the reference, i.e. the errors that are left after a
+    perfect calibration.
+    """
+    return {band: tone_frequencies(hw, band, offsets) for band in bands}
+
+def check(hw, offset, bands = BANDS, clock = None):
+    """Problems of the signal with this offset, as a list of messages"""
+    problems = []
+    for band in bands:
+        tones = tone_frequencies(hw, band, [offset], None if clock is None else [clock])[0]
+        low = BAND_FREQUENCY[band]
+        error = tones[0] - low
+        if tones[0] < low or tones[3] > low + WINDOW:
+            problems.append("%d m: carrier %.3f Hz is %.3f Hz outside the WSPR window" %
+                            (band, tones[0], error))
+        spacing = np.diff(tones)
+        worst = np.max(np.abs(spacing - WSPR_SPACING))
+        if worst > SPACING_TOLERANCE:
+            problems.append("%d m: tone spacing %s Hz, %.3f Hz off" %
+                            (band, ' '.join("%.4f" % s for s in spacing), worst))
+    return problems
+
+def calibrate(hw, band, measured, offset, offsets = OFFSETS):
+    """
+    The offset that puts the carrier of band closest to its nominal
+    frequency, from a carrier measured (e.g. in tune mode) with the
+    offset used then. The real reference follows from the measurement,
+    the rest is a lookup in the table of all offsets.
+    """
+    ratio = measured / tone_frequencies(hw, band, [offset])[0][0]
+    clock = calibrated_clock(hw, [offset])[0] * ratio
+    offsets = np.asarray(offsets)
+    carriers = tone_frequencies(hw, band, offsets, np.full(offsets.shape, clock))[:, 0]
+    # Just above the low window edge is best, below it is out of the window
+    error = carriers - BAND_FREQUENCY[band]
+    error = np.where(error < 0, np.inf, error)
+    return int(offsets[np.argmin(error)])
+
+def report(hw, offset):
+    print("Band   Carrier Hz          Error     Tone spacing Hz")
+    for band in BANDS:
+        tones = tone_frequencies(hw, band, [offset])[0]
+        print("%3d m  %-18.3f %8.3f Hz  %s" % (band, tones[0], tones[0] - BAND_FREQUENCY[band],
+                                             ' '.join("%.4f" % s for s in np.diff(tones))))
+    for problem in check(hw, offset):
+        print("Warning: " + problem)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Tuning words and frequency errors")
+    parser.add_argument('--hw', default = HW_SI5351, choices = (HW_AD9850, HW_SI5351),
+                        help = "1 AD9850, 2 Si5351, as QH")
+    parser.add_argument('--offset', type = int, default = 0, help = "calibration offset")
+    parser.add_argument('--measured', type = float, help = "carrier measured in tune mode, Hz")
+    parser.add_argument('--band', type = int, default = 30, help = "band of the measurement")
+    args = parser.parse_args()
+    offset = args.offset
+    if args.measured is not None:
+        offset = calibrate(args.hw, args.band, args.measured, args.offset)
+        print("Calibration offset %d" % offset)
+    report(args.hw, offset)
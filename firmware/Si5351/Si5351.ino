@@ -86,6 +86,20 @@ TODO
 
 #define BUFFER_SIZE 80
 
+#define DEFAULT_BAUD            9600          // Rate after reset, and the rate to fall back to
+#define BAUD_CONFIRM_TIME       2000          // ms the host has to confirm a new rate with QB
+
+// Binary frames: FRAME_START, type, length, payload, CRC-16/CCITT of type,
+// length and payload, low byte first. Only sent after BM1;
+#define FRAME_START             0xA5
+#define FRAME_STATUS            1             // Reply to FS
+#define STATUS_LENGTH           28
+#define FRAME_EVENT             2             // Sent by the beacon on a change
+#define EVENT_LENGTH            8
+#define EVENT_STATE             1             // wspr_state, interval or band changed
+#define EVENT_CONFIG            2             // QC written
+#define EVENT_TIME              3             // Clock set with QT
+
 enum request_type {get_request, set_request};
 enum wspr_state_t {inactive, waiting_for_timeslot, on_air, tuning};
 #define member_size(type, member) sizeof(((type *)0)->member)
@@ -135,6 +149,10 @@ static void  error(char*);
 static void tune(char*);
 static void configure_wspr(char*);
 static void query_hw(char*);
+static void serial_speed(char*);
+static void binary_mode(char*);
+static void full_status(char*);
+void send_event(uint8_t);
 
 void call_after (unsigned int, void (*) ());
 
@@ -146,6 +164,9 @@ cmd_entry cmd_table[] = {
                          {"QC", configure_wspr},
                          {"QT", time_sync},
                          {"QH", query_hw},
+                         {"QB", serial_speed},
+                         {"BM", binary_mode},
+                         {"FS", full_status},
                          {"",   error} };
 #ifdef SI5351
 Si5351 si5351;
@@ -193,6 +214,15 @@ si5351_drive output_level = SI5351_DRIVE_4MA; //SI5351_DRIVE_2MA, SI5351_DRIVE_4
 
 char commandbuffer[BUFFER_SIZE];
 
+unsigned long baud_rate = DEFAULT_BAUD;
+unsigned long baud_set_at;
+bool baud_pending = false;
+
+bool binary_frames = false;
+wspr_state_t reported_state = inactive;
+unsigned int reported_interval;
+unsigned int reported_band;
+
 
 #ifdef AD9850DDS
 
@@ -394,6 +424,7 @@ void configure_wspr(char* cmd)
        eeprom_address = (int)offsetof(flash_layout, magic);
        eestrput(eeprom_address, MAGIC);
        Serial.println("OK");
+       send_event(EVENT_CONFIG);
 
        
   break;
@@ -498,7 +529,10 @@ void time_sync(char *param)
 #endif
 
           if(result == 0)
+          {
              Serial.println("Success");
+             send_event(EVENT_TIME);
+          }
           else
             Serial.println("Failed");
       break;
@@ -898,6 +932,208 @@ void query_hw(char *cmd)
     }
 }
 
+//======================================================================
+// serial_speed
+// QB<rate> switches to a new rate after the reply. The host must confirm
+// it with QB at the new rate within BAUD_CONFIRM_TIME, else the beacon
+// goes back to DEFAULT_BAUD. The rate is not stored, a reset always
+// starts at DEFAULT_BAUD.
+//======================================================================
+void serial_speed(char *cmd)
+{
+    unsigned long rate;
+    switch(request(cmd))
+    {
+        case get_request:
+            baud_pending = false;
+            Serial.println(baud_rate);
+        break;
+
+        case set_request:
+            rate = atol(cmd);
+            if(rate == 9600 || rate == 19200 || rate == 38400 || rate == 57600 || rate == 115200)
+            {
+                Serial.println("OK");
+                Serial.flush();
+                Serial.begin(rate);
+                baud_rate = rate;
+                baud_pending = true;
+                baud_set_at = millis();
+                pos = 0;
+            }
+            else
+                Serial.println("ER");
+        break;
+    }
+}
+
+void check_serial_speed()
+{
+    // Unsigned subtraction, right across the wrap of millis() after 49 days
+    if(baud_pending && millis() - baud_set_at >= BAUD_CONFIRM_TIME)
+    {
+        // Not confirmed, the host cannot hear us
+        Serial.begin(DEFAULT_BAUD);
+        baud_rate = DEFAULT_BAUD;
+        baud_pending = false;
+        pos = 0;
+    }
+}
+
+//======================================================================
+// binary_mode
+// BM1 lets the beacon send binary frames, BM0 turns them off. Not
+// stored, the beacon starts in plain text mode after a reset.
+//======================================================================
+void binary_mode(char *cmd)
+{
+    switch(request(cmd))
+    {
+        case get_request:
+            Serial.println(binary_frames ? "1" : "0");
+        break;
+
+        case set_request:
+            if(strcmp(cmd, "0") == 0 || strcmp(cmd, "1") == 0)
+            {
+                binary_frames = (cmd[0] == '1');
+                Serial.println("OK");
+            }
+            else
+                Serial.println("ER");
+        break;
+    }
+}
+
+uint16_t crc16_update(uint16_t crc, uint8_t data)
+{
+    crc ^= (uint16_t)data << 8;
+    for(int i = 0; i < 8; i++)
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    return crc;
+}
+
+void send_frame(uint8_t type, const uint8_t *payload, uint8_t length)
+{
+    uint16_t crc = 0xFFFF;
+    crc = crc16_update(crc, type);
+    crc = crc16_update(crc, length);
+    Serial.write(FRAME_START);
+    Serial.write(type);
+    Serial.write(length);
+    for(int i = 0; i < length; i++)
+    {
+        crc = crc16_update(crc, payload[i]);
+        Serial.write(payload[i]);
+    }
+    Serial.write(crc & 0xff);
+    Serial.write(crc >> 8);
+}
+
+void put_long(uint8_t *p, long value)
+{
+    for(int i = 0; i < 4; i++, value >>= 8)
+        p[i] = value & 0xff;
+}
+
+//======================================================================
+// send_event
+// An event frame, only after BM1. The host learns of a change as it
+// happens instead of polling for it:
+//   0  event         uint8   EVENT_STATE, EVENT_CONFIG or EVENT_TIME
+//   1  time          uint32  now()
+//   5  state         uint8   wspr_state_t
+//   6  interval      uint8   minutes
+//   7  band          uint8   meters
+//======================================================================
+void send_event(uint8_t event)
+{
+    uint8_t payload[EVENT_LENGTH];
+
+    if(!binary_frames)
+        return;
+    payload[0] = event;
+    put_long(&payload[1], now());
+    payload[5] = wspr_state;
+    payload[6] = timeslot;
+    payload[7] = bands;
+    send_frame(FRAME_EVENT, payload, EVENT_LENGTH);
+}
+
+// Called from loop(), after the commands and the symbol timer have run
+void check_state_change()
+{
+    if(wspr_state != reported_state || timeslot != reported_interval || bands != reported_band)
+    {
+        reported_state = wspr_state;
+        reported_interval = timeslot;
+        reported_band = bands;
+        send_event(EVENT_STATE);
+    }
+}
+
+//======================================================================
+// full_status
+// Everything the host polls for in one frame, little endian:
+//   0  time          uint32  now()
+//   4  state         uint8   wspr_state_t
+//   5  interval      uint8   minutes
+//   6  band          uint8   meters
+//   7  symbol        uint8   symbols sent of this transmission
+//   8  configured    uint8   1 when QC has been written
+//   9  hw            uint8   as QH
+//  10  call          char[8] NUL padded
+//  18  locator       char[5] NUL padded
+//  23  power         int8    dBm
+//  24  xtal_offset   int32
+//======================================================================
+void full_status(char *cmd)
+{
+    uint8_t payload[STATUS_LENGTH];
+    unsigned int interval = timeslot;
+    unsigned int band = bands;
+    int tmp_int;
+    char tmp_str[LENGTH_CALL + 1];
+
+    if(!binary_frames || request(cmd) == set_request)
+    {
+        error(cmd);
+        return;
+    }
+    memset(payload, 0, sizeof(payload));
+    put_long(&payload[0], now());
+    payload[4] = wspr_state;
+    payload[7] = wspr_symbol;
+#ifdef AD9850DDS
+    payload[9] = 1;
+#endif
+#ifdef SI5351
+    payload[9] = 2;
+#endif
+    eestrget((int)offsetof(flash_layout, magic), tmp_str, LENGTH_MAGIC - 2);
+    if(strcmp(tmp_str, MAGIC) == 0)
+    {
+        payload[8] = 1;
+        if(wspr_state == inactive)
+        {
+            // As WS ST, the stored ones when not sending
+            EEPROM.get((int)offsetof(flash_layout, interval), interval);
+            EEPROM.get((int)offsetof(flash_layout, band), band);
+        }
+        eestrget((int)offsetof(flash_layout, call), tmp_str, LENGTH_CALL - 2);
+        strncpy((char *)&payload[10], tmp_str, LENGTH_CALL);
+        eestrget((int)offsetof(flash_layout, locator), tmp_str, LENGTH_LOCATOR - 2);
+        strncpy((char *)&payload[18], tmp_str, LENGTH_LOCATOR);
+        EEPROM.get((int)offsetof(flash_layout, power), tmp_int);
+        payload[23] = (int8_t)tmp_int;
+        EEPROM.get((int)offsetof(flash_layout, xtal_offset), tmp_int);
+        put_long(&payload[24], tmp_int);
+    }
+    payload[5] = interval;
+    payload[6] = band;
+    send_frame(FRAME_STATUS, payload, STATUS_LENGTH);
+}
+
 //======================================================================
 //
 //======================================================================
@@ -966,7 +1202,7 @@ void setup()
   
   
   
-  Serial.begin(9600);
+  Serial.begin(DEFAULT_BAUD);
 
   // Set time sync provider
 #ifdef HW_CLOCK
@@ -1011,4 +1247,6 @@ void loop()
     start_wspr_transmission();
   }
   poll_mstimer();
+  check_serial_speed();
+  check_state_change();
 }
@@ -0,0 +1,75 @@
+// Host build of the WSPR beacon firmware: the parts of the Arduino core
+// that Si5351.ino uses, for Linux.
+//
+// millis() runs on a simulated clock, real time multiplied by the speed
+// given to the host program. Serial is the master side of a pseudo
+// terminal, so the host code opens the slave exactly like /dev/ttyACM0.
+// Pin writes and the synthesiser calls are written to the event log.
+/* License
+   -------
+ * This sketch  is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * You should have received a copy of the GNU General Public License.
+ * If not, see <http://www.gnu.org/licenses/>.
+*/
+#ifndef HOST_ARDUINO_H
+#define HOST_ARDUINO_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+
+typedef uint8_t byte;
+typedef bool boolean;
+
+#define HIGH    1
+#define LOW     0
+#define INPUT   0
+#define OUTPUT  1
+#define DEC     10
+#define HEX     16
+
+unsigned long millis();
+void pinMode(uint8_t pin, uint8_t mode);
+void digitalWrite(uint8_t pin, uint8_t value);
+
+// Written by the host program, one line per event: "<millis> <event> ..."
+void host_log(const char *format, ...);
+
+class HardwareSerial
+{
+public:
+    void begin(unsigned long baud);
+    void flush();
+    int available();
+    int read();
+    size_t write(uint8_t c);
+    size_t print(const char *s);
+    size_t print(char c);
+    size_t print(int n, int base = DEC);
+    size_t print(unsigned int n, int base = DEC);
+    size_t print(long n, int base = DEC);
+    size_t print(unsigned long n, int base = DEC);
+    size_t println();
+    size_t println(const char *s);
+    size_t println(char c);
+    size_t println(int n, int base = DEC);
+    size_t println(unsigned int n, int base = DEC);
+    size_t println(long n, int base = DEC);
+    size_t println(unsigned long n, int base = DEC);
+};
+
+extern HardwareSerial Serial;
+
+void setup();
+void loop();
+
+#endif
@@ -0,0 +1,19 @@
+// Host build: DS3231 real time clock. It starts at the host time and runs
+// on the simulated clock. set() restarts the one second countdown, like
+// a write of the seconds register does.
+#ifndef HOST_DS3232RTC_H
+#define HOST_DS3232RTC_H
+
+#include <stdint.h>
+#include <time.h>
+
+class DS3232RTC
+{
+public:
+    static time_t get();
+    static uint8_t set(time_t t);
+};
+
+extern DS3232RTC RTC;
+
+#endif
@@ -0,0 +1,39 @@
+// Host build: EEPROM of an Arduino UNO, kept in memory and optionally in
+// a file that is written through, so the configuration survives a
+// restart of the host program like it survives a power cycle. int is 32
+// bits here, so flash_layout and the image are not laid out as on the AVR.
+#ifndef HOST_EEPROM_H
+#define HOST_EEPROM_H
+
+#include <stdint.h>
+#include <string.h>
+
+#define EEPROM_SIZE 1024
+
+class EEPROMClass
+{
+public:
+    uint8_t read(int address);
+    void write(int address, uint8_t value);
+
+    template <typename T> T &get(int address, T &value)
+    {
+        for (size_t i = 0; i < sizeof(T); i++)
+            ((uint8_t *)&value)[i] = read(address + i);
+        return value;
+    }
+
+    template <typename T> const T &put(int address, const T &value)
+    {
+        for (size_t i = 0; i < sizeof(T); i++)
+            write(address + i, ((const uint8_t *)&value)[i]);
+        return value;
+    }
+};
+
+extern EEPROMClass EEPROM;
+
+// Erased (0xff) or loaded from path, and written through to it
+void eeprom_open(const char *path);
+
+#endif
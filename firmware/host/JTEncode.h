@@ -0,0 +1,16 @@
+// Host build: WSPR encoding as JTEncode does it, the same steps as
+// Python3/wspr_encode.py, so the symbols sent can be compared.
+#ifndef HOST_JTENCODE_H
+#define HOST_JTENCODE_H
+
+#include <stdint.h>
+
+#define WSPR_SYMBOL_COUNT 162
+
+class JTEncode
+{
+public:
+    void wspr_encode(const char *call, const char *loc, const int8_t dbm, uint8_t *symbols);
+};
+
+#endif
@@ -0,0 +1,18 @@
+// Host build: the part of the Time library that the firmware uses. now()
+// counts seconds from millis() and reads the sync provider every five
+// minutes, as the library does.
+#ifndef HOST_TIMELIB_H
+#define HOST_TIMELIB_H
+
+#include <time.h>
+
+typedef time_t (*getExternalTime)();
+
+time_t now();
+void setTime(time_t t);
+int minute();
+int second();
+void setSyncProvider(getExternalTime getTimeFunction);
+void setSyncInterval(time_t interval);
+
+#endif
@@ -0,0 +1,4 @@
+// Host build: nothing is on an I2C bus, see si5351.h and DS3232RTC.h
+#ifndef HOST_WIRE_H
+#define HOST_WIRE_H
+#endif
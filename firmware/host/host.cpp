@@ -0,0 +1,354 @@
+// Host build of the WSPR beacon firmware: simulated clock, Serial on a
+// pseudo terminal, event log and the main program that runs setup() and
+// loop() of the unmodified Si5351.ino.
+//
+// Usage: fxk_wspr_host [-s SPEED] [-t TIME] [-e EEPROM_FILE] [-l LOG_FILE]
+//   -s  speed of the simulated clock, 1 is real time
+//   -t  time the real time clock starts at, default the host time
+//   -e  file that keeps the EEPROM between runs
+//   -l  event log: pin writes, synthesiser calls, serial bytes
+// The path of the serial device is printed on stdout when it is ready.
+//
+// The bytes from the pty are paced to the line speed set with
+// Serial.begin() and put in a receive ring of the size of the Arduino
+// core's. A byte that arrives while the ring is full is lost, as on the
+// AVR, and logged as "serial lost".
+/* License
+   -------
+ * This sketch  is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * You should have received a copy of the GNU General Public License.
+ * If not, see <http://www.gnu.org/licenses/>.
+*/
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <sys/time.h>
+#include <termios.h>
+#include <time.h>
+#include <unistd.h>
+#include "Arduino.h"
+#include "EEPROM.h"
+
+#define RX_BUFFER_SIZE  64          // Serial receive ring of the Arduino core, holds one less
+#define LINE_SIZE       4096        // Bytes read from the pty that are still on the line
+#define WAIT_MS         1.0         // Longest sleep between loop() calls, real milliseconds
+
+HardwareSerial Serial;
+
+static double clock_speed = 1.0;
+static struct timespec clock_start;
+static FILE *event_log = NULL;
+static int master = -1;
+static unsigned char rx_buffer[RX_BUFFER_SIZE];
+static int rx_head = 0;
+static int rx_count = 0;
+static unsigned char line_data[LINE_SIZE];
+static double line_time[LINE_SIZE];    // Simulated time each byte has arrived
+static int line_head = 0;
+static int line_count = 0;
+static double line_free = 0.0;          // Simulated time the line is idle from
+static unsigned long line_baud = 9600;
+
+double host_seconds();
+void rtc_start(time_t t, double phase);
+
+//======================================================================
+// Simulated clock
+//======================================================================
+double host_seconds()
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return ((t.tv_sec - clock_start.tv_sec) + (t.tv_nsec - clock_start.tv_nsec) * 1e-9) * clock_speed;
+}
+
+unsigned long millis()
+{
+    return (unsigned long)(host_seconds() * 1000.0);
+}
+
+//======================================================================
+// Pins and event log
+//======================================================================
+void host_log(const char *format, ...)
+{
+    va_list args;
+    if (event_log == NULL)
+        return;
+    fprintf(event_log, "%.3f ", host_seconds() * 1000.0);
+    va_start(args, format);
+    vfprintf(event_log, format, args);
+    va_end(args);
+    fputc('\n', event_log);
+}
+
+void pinMode(uint8_t pin, uint8_t mode)
+{
+}
+
+void digitalWrite(uint8_t pin, uint8_t value)
+{
+    host_log("pin %d %d", pin, value);
+}
+
+//======================================================================
+// Serial on the master side of a pseudo terminal
+//======================================================================
+static int open_pty()
+{
+    struct termios attr;
+    int slave;
+    master = posix_openpt(O_RDWR | O_NOCTTY);
+    if (master < 0 || grantpt(master) < 0 || unlockpt(master) < 0)
+        return -1;
+    // Held open, so the master does not see a hangup between host connections
+    slave = open(ptsname(master), O_RDWR | O_NOCTTY);
+    if (slave < 0)
+        return -1;
+    tcgetattr(slave, &attr);
+    cfmakeraw(&attr);
+    tcsetattr(slave, TCSANOW, &attr);
+    fcntl(master, F_SETFL, fcntl(master, F_GETFL) | O_NONBLOCK);
+    return 0;
+}
+
+void HardwareSerial::begin(unsigned long baud)
+{
+    host_log("serial %lu", baud);
+    line_baud = baud;
+}
+
+// Waits for the output to be sent, as the Arduino core does
+void HardwareSerial::flush()
+{
+    tcdrain(master);
+}
+
+// What the receive interrupt would have done by now: the bytes that have
+// arrived go to the ring, those that find it full are dropped
+static void receive()
+{
+    unsigned char data[256];
+    double now = host_seconds();
+    int lost = 0;
+    while (line_count < LINE_SIZE)
+    {
+        size_t room = LINE_SIZE - line_count;
+        ssize_t n = ::read(master, data, room < sizeof(data) ? room : sizeof(data));
+        if (n <= 0)
+            break;
+        for (ssize_t i = 0; i < n; i++)
+        {
+            // 10 bits a byte, 8N1
+            if (line_free < now)
+                line_free = now;
+            line_free += 10.0 / line_baud;
+            int tail = (line_head + line_count) % LINE_SIZE;
+            line_data[tail] = data[i];
+            line_time[tail] = line_free;
+            line_count++;
+        }
+    }
+    while (line_count > 0 && line_time[line_head] <= now)
+    {
+        if (rx_count < RX_BUFFER_SIZE - 1)
+        {
+            rx_buffer[(rx_head + rx_count) % RX_BUFFER_SIZE] = line_data[line_head];
+            rx_count++;
+        }
+        else
+            lost++;
+        line_head = (line_head + 1) % LINE_SIZE;
+        line_count--;
+    }
+    if (lost > 0)
+        host_log("serial lost %d", lost);
+}
+
+int HardwareSerial::available()
+{
+    receive();
+    return rx_count;
+}
+
+int HardwareSerial::read()
+{
+    int c;
+    if (available() == 0)
+        return -1;
+    c = rx_buffer[rx_head];
+    rx_head = (rx_head + 1) % RX_BUFFER_SIZE;
+    rx_count--;
+    return c;
+}
+
+size_t HardwareSerial::write(uint8_t c)
+{
+    while (::write(master, &c, 1) < 0 && errno == EAGAIN)
+        usleep(1000);
+    return 1;
+}
+
+size_t HardwareSerial::print(const char *s)
+{
+    size_t n = 0;
+    while (s[n])
+        write(s[n++]);
+    return n;
+}
+
+size_t HardwareSerial::print(char c)
+{
+    return write(c);
+}
+
+size_t HardwareSerial::print(long n, int base)
+{
+    char text[34];
+    if (base == DEC)
+        snprintf(text, sizeof(text), "%ld", n);
+    else
+        snprintf(text, sizeof(text), "%lx", (unsigned long)n);
+    return print(text);
+}
+
+size_t HardwareSerial::print(unsigned long n, int base)
+{
+    char text[34];
+    snprintf(text, sizeof(text), base == DEC ? "%lu" : "%lx", n);
+    return print(text);
+}
+
+size_t HardwareSerial::print(int n, int base)
+{
+    return print((long)n, base);
+}
+
+size_t HardwareSerial::print(unsigned int n, int base)
+{
+    return print((unsigned long)n, base);
+}
+
+size_t HardwareSerial::println()
+{
+    return print("\r\n");
+}
+
+size_t HardwareSerial::println(const char *s)
+{
+    return print(s) + println();
+}
+
+size_t HardwareSerial::println(char c)
+{
+    return print(c) + println();
+}
+
+size_t HardwareSerial::println(int n, int base)
+{
+    return print(n, base) + println();
+}
+
+size_t HardwareSerial::println(unsigned int n, int base)
+{
+    return print(n, base) + println();
+}
+
+size_t HardwareSerial::println(long n, int base)
+{
+    return print(n, base) + println();
+}
+
+size_t HardwareSerial::println(unsigned long n, int base)
+{
+    return print(n, base) + println();
+}
+
+//======================================================================
+// Main program
+//======================================================================
+static void wait_for_serial()
+{
+    struct pollfd fd = {master, POLLIN, 0};
+    struct timespec timeout;
+    double wait = WAIT_MS / clock_speed;
+    if (rx_count > 0)
+        return;
+    if (line_count > 0)
+    {
+        // Until the next byte on the line has arrived
+        double next = (line_time[line_head] - host_seconds()) * 1000.0 / clock_speed;
+        wait = next < wait ? (next > 0 ? next : 0) : wait;
+    }
+    timeout.tv_sec = 0;
+    timeout.tv_nsec = (long)(wait * 1e6);
+    ppoll(&fd, 1, &timeout, NULL);
+}
+
+int main(int argc, char **argv)
+{
+    struct timeval wall;
+    time_t start_time = 0;
+    const char *eeprom_file = NULL;
+    const char *log_file = NULL;
+    int option;
+
+    while ((option = getopt(argc, argv, "s:t:e:l:")) != -1)
+    {
+        switch (option)
+        {
+            case 's': clock_speed = atof(optarg); break;
+            case 't': start_time = atol(optarg); break;
+            case 'e': eeprom_file = optarg; break;
+            case 'l': log_file = optarg; break;
+            default:
+                fprintf(stderr, "Usage: %s [-s SPEED] [-t TIME] [-e EEPROM_FILE] [-l LOG_FILE]\n", argv[0]);
+                return 1;
+        }
+    }
+    if (clock_speed <= 0)
+        clock_speed = 1.0;
+    if (log_file != NULL)
+    {
+        event_log = fopen(log_file, "w");
+        if (event_log == NULL)
+        {
+            perror(log_file);
+            return 1;
+        }
+        setvbuf(event_log, NULL, _IOLBF, 0);
+    }
+    eeprom_open(eeprom_file);
+    if (open_pty() < 0)
+    {
+        perror("pseudo terminal");
+        return 1;
+    }
+    clock_gettime(CLOCK_MONOTONIC, &clock_start);
+    if (start_time != 0)
+        rtc_start(start_time, 0.0);
+    else
+    {
+        gettimeofday(&wall, NULL);
+        rtc_start(wall.tv_sec, wall.tv_usec * 1e-6);
+    }
+    printf("%s\n", ptsname(master));
+    fflush(stdout);
+
+    setup();
+    for (;;)
+    {
+        loop();
+        wait_for_serial();
+    }
+    return 0;
+}
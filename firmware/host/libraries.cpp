@@ -0,0 +1,294 @@
+// Host build of the WSPR beacon firmware: EEPROM, Time, DS3232RTC, Si5351
+// and JTEncode as far as the firmware uses them.
+/* License
+   -------
+ * This sketch  is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * You should have received a copy of the GNU General Public License.
+ * If not, see <http://www.gnu.org/licenses/>.
+*/
+#include <ctype.h>
+#include <fcntl.h>
+#include <math.h>
+#include <unistd.h>
+#include "Arduino.h"
+#include "EEPROM.h"
+#include "TimeLib.h"
+#include "DS3232RTC.h"
+#include "si5351.h"
+#include "JTEncode.h"
+
+double host_seconds();
+
+//======================================================================
+// EEPROM
+//======================================================================
+EEPROMClass EEPROM;
+
+static uint8_t eeprom_image[EEPROM_SIZE];
+static int eeprom_fd = -1;
+
+void eeprom_open(const char *path)
+{
+    memset(eeprom_image, 0xff, sizeof(eeprom_image));
+    if (path == NULL)
+        return;
+    eeprom_fd = open(path, O_RDWR | O_CREAT, 0644);
+    if (eeprom_fd < 0)
+        return;
+    if (pread(eeprom_fd, eeprom_image, EEPROM_SIZE, 0) != EEPROM_SIZE)
+    {
+        memset(eeprom_image, 0xff, sizeof(eeprom_image));
+        pwrite(eeprom_fd, eeprom_image, EEPROM_SIZE, 0);
+    }
+}
+
+uint8_t EEPROMClass::read(int address)
+{
+    return eeprom_image[address % EEPROM_SIZE];
+}
+
+void EEPROMClass::write(int address, uint8_t value)
+{
+    address = address % EEPROM_SIZE;
+    eeprom_image[address] = value;
+    if (eeprom_fd >= 0)
+        pwrite(eeprom_fd, &value, 1, address);
+    host_log("eeprom %d %d", address, value);
+}
+
+//======================================================================
+// Time library
+//======================================================================
+static time_t sys_time = 0;
+static unsigned long prev_millis = 0;
+static time_t next_sync_time = 0;
+static time_t sync_interval = 300;
+static getExternalTime get_time = NULL;
+
+void setTime(time_t t)
+{
+    sys_time = t;
+    next_sync_time = t + sync_interval;
+    prev_millis = millis();
+}
+
+time_t now()
+{
+    while (millis() - prev_millis >= 1000)
+    {
+        sys_time++;
+        prev_millis += 1000;
+    }
+    if (next_sync_time <= sys_time && get_time != NULL)
+    {
+        time_t t = get_time();
+        if (t != 0)
+            setTime(t);
+        else
+            next_sync_time = sys_time + sync_interval;
+    }
+    return sys_time;
+}
+
+int minute()
+{
+    return (now() / 60) % 60;
+}
+
+int second()
+{
+    return now() % 60;
+}
+
+void setSyncProvider(getExternalTime getTimeFunction)
+{
+    get_time = getTimeFunction;
+    next_sync_time = sys_time;
+    now();
+}
+
+void setSyncInterval(time_t interval)
+{
+    sync_interval = interval;
+    next_sync_time = sys_time + interval;
+}
+
+//======================================================================
+// DS3231 real time clock
+//======================================================================
+DS3232RTC RTC;
+
+static time_t rtc_time = 0;         // RTC time at simulated time rtc_at
+static double rtc_at = 0.0;
+
+// The clock starts at t, phase seconds into that second
+void rtc_start(time_t t, double phase)
+{
+    rtc_time = t;
+    rtc_at = host_seconds() - phase;
+}
+
+time_t DS3232RTC::get()
+{
+    return rtc_time + (time_t)floor(host_seconds() - rtc_at);
+}
+
+uint8_t DS3232RTC::set(time_t t)
+{
+    rtc_start(t, 0.0);
+    host_log("rtc %ld", (long)t);
+    return 0;
+}
+
+//======================================================================
+// Si5351
+//======================================================================
+bool Si5351::init(uint8_t xtal_load_c, uint32_t ref_osc_freq, int32_t corr)
+{
+    host_log("si5351 init %d", corr);
+    return true;
+}
+
+void Si5351::set_correction(int32_t corr, enum si5351_pll_input ref_osc)
+{
+    host_log("si5351 correction %d", corr);
+}
+
+void Si5351::set_pll(uint64_t pll_freq, enum si5351_pll target_pll)
+{
+}
+
+uint8_t Si5351::set_freq(uint64_t freq, enum si5351_clock clk)
+{
+    host_log("si5351 freq %d %llu", clk, (unsigned long long)freq);
+    return 0;
+}
+
+void Si5351::set_clock_pwr(enum si5351_clock clk, uint8_t pwr)
+{
+    host_log("si5351 pwr %d %d", clk, pwr);
+}
+
+//======================================================================
+// JTEncode, WSPR type 1 messages
+//======================================================================
+static const uint8_t sync_vector[WSPR_SYMBOL_COUNT] =
+{
+    1,1,0,0,0,0,0,0,1,0,0,0,1,1,1,0,0,0,1,0,0,1,0,1,1,1,1,0,0,0,
+    0,0,0,0,1,0,0,1,0,1,0,0,0,0,0,0,1,0,1,1,0,0,1,1,0,1,0,0,0,1,
+    1,0,1,0,0,0,0,1,1,0,1,0,1,0,1,0,1,0,0,1,0,0,1,0,1,1,0,0,0,1,
+    1,0,1,0,1,0,0,0,1,0,0,0,0,0,1,0,0,1,0,0,1,1,1,0,1,1,0,0,1,1,
+    0,1,0,0,0,1,1,1,0,0,0,0,0,1,0,1,0,0,1,1,0,0,0,0,0,0,0,1,1,0,
+    1,0,1,1,0,0,0,1,1,0,0,0
+};
+
+static const int8_t valid_dbm[] =
+{
+    -30, -27, -23, -20, -17, -13, -10, -7, -3, 0, 3, 7, 10, 13, 17,
+    20, 23, 27, 30, 33, 37, 40, 43, 47, 50, 53, 57, 60
+};
+
+static int char_code(char c)
+{
+    if (isdigit(c))
+        return c - '0';
+    if (c >= 'A' && c <= 'Z')
+        return c - 'A' + 10;
+    return 36;
+}
+
+static int parity(uint32_t x)
+{
+    return __builtin_popcount(x) & 1;
+}
+
+void JTEncode::wspr_encode(const char *call, const char *loc, const int8_t dbm, uint8_t *symbols)
+{
+    char callsign[7];
+    char locator[5];
+    int power = valid_dbm[0];
+    size_t i;
+    int n;
+
+    // Callsign of 6 characters, a digit as 2nd character is aligned with a space
+    memset(callsign, 0, sizeof(callsign));
+    strncpy(callsign, call, 6);
+    if (isdigit(callsign[1]) && isupper(callsign[2]))
+    {
+        memmove(callsign + 1, callsign, 5);
+        callsign[0] = ' ';
+    }
+    for (i = 0; i < 6; i++)
+    {
+        callsign[i] = toupper(callsign[i]);
+        if (!(isdigit(callsign[i]) || (callsign[i] >= 'A' && callsign[i] <= 'Z')))
+            callsign[i] = ' ';
+    }
+
+    // An invalid locator is sent as AA00
+    strcpy(locator, "AA00");
+    if (strlen(loc) == 4 || strlen(loc) == 6)
+    {
+        char a = toupper(loc[0]);
+        char b = toupper(loc[1]);
+        if (a >= 'A' && a <= 'R' && b >= 'A' && b <= 'R' && isdigit(loc[2]) && isdigit(loc[3]))
+        {
+            locator[0] = a;
+            locator[1] = b;
+            locator[2] = loc[2];
+            locator[3] = loc[3];
+        }
+    }
+
+    // Power rounded down to a valid level
+    for (i = 0; i < sizeof(valid_dbm); i++)
+        if (valid_dbm[i] <= dbm)
+            power = valid_dbm[i];
+
+    // Bit packing
+    uint32_t c = char_code(callsign[0]);
+    c = c * 36 + char_code(callsign[1]);
+    c = c * 10 + char_code(callsign[2]);
+    for (i = 3; i < 6; i++)
+        c = c * 27 + char_code(callsign[i]) - 10;
+    uint32_t m = (179 - 10 * (locator[0] - 'A') - (locator[2] - '0')) * 180 +
+                 10 * (locator[1] - 'A') + (locator[3] - '0');
+    m = m * 128 + power + 64;
+    c &= 0xfffffff;
+    m &= 0x3fffff;
+
+    uint8_t bits[81];
+    for (n = 0; n < 28; n++)
+        bits[n] = (c >> (27 - n)) & 1;
+    for (n = 0; n < 22; n++)
+        bits[28 + n] = (m >> (21 - n)) & 1;
+    memset(bits + 50, 0, 31);
+
+    // Convolutional code, K=32, r=1/2
+    uint8_t coded[WSPR_SYMBOL_COUNT];
+    uint32_t reg = 0;
+    for (n = 0; n < 81; n++)
+    {
+        reg = (reg << 1) | bits[n];
+        coded[2 * n] = parity(reg & 0xf2d05351);
+        coded[2 * n + 1] = parity(reg & 0xe4613c47);
+    }
+
+    // Interleave by bit reversed index and merge with the sync vector
+    n = 0;
+    for (int j = 0; j < 256 && n < WSPR_SYMBOL_COUNT; j++)
+    {
+        uint8_t r = 0;
+        for (int k = 0; k < 8; k++)
+            r |= ((j >> k) & 1) << (7 - k);
+        if (r < WSPR_SYMBOL_COUNT)
+            symbols[r] = sync_vector[r] + 2 * coded[n++];
+    }
+}
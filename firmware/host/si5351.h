@@ -0,0 +1,28 @@
+// Host build: the Etherkit Si5351 calls of the firmware. Nothing is
+// computed, the calls that change the output are written to the event
+// log, so the tone and timing of every symbol can be checked.
+#ifndef HOST_SI5351_H
+#define HOST_SI5351_H
+
+#include <stdint.h>
+
+#define SI5351_FREQ_MULT            100ULL
+#define SI5351_PLL_FIXED            80000000000ULL
+#define SI5351_CRYSTAL_LOAD_8PF     (3 << 6)
+
+enum si5351_clock {SI5351_CLK0, SI5351_CLK1, SI5351_CLK2};
+enum si5351_pll {SI5351_PLLA, SI5351_PLLB};
+enum si5351_pll_input {SI5351_PLL_INPUT_XO, SI5351_PLL_INPUT_CLKIN};
+enum si5351_drive {SI5351_DRIVE_2MA, SI5351_DRIVE_4MA, SI5351_DRIVE_6MA, SI5351_DRIVE_8MA};
+
+class Si5351
+{
+public:
+    bool init(uint8_t xtal_load_c, uint32_t ref_osc_freq, int32_t corr);
+    void set_correction(int32_t corr, enum si5351_pll_input ref_osc);
+    void set_pll(uint64_t pll_freq, enum si5351_pll target_pll);
+    uint8_t set_freq(uint64_t freq, enum si5351_clock clk);
+    void set_clock_pwr(enum si5351_clock clk, uint8_t pwr);
+};
+
+#endif